@@ -91,6 +91,7 @@ setup_args = dict(
     package_dir = {'' : 'src'},
     # test_suite = 'cifpdfsearch.tests',
     include_package_data = True,
+    python_requires = '>=3.9',
     install_requires = [],
     zip_safe = False,
     data_files = [
@@ -117,9 +118,11 @@ setup_args = dict(
         'License :: OSI Approved :: BSD License',
         'Operating System :: MacOS',
         'Operating System :: POSIX',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
+        'Programming Language :: Python :: 3.13',
         'Topic :: Scientific/Engineering :: Chemistry',
         'Topic :: Scientific/Engineering :: Human Machine Interfaces',
         'Topic :: Scientific/Engineering :: Physics',
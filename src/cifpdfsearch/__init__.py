@@ -5,7 +5,6 @@ __all__ = ['cifid', 'cifdocument', 'genjson', 'walkjson',
 
 import json
 import os.path
-from pkg_resources import Requirement, resource_filename
 
 from cifpdfsearch.cifdocument import cifid, cifdocument
 from cifpdfsearch._utils import genjson, walkjson, normcodid
@@ -23,7 +22,7 @@ def jload(filename):
 def datapath(basename):
     """Return absolute path to data files root in cifpdfsearch.
     """
-    return os.path.join(APPDATADIR, basename)
+    return os.path.join(_appdatadir(), basename)
 
 
 def cifpath(codid):
@@ -68,37 +67,42 @@ def gencifpaths():
         Absolute paths to CIF files in the local COD database.
     """
     from cifpdfsearch.config import CODDIR
+    from cifpdfsearch.codscan import gencodfiles
     top = os.path.join(CODDIR, 'cif')
-    for root, dirnames, filenames in os.walk(top):
-        if root == top:
-            dirnames[:] = [d for d in dirnames if len(d) == 1 and d.isdigit()]
-            dirnames.sort()
-            continue
-        dirnames.sort()
-        filenames.sort()
-        for f in filenames:
-            if f.endswith('.cif'):
-                yield os.path.join(root, f)
+    for path in gencodfiles(top):
+        yield path
     pass
 
 # ----------------------------------------------------------------------------
 
-# Resolve APPDATADIR base path to the application data files.
-_upbasedir = os.path.normpath(resource_filename(__name__, '..'))
-_development_mode = (
-    os.path.basename(_upbasedir) == "src" and
-    os.path.isfile(os.path.join(_upbasedir, "../setup.py"))
-)
-
-# Requirement must have egg-info.  Do not use in _development_mode.
-_req = Requirement.parse("cifpdfsearch")
-APPDATADIR = (os.path.dirname(_upbasedir) if _development_mode
-              else resource_filename(_req, ""))
-APPDATADIR = os.path.abspath(APPDATADIR)
-
-del _upbasedir
-del _development_mode
-del _req
+def __getattr__(name):
+    "Resolve APPDATADIR on the first access."
+    if name == 'APPDATADIR':
+        return _appdatadir()
+    emsg = "module {!r} has no attribute {!r}".format(__name__, name)
+    raise AttributeError(emsg)
+
+
+def _appdatadir():
+    "Resolve APPDATADIR base path to the application data files."
+    rv = globals().get('APPDATADIR')
+    if rv is not None:
+        return rv
+    from importlib.resources import files
+    upbasedir = os.path.dirname(os.path.normpath(str(files(__name__))))
+    development_mode = (
+        os.path.basename(upbasedir) == "src" and
+        os.path.isfile(os.path.join(upbasedir, "../setup.py"))
+    )
+    if development_mode:
+        rv = os.path.dirname(upbasedir)
+    else:
+        # Distribution must have metadata.  Do not use in development mode.
+        from importlib.metadata import distribution
+        rv = str(distribution("cifpdfsearch").locate_file(""))
+    rv = os.path.abspath(rv)
+    globals()['APPDATADIR'] = rv
+    return rv
 
 # silence the pyflakes syntax checker
 assert __version__ or True
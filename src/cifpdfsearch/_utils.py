@@ -5,6 +5,7 @@
 
 import sys
 import re
+import math
 
 
 def grouper(iterable, n, *fillvalue):
@@ -48,6 +49,21 @@ def tofloat(s):
     return rv
 
 
+def cifcellvolume(values):
+    "Calculate unit cell volume from CIF cell parameters or return None."
+    names = ['_cell_length_a', '_cell_length_b', '_cell_length_c',
+             '_cell_angle_alpha', '_cell_angle_beta', '_cell_angle_gamma']
+    try:
+        a, b, c, alpha, beta, gamma = (tofloat(values[n]) for n in names)
+        ca, cb, cg = (math.cos(math.radians(x))
+                      for x in (alpha, beta, gamma))
+        rv = a * b * c * math.sqrt(
+            1 - ca * ca - cb * cb - cg * cg + 2 * ca * cb * cg)
+    except (KeyError, TypeError, ValueError):
+        rv = None
+    return rv
+
+
 def normcodid(codid):
     """Return COD identifier as 7-digit string.
 
@@ -88,24 +104,33 @@ def normcodid(codid):
 _rxcodid = re.compile(r'(?<!\d)\d{7}(?!\d)')
 
 
-def genjson(fp=None, filename=None, bufsize=262144, maxbufsize=None):
+def genjson(fp=None, filename=None, bufsize=262144, maxbufsize=None,
+            jobs=None):
     """Generate JSON entries from a file-like object.
 
+    The entries are located by a byte-level scan for their boundaries,
+    which does not decode the data and takes linear time also for
+    entries that span many read buffers.
+
     Parameters
     ----------
     fp : file, optional
-        A file-like object with a sequence of JSON entries.
+        A file-like object with a sequence of JSON entries.  It can be
+        opened in binary or text mode, binary mode is faster.
     filename : str, optional
         Path to a file with JSON entries.  The `filename` and
         `fp` arguments are mutually exclusive; only one of
         them must be provided.
     bufsize : int, optional
-        Size of the buffer to be read from the file for decoding.
-        When decoding fails, the buffer is enlarged up to `maxbufsize`
-        or until the whole file is consumed.
+        Minimum size of data to be read from the file at once.
+        The reads grow with the size of incomplete entry.
     maxbufsize : int, optional
         Maximum allowed size of the internal read buffer.  When specified,
         each JSON entry must be shorter than that.
+    jobs : int, optional
+        Number of worker processes for decoding the entries.  The
+        entries are generated in the file order.  Decode in the
+        calling process when not specified.
 
     Returns
     -------
@@ -117,40 +142,138 @@ def genjson(fp=None, filename=None, bufsize=262144, maxbufsize=None):
     JSONDecodeError
         When JSON decoding fails or if some entry exceeds `maxbufsize`.
     """
-    from json import JSONDecoder
+    import json
     if fp is None and filename is None:
         raise TypeError("must have either 'fp' or 'filename' arguments")
     if fp is not None and filename is not None:
         raise TypeError("cannot use both 'fp' and 'filename' arguments")
     if filename is not None:
-        kw = {'bufsize' : bufsize, 'maxbufsize' : maxbufsize}
-        with open(filename) as fp1:
+        kw = dict(bufsize=bufsize, maxbufsize=maxbufsize, jobs=jobs)
+        with open(filename, 'rb') as fp1:
             for jobj in genjson(fp=fp1, **kw):
                 yield jobj
         return
     # here we have file-like object in fp
+    records = _genjsonrecords(fp, bufsize, maxbufsize)
+    if not jobs or jobs <= 1:
+        for rec in records:
+            yield json.loads(rec)
+        return
+    import multiprocessing
+    with multiprocessing.Pool(jobs) as pool:
+        for jobj in pool.imap(json.loads, records, chunksize=64):
+            yield jobj
+    return
+
+
+def _genjsonrecords(fp, bufsize, maxbufsize=None):
+    """Generate byte strings of the top-level JSON values in a stream.
+
+    The boundaries of objects and arrays are found with a vectorized
+    scan of each buffer, which never re-examines a complete entry.
+    """
+    from json import JSONDecodeError
     maxbuflen = sys.maxsize if maxbufsize is None else maxbufsize
-    decoder = JSONDecoder()
-    buf = ''
-    while True:
-        chunk = fp.read(bufsize)
+    buf = b''
+    eof = False
+    while not eof:
+        if len(buf) > maxbuflen:
+            emsg = "JSON entry exceeds maxbufsize"
+            raise JSONDecodeError(emsg, buf.decode(errors='replace'), 0)
+        # grow the reads with an incomplete entry to keep scans linear
+        chunk = fp.read(max(bufsize, len(buf)))
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        eof = not chunk
         buf += chunk
-        # end of file after processing last entry
-        if buf == '':
-            break
-        try:
-            jobj, i = decoder.raw_decode(buf)
-        except ValueError:
-            if chunk == '':
-                raise
-            if len(buf) > maxbuflen:
-                raise
-            continue
-        buf = buf[i:].lstrip()
-        yield jobj
+        pos = 0
+        for end in _jsonrecordends(buf):
+            spans, pos = _splitjsonvalues(buf, pos, end, complete=True)
+            for lo, hi in spans:
+                yield buf[lo:hi]
+        spans, pos = _splitjsonvalues(buf, pos, len(buf), complete=eof)
+        for lo, hi in spans:
+            yield buf[lo:hi]
+        buf = buf[pos:]
     return
 
 
+def _jsonrecordends(buf):
+    """Return offsets after the top-level objects and arrays in buf.
+
+    Brackets are counted only outside of strings, that is, when preceded
+    by an even number of quotes which are not escaped with backslash.
+    """
+    import numpy
+    from json import JSONDecodeError
+    a = numpy.frombuffer(buf, dtype=numpy.uint8)
+    qi = numpy.flatnonzero(a == 0x22)
+    if qi.size and b'\\' in buf:
+        # quote is escaped when preceded by odd number of backslashes
+        idx = numpy.arange(a.size)
+        lastnb = numpy.maximum.accumulate(numpy.where(a == 0x5c, -1, idx))
+        nbs = qi - 1 - numpy.where(qi > 0, lastnb[qi - 1], -1)
+        qi = qi[nbs % 2 == 0]
+    # ASCII codes of "[" and "{" differ by 0x20 and so do "]" and "}"
+    a20 = a | 0x20
+    bi = numpy.flatnonzero((a20 == 0x7b) | (a20 == 0x7d))
+    bi = bi[numpy.searchsorted(qi, bi) % 2 == 0]
+    step = numpy.where(a20[bi] == 0x7b, 1, -1)
+    depth = numpy.cumsum(step)
+    if depth.size and depth.min() < 0:
+        pos = int(bi[numpy.argmax(depth < 0)])
+        emsg = "Unexpected character"
+        raise JSONDecodeError(emsg, buf.decode(errors='replace'), pos)
+    rv = (bi[depth == 0] + 1).tolist()
+    return rv
+
+
+def _splitjsonvalues(buf, lo, hi, complete):
+    """Find spans of top-level JSON values in buf[lo:hi].
+
+    The range holds scalar values optionally followed by an object
+    or array that ends at `hi`.  When `complete` is False, stop before
+    an object, array, or value that may continue past `hi`.
+
+    Returns
+    -------
+    spans : list
+        The (start, end) offsets of the JSON values.
+    pos : int
+        Offset of the first unprocessed byte.
+    """
+    from json import JSONDecodeError
+    spans = []
+    pos = lo
+    while pos < hi:
+        pos = _rxjsonspace.match(buf, pos, hi).end()
+        c = buf[pos:pos + 1] if pos < hi else b''
+        if not c:
+            break
+        if c in b'{[':
+            if complete:
+                spans.append((pos, hi))
+                pos = hi
+            break
+        rx = _rxjsonstring if c == b'"' else _rxjsonscalar
+        mx = rx.match(buf, pos, hi)
+        if mx is None and not complete:
+            break
+        if mx is None or mx.end() == pos:
+            emsg = ("Unterminated JSON entry" if c == b'"'
+                    else "Unexpected character")
+            raise JSONDecodeError(emsg, buf.decode(errors='replace'), pos)
+        if mx.end() == hi and not complete:
+            break
+        spans.append(mx.span())
+        pos = mx.end()
+    return spans, pos
+
+_rxjsonspace = re.compile(rb'[ \t\n\r]*')
+_rxjsonstring = re.compile(rb'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_rxjsonscalar = re.compile(rb'[^ \t\n\r{}[\]",:]*')
+
+
 def safecall(f, default=None):
     """Function wrapper that returns fallback value on exception.
     """
@@ -191,7 +314,7 @@ def h5writejson(group, cfg):
     def _assign_type(gtop, gpath):
         owners = list(accumulate((cfg,) + gpath, getitem))
         for owner in reversed(owners):
-            tp = numpy.string_(type(owner).__name__)
+            tp = numpy.bytes_(type(owner).__name__)
             if gtop.attrs.get('type', '') == tp:
                 break
             gtop.attrs['type'] = tp
@@ -205,6 +328,36 @@ def h5writejson(group, cfg):
     return
 
 
+def h5readjson(group):
+    """Read json-like object saved with h5writejson from HDF5 group.
+
+    Parameters
+    ----------
+    group : h5py.Group
+        The HDF5 group object with the saved json-like object.
+
+    Returns
+    -------
+    dict, list or tuple
+        The json-like object as indicated by the "type" attributes.
+    """
+    import h5py
+    if isinstance(group, h5py.Dataset):
+        rv = group[()]
+        if isinstance(rv, bytes):
+            rv = rv.decode()
+        elif hasattr(rv, 'item'):
+            rv = rv.item()
+        return rv
+    items = {n: h5readjson(group[n]) for n in group}
+    tp = group.attrs.get('type', b'dict')
+    tp = tp.decode() if isinstance(tp, bytes) else str(tp)
+    if tp not in ('list', 'tuple'):
+        return items
+    rv = [items[str(i)] for i in range(len(items))]
+    return rv if tp == 'list' else tuple(rv)
+
+
 def walkjson(obj):
     """Generate index-paths and values from a json-like hierarchy.
 
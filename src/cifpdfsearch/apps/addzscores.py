@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+'''Add z-scored PDF rows to raw storage for fast correlation search.
+
+The z-scored rows are centred and normalized over an r-window so that
+cifpdfsearch evaluates correlation coefficients as a single dot product
+when the searched PDF covers the same window.  Without any --window use
+the full r-range of the storage.
+'''
+
+import argparse
+
+parser = argparse.ArgumentParser(description=__doc__.strip())
+parser.add_argument('-w', '--window', nargs=2, type=float, action='append',
+                    metavar=('RMIN', 'RMAX'),
+                    help="r-window for the z-scores.  Can be repeated.")
+parser.add_argument('storage', nargs='+',
+                    help="Raw storage YAML files or a sharded storage "
+                    "manifest")
+
+
+def main(args):
+    from cifpdfsearch.cifpdf import openstorage, writezscores
+    windows = args.window or [(None, None)]
+    for f in args.storage:
+        store = openstorage(f)
+        shards = getattr(store, 'shards', [store])
+        for st in shards:
+            writezscores(st, windows)
+            print("{}: z-scores for {} windows".format(
+                st.filename, len(st.zscores)))
+    return
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
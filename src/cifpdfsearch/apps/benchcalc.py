@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+'''Benchmark PDF calculation throughput of the calcpdfs pipeline.
+
+Calculate PDFs with the configured PDFCALCULATOR for a fixed sample of
+CIF files and report the throughput, time spent in each stage and the
+distribution of per-entry cost.  The default sample are the bundled
+standard CIFs.  Entries from a COD list that are not in the local COD
+mirror are replaced with synthetic CIFs generated from the COD id.
+'''
+
+import os
+import time
+import json
+import argparse
+
+parser = argparse.ArgumentParser(description=__doc__.strip())
+parser.add_argument('-c', '--config', metavar='FILE',
+                    help="Load the specified configuration file")
+parser.add_argument('-l', '--codlist', metavar='FILE',
+                    help="File with COD CIF paths or ids to be calculated, "
+                    "e.g., codcifs1000.txt.")
+parser.add_argument('-n', '--count', type=int,
+                    help="Limit the sample to the first COUNT entries.")
+parser.add_argument('-o', '--output', metavar='FILE',
+                    help="Save summary and per-entry timings to a JSON file.")
+parser.add_argument('cifs', nargs='*',
+                    help="CIF files to be calculated.  Use the bundled "
+                    "standards when no CIFs or COD list are specified.")
+
+STAGES = ('parse', 'expand', 'calculate', 'write')
+
+# Space groups for synthetic CIFs as (H-M symbol, symmetry operations).
+SYNTHETIC_SPACEGROUPS = [
+    ('P 1', ['x,y,z']),
+    ('P -1', ['x,y,z', '-x,-y,-z']),
+    ('P 1 21/c 1', ['x,y,z', '-x,1/2+y,1/2-z', '-x,-y,-z', 'x,1/2-y,1/2+z']),
+    ('P b c a', ['x,y,z', '1/2-x,-y,1/2+z', '-x,1/2+y,1/2-z',
+                 '1/2+x,1/2-y,-z', '-x,-y,-z', '1/2+x,y,1/2-z',
+                 'x,1/2-y,1/2+z', '1/2-x,1/2+y,z']),
+]
+
+SYNTHETIC_ELEMENTS = 'H C N O F Na Mg Al Si P S Cl K Ca Ti Fe Ni Cu Zn Ba'
+
+
+def synthesizecif(codid):
+    """Return CIF text of a random crystal structure seeded by COD id.
+
+    The structure has a typical atom number density of 0.08 / A**3
+    and up to 240 atoms in the unit cell.
+    """
+    import numpy
+    rs = numpy.random.RandomState(int(codid))
+    hm, symops = SYNTHETIC_SPACEGROUPS[
+        rs.randint(len(SYNTHETIC_SPACEGROUPS))]
+    nsites = int(numpy.exp(rs.uniform(0, numpy.log(240 / len(symops)))))
+    nsites = max(1, nsites)
+    volume = nsites * len(symops) / 0.08
+    abc = volume ** (1.0 / 3) * rs.uniform(0.8, 1.25, 3)
+    beta = 90.0 if hm != 'P 1 21/c 1' else rs.uniform(90, 115)
+    abc[1] = volume / (abc[0] * abc[2] * numpy.sin(numpy.radians(beta)))
+    elements = SYNTHETIC_ELEMENTS.split()
+    lines = ['data_synthetic_{}'.format(codid)]
+    lines += ['_cell_length_{} {:.5f}'.format(n, x)
+              for n, x in zip('abc', abc)]
+    lines += ['_cell_angle_alpha 90', '_cell_angle_beta {:.3f}'.format(beta),
+              '_cell_angle_gamma 90',
+              "_symmetry_space_group_name_H-M '{}'".format(hm),
+              '_cod_database_code {}'.format(codid),
+              'loop_', '_symmetry_equiv_pos_as_xyz']
+    lines += symops
+    lines += ['loop_', '_atom_site_label', '_atom_site_type_symbol',
+              '_atom_site_fract_x', '_atom_site_fract_y',
+              '_atom_site_fract_z', '_atom_site_U_iso_or_equiv']
+    for i in range(nsites):
+        smbl = elements[rs.randint(len(elements))]
+        xyz = ' '.join('{:.5f}'.format(x) for x in rs.random_sample(3))
+        lines.append('{0}{1} {0} {2} 0.01'.format(smbl, i + 1, xyz))
+    rv = '\n'.join(lines) + '\n'
+    return rv
+
+
+class _TimedStages:
+    """Evaluate and time the stages of PDF calculation for a CIF file.
+    """
+
+    def __init__(self, pdfc, outdir, eps=0.001):
+        from diffpy.structure.parsers.p_cif import P_cif
+        self.pdfc = pdfc
+        self.outdir = outdir
+        timer = self
+
+        class TimedP_cif(P_cif):
+
+            def _expandAsymmetricUnit(self, block):
+                t0 = time.perf_counter()
+                super()._expandAsymmetricUnit(block)
+                timer.texpand += time.perf_counter() - t0
+                return
+
+        self.parser = TimedP_cif(eps=eps)
+        self.texpand = 0.0
+        return
+
+
+    def __call__(self, ciffile):
+        "Return dictionary of stage times for the CIF file."
+        import numpy
+        rv = {}
+        self.texpand = 0.0
+        t0 = time.perf_counter()
+        stru = self.parser.parseFile(ciffile)
+        t1 = time.perf_counter()
+        r, g = self.pdfc(stru)
+        t2 = time.perf_counter()
+        out = os.path.join(self.outdir, 'benchcalc.npy')
+        numpy.save(out, g.astype(numpy.float32))
+        t3 = time.perf_counter()
+        rv['parse'] = t1 - t0 - self.texpand
+        rv['expand'] = self.texpand
+        rv['calculate'] = t2 - t1
+        rv['write'] = t3 - t2
+        rv['natoms'] = len(stru)
+        return rv
+
+# end of class _TimedStages
+
+
+def getsample(args, tmpdir):
+    """Return list of (label, ciffile, synthetic) tuples for benchmark.
+    """
+    import glob
+    from cifpdfsearch import datapath, cifpath, normcodid
+    rv = [(os.path.basename(f), f, False) for f in args.cifs]
+    if args.codlist:
+        with open(args.codlist) as fp:
+            entries = [line.strip() for line in fp if line.strip()]
+        for e in entries[:args.count]:
+            codid = normcodid(os.path.basename(e))
+            f = cifpath(codid)
+            synthetic = not os.path.isfile(f)
+            if synthetic:
+                f = os.path.join(tmpdir, codid + '.cif')
+                with open(f, 'w') as fp:
+                    fp.write(synthesizecif(codid))
+            rv.append((codid, f, synthetic))
+    if not rv:
+        stdcifs = sorted(glob.glob(datapath('standards/*.cif')))
+        rv = [(os.path.basename(f), f, False) for f in stdcifs]
+    rv = rv[:args.count]
+    return rv
+
+
+def main(args):
+    import tempfile
+    import shutil
+    from cifpdfsearch import config, cifpdf
+    if args.config:
+        config.initialize(args.config)
+    pdfc = cifpdf.calculator.fromConfig(config.PDFCALCULATOR)
+    sft = pdfc.scatteringfactortable
+    if hasattr(sft, 'preload'):
+        sft.preload()
+    tmpdir = tempfile.mkdtemp(prefix='benchcalc-')
+    try:
+        sample = getsample(args, tmpdir)
+        timedstages = _TimedStages(pdfc, tmpdir)
+        records = []
+        t0 = time.perf_counter()
+        for label, f, synthetic in sample:
+            rec = dict(entry=label, synthetic=synthetic,
+                       cost=cifpdf.cifcost(f, pdfc.rmax))
+            try:
+                rec.update(timedstages(f))
+            except Exception as e:
+                rec['error'] = '{}: {}'.format(type(e).__name__, e)
+            records.append(rec)
+        walltime = time.perf_counter() - t0
+    finally:
+        shutil.rmtree(tmpdir)
+    summary = summarize(records, walltime)
+    summary['config'] = config.PDFCALCULATOR
+    printsummary(summary)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(dict(summary=summary, entries=records), fp,
+                      indent=1, sort_keys=True, default=float)
+    return
+
+
+def summarize(records, walltime):
+    "Return dictionary of benchmark statistics."
+    import numpy
+    done = [r for r in records if 'error' not in r]
+    rv = {}
+    rv['structures'] = len(done)
+    rv['synthetic'] = sum(r['synthetic'] for r in records)
+    rv['failed'] = len(records) - len(done)
+    rv['walltime'] = walltime
+    rv['throughput'] = len(done) / walltime if walltime > 0 else None
+    rv['stages'] = {s: sum(r[s] for r in done) for s in STAGES}
+    tentry = numpy.array([sum(r[s] for s in STAGES) for r in done])
+    if len(done):
+        pct = [0, 50, 90, 99, 100]
+        rv['entrytime'] = dict(zip(['min', 'p50', 'p90', 'p99', 'max'],
+                                   numpy.percentile(tentry, pct)))
+        order = numpy.argsort(tentry)[::-1][:5]
+        rv['slowest'] = [(done[i]['entry'], tentry[i]) for i in order]
+    # Spearman rank correlation between estimated cost and time
+    costs = numpy.array([r['cost'] for r in done])
+    if len(done) > 2 and numpy.all(numpy.isfinite(costs)):
+        rank = lambda x: numpy.argsort(numpy.argsort(x))
+        rv['costcorrelation'] = numpy.corrcoef(
+            rank(costs), rank(tentry))[0, 1]
+    return rv
+
+
+def printsummary(summary):
+    print("structures: {} ({} synthetic, {} failed)".format(
+        summary['structures'], summary['synthetic'], summary['failed']))
+    print("wall time [s]: {:.4g}".format(summary['walltime']))
+    if summary['throughput'] is not None:
+        print("throughput [structures/s]: {:.4g}".format(
+            summary['throughput']))
+    ttotal = sum(summary['stages'].values()) or 1.0
+    nst = max(1, summary['structures'])
+    print("{:12s} {:>10s} {:>10s} {:>8s}".format(
+        'stage', 'total[s]', 'mean[ms]', 'fraction'))
+    for s in STAGES:
+        t = summary['stages'][s]
+        print("{:12s} {:10.4g} {:10.4g} {:8.3f}".format(
+            s, t, 1e3 * t / nst, t / ttotal))
+    if 'entrytime' in summary:
+        et = summary['entrytime']
+        print("entry time [ms]:", ' '.join(
+            '{}={:.4g}'.format(n, 1e3 * v) for n, v in et.items()))
+        print("slowest entries:")
+        for label, t in summary['slowest']:
+            print("  {} {:.4g} s".format(label, t))
+    if 'costcorrelation' in summary:
+        print("rank correlation of cost estimate and time: {:.3f}".format(
+            summary['costcorrelation']))
+    return
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
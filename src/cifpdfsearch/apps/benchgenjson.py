@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+'''Benchmark the streaming JSON parser of the CIF document dumps.
+
+Compare the throughput of genjson with the former implementation that
+re-sliced the read buffer after every entry.  The input is a JSON dump
+such as the output of ciftonicejson or a synthetic dump with entries of
+the specified size.  All parser variants must produce identical entries.
+'''
+
+import os
+import sys
+import time
+import json
+import argparse
+
+parser = argparse.ArgumentParser(description=__doc__.strip())
+parser.add_argument('-n', '--count', type=int, default=2000,
+                    help="Number of entries in the synthetic dump.  "
+                    "The default is 2000.")
+parser.add_argument('-s', '--size', type=int, default=4000,
+                    help="Approximate size of synthetic entries in bytes.  "
+                    "The default is 4000.")
+parser.add_argument('-j', '--jobs', type=int, default=4,
+                    help="Number of decoding processes for the parallel "
+                    "variant.  The default is 4.")
+parser.add_argument('--bufsize', type=int, default=262144,
+                    help="Read buffer size.  The default is 262144.")
+parser.add_argument('--no-legacy', action='store_true',
+                    help="Skip the former implementation, which is "
+                    "quadratic in the number of entries per buffer.")
+parser.add_argument('dump', nargs='?',
+                    help="JSON dump to be parsed.  Use a synthetic dump "
+                    "when not specified.")
+
+
+def genfromtext(genfunc, filename, **kw):
+    "Run JSON parser genfunc on a file opened in text mode."
+    with open(filename) as fp:
+        for jobj in genfunc(fp, **kw):
+            yield jobj
+    pass
+
+
+def legacygenjson(fp, bufsize=262144):
+    "Former genjson implementation for comparison."
+    from json import JSONDecoder
+    decoder = JSONDecoder()
+    buf = ''
+    while True:
+        chunk = fp.read(bufsize)
+        buf += chunk
+        if buf == '':
+            break
+        try:
+            jobj, i = decoder.raw_decode(buf)
+        except ValueError:
+            if chunk == '':
+                raise
+            continue
+        buf = buf[i:].lstrip()
+        yield jobj
+    pass
+
+
+def synthesizedump(filename, count, size):
+    """Write a dump of JSON entries that resemble CIF documents.
+
+    Entries are indented over several lines and contain nested
+    objects, arrays and strings with escaped characters.
+    """
+    import random
+    rs = random.Random(count)
+    with open(filename, 'w') as fp:
+        for i in range(count):
+            natoms = max(1, size // 100)
+            doc = {
+                'codid': str(1000000 + i),
+                'formula': '- C{} H{} O{} -'.format(*rs.sample(range(99), 3)),
+                'title': 'Synthetic "entry" {}\\'.format(i),
+                'cell': [rs.uniform(3, 30) for _ in range(6)],
+                'atom_site': [{'label': 'C{}'.format(k),
+                               'xyz': [rs.random() for _ in range(3)]}
+                              for k in range(natoms)],
+            }
+            json.dump(doc, fp, indent=1)
+            fp.write('\n')
+    return
+
+
+def timeparse(label, genfunc, reference):
+    "Run genfunc, check its results and print the throughput."
+    t0 = time.perf_counter()
+    entries = list(genfunc())
+    dt = time.perf_counter() - t0
+    status = 'ok' if reference is None or entries == reference else 'DIFFER'
+    print("{:16s} {:8.3f} {:10.4g} {:>8s}".format(
+        label, dt, len(entries) / dt, status))
+    return entries, status == 'ok'
+
+
+def main(args):
+    import tempfile
+    from cifpdfsearch import genjson
+    tmpdir = None
+    dump = args.dump
+    if dump is None:
+        tmpdir = tempfile.mkdtemp(prefix='benchgenjson-')
+        dump = os.path.join(tmpdir, 'synthetic.json')
+        synthesizedump(dump, args.count, args.size)
+    kw = dict(bufsize=args.bufsize)
+    variants = [
+        ('binary', lambda: genjson(filename=dump, **kw)),
+        ('text', lambda: genfromtext(genjson, dump, **kw)),
+        ('binary-j{}'.format(args.jobs),
+         lambda: genjson(filename=dump, jobs=args.jobs, **kw)),
+    ]
+    if not args.no_legacy:
+        variants.insert(0, ('legacy',
+                            lambda: genfromtext(legacygenjson, dump, **kw)))
+    try:
+        print("dump: {} ({:.4g} MB)".format(dump, os.path.getsize(dump) / 1e6))
+        print("{:16s} {:>8s} {:>10s} {:>8s}".format(
+            'variant', 'time[s]', 'entries/s', 'check'))
+        reference = None
+        allok = True
+        for label, genfunc in variants:
+            entries, ok = timeparse(label, genfunc, reference)
+            reference = entries if reference is None else reference
+            allok = allok and ok
+    finally:
+        if tmpdir is not None:
+            import shutil
+            shutil.rmtree(tmpdir)
+    return 0 if allok else 1
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+'''Benchmark startup time of the cifpdfsearch command line tools.
+
+Run every startup scenario in fresh Python processes after a warm-up run,
+so that the files are in the OS cache, and report the best wall time.
+The "help" scenario prints the cifpdfsearch usage, the "query" scenario
+loads the configuration and the modules needed for a document store
+query.  List the slowest imports from "python -X importtime" and fail
+when a scenario exceeds its time budget.
+'''
+
+import sys
+import time
+import argparse
+
+parser = argparse.ArgumentParser(description=__doc__.strip())
+parser.add_argument('-c', '--config', metavar='FILE',
+                    help="Configuration file for the query scenario")
+parser.add_argument('-n', '--repeat', type=int, default=5,
+                    help="Number of timed runs per scenario.  "
+                    "The default is 5.")
+parser.add_argument('--budget-help', type=float, default=0.5,
+                    metavar='SEC',
+                    help="Time budget for the help scenario in seconds.  "
+                    "The default is 0.5.")
+parser.add_argument('--budget-query', type=float, default=1.0,
+                    metavar='SEC',
+                    help="Time budget for the query scenario in seconds.  "
+                    "The default is 1.0.")
+parser.add_argument('--top', type=int, default=8,
+                    help="Number of the slowest imports to be listed.  "
+                    "The default is 8.")
+
+QUERYSTARTUP = '''\
+import sys
+from cifpdfsearch import config
+if sys.argv[1:]:
+    config.initialize(sys.argv[1])
+import cifpdfsearch.apps.cifpdfsearch as app
+from cifpdfsearch.docstore import DocStore
+app.storepath('DOCSTORE')
+'''
+
+
+def scenarios(cfgfile=None):
+    "Return dictionary of Python arguments for the startup scenarios."
+    rv = {
+        'help' : ['-m', 'cifpdfsearch.apps.cifpdfsearch', '--help'],
+        'query' : ['-c', QUERYSTARTUP] + ([cfgfile] if cfgfile else []),
+    }
+    return rv
+
+
+def timestartup(pyargs, repeat):
+    """Return the best wall time of Python runs with the arguments.
+
+    Raises
+    ------
+    RuntimeError
+        When the Python process fails.
+    """
+    import subprocess
+    cmd = [sys.executable] + pyargs
+    times = []
+    for i in range(repeat + 1):
+        t0 = time.perf_counter()
+        proc = subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.PIPE)
+        dt = time.perf_counter() - t0
+        if proc.returncode:
+            emsg = "{} failed:\n{}".format(
+                ' '.join(cmd), proc.stderr.decode(errors='replace'))
+            raise RuntimeError(emsg)
+        # skip the warm-up run
+        if i:
+            times.append(dt)
+    return min(times)
+
+
+def slowestimports(pyargs, top):
+    """Return the slowest imports as a list of (self, cumulative, name).
+
+    The times are in seconds from the "python -X importtime" report.
+    """
+    import subprocess
+    cmd = [sys.executable, '-X', 'importtime'] + pyargs
+    proc = subprocess.run(cmd, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    records = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        words = line[12:].split('|')
+        if len(words) != 3 or not words[0].strip().isdigit():
+            continue
+        tself, tcumul = (int(w) * 1e-6 for w in words[:2])
+        records.append((tself, tcumul, words[2].strip()))
+    records.sort(reverse=True)
+    return records[:top]
+
+
+def main(args):
+    budgets = {'help' : args.budget_help, 'query' : args.budget_query}
+    allok = True
+    for name, pyargs in scenarios(args.config).items():
+        tbest = timestartup(pyargs, args.repeat)
+        ok = tbest <= budgets[name]
+        allok = allok and ok
+        print("{}: {:.3f} s, budget {:.3f} s, {}".format(
+            name, tbest, budgets[name], 'ok' if ok else 'OVER BUDGET'))
+        if args.top > 0:
+            print("  {:>8s} {:>8s}  module".format('self[s]', 'cumul[s]'))
+        for tself, tcumul, module in slowestimports(pyargs, args.top):
+            print("  {:8.4f} {:8.4f} {}".format(tself, tcumul, module))
+    return 0 if allok else 1
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    sys.exit(main(args))
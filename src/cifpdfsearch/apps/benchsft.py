@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+'''Benchmark tabulated scattering factors of SFTXrayNeutral in calcpdfs.
+
+Compare direct and tabulated form factor lookups in the Python callback
+and the calcpdfs calculation time for the standard CIF files.
+'''
+
+import glob
+import time
+import argparse
+
+parser = argparse.ArgumentParser(description=__doc__.strip())
+parser.add_argument('-c', '--config', metavar='FILE',
+                    help="Load the specified configuration file")
+parser.add_argument('-n', '--repeat', type=int, default=3,
+                    help="Number of calculations per CIF file.")
+parser.add_argument('cifs', nargs='*',
+                    help="CIF files to be calculated, by default the "
+                    "bundled standards.")
+
+SYMBOLS = 'H C O Si Ni Zn Sr2+ Ti4+ O2- Wa'.split()
+
+
+def timelookups(sft, qgrid):
+    "Return time per lookup call for SYMBOLS over the qgrid."
+    t0 = time.perf_counter()
+    for smbl in SYMBOLS:
+        for q in qgrid:
+            sft.lookup(smbl, q)
+    rv = (time.perf_counter() - t0) / (len(SYMBOLS) * len(qgrid))
+    return rv
+
+
+def timecalculations(pdfc, cifs, repeat):
+    "Return total calcpdfs calculation time for all CIF files."
+    from cifpdfsearch.apps.calcpdfs import calculate
+    t0 = time.perf_counter()
+    for i in range(repeat):
+        for f in cifs:
+            try:
+                calculate(pdfc, f)
+            except RuntimeError:
+                pass
+    rv = time.perf_counter() - t0
+    return rv
+
+
+def main(args):
+    import numpy
+    from cifpdfsearch import config, cifpdf, datapath
+    from cifpdfsearch.sftxrayneutral import SFTXrayNeutral
+    if args.config:
+        config.initialize(args.config)
+    cifs = args.cifs or sorted(glob.glob(datapath('standards/*.cif')))
+    cfg = dict(config.PDFCALCULATOR, scatteringfactortable='xrayneutral')
+    pdfc = cifpdf.calculator.fromConfig(cfg)
+    sft = SFTXrayNeutral()
+    qgrid = numpy.linspace(0, 30, 1001)
+    # first fill the tables to get a consistent comparison
+    t0 = time.perf_counter()
+    sft.preload()
+    tpreload = time.perf_counter() - t0
+    SFTXrayNeutral.tabulate = False
+    fdirect = [sft.lookup(s, q) for s in SYMBOLS for q in qgrid]
+    tldirect = timelookups(sft, qgrid)
+    tcdirect = timecalculations(pdfc, cifs, args.repeat)
+    SFTXrayNeutral.tabulate = True
+    ftable = [sft.lookup(s, q) for s in SYMBOLS for q in qgrid]
+    tltable = timelookups(sft, qgrid)
+    tctable = timecalculations(pdfc, cifs, args.repeat)
+    maxrelerr = numpy.max(numpy.abs(numpy.subtract(ftable, fdirect)) /
+                          numpy.abs(fdirect))
+    ncalc = args.repeat * len(cifs)
+    print("preload tables [s]: {:.3g}".format(tpreload))
+    print("max relative error of tabulated values: {:.3g}".format(maxrelerr))
+    print("{:24s} {:>12s} {:>12s} {:>8s}".format(
+        '', 'direct', 'tabulated', 'speedup'))
+    fmt = "{:24s} {:12.4g} {:12.4g} {:8.2f}"
+    print(fmt.format("lookup [us]", 1e6 * tldirect, 1e6 * tltable,
+                     tldirect / tltable))
+    print(fmt.format("calculation [ms]", 1e3 * tcdirect / ncalc,
+                     1e3 * tctable / ncalc, tcdirect / tctable))
+    return
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
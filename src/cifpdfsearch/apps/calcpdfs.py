@@ -5,16 +5,56 @@
 
 import os.path
 import argparse
-import numpy
+import time
 
 parser = argparse.ArgumentParser(description=__doc__.strip())
 parser.add_argument('-c', '--config', metavar='FILE',
                     help="Load the specified configuration file")
 parser.add_argument('-f', '--force', action='store_true',
                     help="Overwrite existing result files.")
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help="Number of parallel worker processes.")
+parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                    help="Maximum wall-clock time per structure.  Longer "
+                    "calculations are terminated and logged as failures.")
+parser.add_argument('--order', choices=['cost', 'random'], default='cost',
+                    help="Processing order of the CIF files.  The default "
+                    "'cost' starts with the most expensive structures.")
+parser.add_argument('--journal', metavar='FILE',
+                    help="Status journal in JSON lines format.  "
+                    "Use calcpdfs.jsonl in the output directory by default.")
+parser.add_argument('--retry-failed', action='store_true',
+                    help="Recalculate entries that failed with permanent "
+                    "errors.  Only transient failures are retried otherwise.")
+parser.add_argument('--stale', type=float, metavar='SECONDS',
+                    help="Recalculate entries started longer than this ago "
+                    "that have no result.  Assume they are still running "
+                    "when not specified.")
+parser.add_argument('--make-leases', type=int, metavar='SIZE',
+                    help="Split the CIF files into lease files with SIZE "
+                    "entries in the leases subdirectory of output and exit.")
+parser.add_argument('--leases', action='store_true',
+                    help="Process CIF files from the leases subdirectory "
+                    "and write results to a raw storage shard in the shards "
+                    "subdirectory.  Several processes can share the output.")
+parser.add_argument('--lease-expire', type=float, default=3600,
+                    metavar='SECONDS', help="Reclaim leases that were not "
+                    "renewed for this time.  Must exceed the time per "
+                    "structure.  The default is 3600.")
+parser.add_argument('--report', action='store_true',
+                    help="Print status and throughput statistics "
+                    "from the journal and from the journals of lease "
+                    "owners in the shards subdirectory and exit.")
+parser.add_argument('--metrics', metavar='FILE',
+                    help="Save counters and duration histogram of the "
+                    "calculations to FILE at exit, in Prometheus text "
+                    "format for the .prom extension and JSON otherwise.")
+parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                    help="Serve the metrics in Prometheus text format "
+                    "on this HTTP port.")
 parser.add_argument('output',
                     help="Output directory for the npy files")
-parser.add_argument('cifs', nargs='+',
+parser.add_argument('cifs', nargs='*',
                     help="CIF files for which to calculate PDFs. "
                          "Replace '-' with files from standard input.")
 
@@ -31,31 +71,325 @@ def calculate(pdfc, ciffile):
     return r, g
 
 
+def calculatefile(pdfc, ciffile, out):
+    """Calculate PDF for a CIF file and save it to the npy file.
+
+    Returns
+    -------
+    dict
+        Status record with the "cif", "status" and "duration" items.
+        Failed calculations have status "error" and also contain the
+        "error" exception name and its "message".
+    """
+    import numpy
+    rv = dict(cif=ciffile, status='ok')
+    t0 = time.time()
+    try:
+        r, g = calculate(pdfc, ciffile)
+        savenpy(out, g.astype(numpy.float32))
+    except Exception as e:
+        rv.update(status='error', error=type(e).__name__, message=str(e))
+    rv['duration'] = time.time() - t0
+    return rv
+
+
+def recordmetrics(rec):
+    "Count calculation status and observe duration from a status record."
+    from cifpdfsearch.metrics import metrics
+    if rec['status'] == 'ok':
+        metrics.inc('structures_computed')
+    else:
+        metrics.inc('structures_failed')
+    metrics.observe('structure_seconds', rec['duration'])
+    return
+
+
+def savenpy(out, g):
+    """Save array to npy file via a temporary file so it is never partial.
+    """
+    import numpy
+    tmp = out + '.part'
+    with open(tmp, 'wb') as fp:
+        numpy.save(fp, g)
+    os.replace(tmp, out)
+    return
+
+
+def genresults(pdfc, tasks, jobs=1, timeout=None):
+    """Calculate PDFs for a sequence of tasks.
+
+    Parameters
+    ----------
+    pdfc : PDFCalculator
+        The configured PDF calculator.
+    tasks : iterable
+        Pairs of (ciffile, out) for the input CIF and output npy file.
+    jobs : int, optional
+        Number of parallel worker processes.
+    timeout : float, optional
+        Maximum wall-clock time in seconds per task.
+
+    Yields
+    ------
+    dict
+        Status records from `calculatefile` in the order of completion.
+        Terminated tasks have status "timeout".
+    """
+    if jobs <= 1 and timeout is None:
+        for cf, out in tasks:
+            yield calculatefile(pdfc, cf, out)
+        return
+    import multiprocessing
+    ctx = multiprocessing.get_context('fork')
+    pending = iter(tasks)
+    running = {}
+    try:
+        for rec in _genworkerresults(ctx, pdfc, pending, running,
+                                     jobs, timeout):
+            yield rec
+    finally:
+        # terminate workers left over from an interrupted iteration
+        for proc, cf, out, t0 in running.values():
+            proc.kill()
+            proc.join()
+    return
+
+
+def _genworkerresults(ctx, pdfc, pending, running, jobs, timeout):
+    "Implementation of genresults with worker processes."
+    from multiprocessing.connection import wait
+    while True:
+        while len(running) < max(1, jobs):
+            task = next(pending, None)
+            if task is None:
+                break
+            cf, out = task
+            rconn, wconn = ctx.Pipe(duplex=False)
+            proc = ctx.Process(target=_workertask,
+                               args=(wconn, pdfc, cf, out))
+            proc.start()
+            wconn.close()
+            running[rconn] = (proc, cf, out, time.time())
+        if not running:
+            break
+        waittime = None
+        if timeout is not None:
+            tfirst = min(t0 for _, _, _, t0 in running.values())
+            waittime = max(0, tfirst + timeout - time.time())
+        for conn in wait(list(running), timeout=waittime):
+            proc, cf, out, t0 = running.pop(conn)
+            try:
+                rec = conn.recv()
+            except EOFError:
+                rec = dict(cif=cf, status='error', error='WorkerError',
+                           message='exit code {}'.format(proc.exitcode),
+                           duration=time.time() - t0)
+            conn.close()
+            proc.join()
+            yield rec
+        if timeout is None:
+            continue
+        now = time.time()
+        expired = [c for c, v in running.items() if now - v[-1] > timeout]
+        for conn in expired:
+            proc, cf, out, t0 = running.pop(conn)
+            proc.kill()
+            proc.join()
+            conn.close()
+            # discard any partial output
+            if os.path.exists(out + '.part'):
+                os.remove(out + '.part')
+            emsg = 'exceeded {:g} seconds'.format(timeout)
+            yield dict(cif=cf, status='timeout', error='Timeout',
+                       message=emsg, duration=now - t0)
+    return
+
+
+def _workertask(conn, pdfc, ciffile, out):
+    "Worker process target that sends the status record to conn."
+    rec = calculatefile(pdfc, ciffile, out)
+    conn.send(rec)
+    conn.close()
+    return
+
+
 def main(args):
-    from cifpdfsearch import config, cifpdf, normcodid
+    import numpy
+    from cifpdfsearch import config, cifpdf, metrics, normcodid
     from cifpdfsearch._utils import getargswithstdin
-    from numpy.random import randint
+    from cifpdfsearch.journal import CalcJournal, confighash
     if args.config:
         config.initialize(args.config)
     if not os.path.isdir(args.output):
         emsg = "{} must be a directory".format(args.output)
         raise ValueError(emsg)
+    jfile = args.journal
+    if jfile is None:
+        jfile = os.path.join(args.output, 'calcpdfs.jsonl')
+    journal = CalcJournal(jfile)
+    if args.report:
+        mergeownerjournals(journal, args.output)
+        printreport(journal.statistics())
+        return
+    if args.metrics:
+        metrics.saveatexit(args.metrics)
+    if args.metrics_port is not None:
+        metrics.metrics.enable()
+        metrics.metrics.serve(args.metrics_port)
     ciflist = list(getargswithstdin(args.cifs))
     pdfc = cifpdf.calculator.fromConfig(config.PDFCALCULATOR)
-    while ciflist:
-        cf = ciflist.pop(randint(len(ciflist)))
+    # tabulate form factors once before forking worker processes
+    sft = pdfc.scatteringfactortable
+    if hasattr(sft, 'preload'):
+        sft.preload()
+    if args.leases:
+        runleases(args, pdfc)
+        return
+    chash = confighash(config.PDFCALCULATOR)
+    if args.make_leases:
+        # skip entries completed in earlier lease runs
+        mergeownerjournals(journal, args.output)
+    npypath = lambda cf: os.path.join(
+        args.output, 'cod{}.npy'.format(normcodid(cf)))
+
+    def needsrun(cf):
+        if args.force:
+            return True
         codid = normcodid(cf)
-        out = os.path.join(args.output, 'cod{}.npy'.format(codid))
-        if not args.force and os.path.isfile(out):
-            continue
-        # create the file
-        open(out, 'w').close()
-        try:
-            r, g = calculate(pdfc, cf)
-        except Exception as e:
-            print('{}: {} {}'.format(cf, type(e).__name__, e))
-            continue
-        numpy.save(out, g.astype(numpy.float32))
+        run = journal.needsrun(codid, config=chash,
+                               retryfailed=args.retry_failed,
+                               staleafter=args.stale)
+        # results from earlier runs without journal
+        if run and codid not in journal.records:
+            out = npypath(cf)
+            run = not (os.path.isfile(out) and os.path.getsize(out))
+        return run
+
+    # filter by journal first so that cifcost reads only pending CIFs
+    ciflist = [cf for cf in ciflist if needsrun(cf)]
+    if args.order == 'cost':
+        costs = {cf: cifpdf.cifcost(cf, pdfc.rmax) for cf in ciflist}
+        ciflist.sort(key=costs.get, reverse=True)
+    else:
+        numpy.random.shuffle(ciflist)
+    if args.make_leases:
+        from cifpdfsearch.leases import LeaseDirectory
+        ldir = LeaseDirectory(os.path.join(args.output, 'leases'))
+        n = ldir.create(ciflist, args.make_leases)
+        print("created {} leases in {}".format(n, ldir.path))
+        return
+
+    def gentasks():
+        for cf in ciflist:
+            # check again for results from processes sharing the journal
+            if not args.force:
+                journal.refresh()
+                if not needsrun(cf):
+                    continue
+            journal.write(normcodid(cf), 'started', cif=cf, config=chash)
+            yield cf, npypath(cf)
+
+    results = genresults(pdfc, gentasks(), jobs=args.jobs,
+                         timeout=args.timeout)
+    try:
+        for rec in results:
+            recordmetrics(rec)
+            cf = rec.pop('cif')
+            journal.write(normcodid(cf), rec.pop('status'), cif=cf,
+                          config=chash, **rec)
+    finally:
+        journal.close()
+    return
+
+
+def runleases(args, pdfc):
+    """Calculate PDFs from leases and save them in a raw storage shard.
+
+    Use the leases and shards subdirectories of the output directory.
+    The shard files and the status journal are named after the
+    lease owner.  PDFs from a lease that expired and was taken over
+    by another owner are deleted from the shard, so that every COD
+    entry has one live row in all shards.
+    """
+    import numpy
+    import shutil
+    import tempfile
+    from cifpdfsearch import config, normcodid
+    from cifpdfsearch.cifpdf import RAWWriter
+    from cifpdfsearch.journal import CalcJournal, confighash
+    from cifpdfsearch.leases import LeaseDirectory
+    ldir = LeaseDirectory(os.path.join(args.output, 'leases'),
+                          expire=args.lease_expire)
+    sdir = os.path.join(args.output, 'shards')
+    os.makedirs(sdir, exist_ok=True)
+    base = os.path.join(sdir, ldir.owner)
+    chash = confighash(config.PDFCALCULATOR)
+    journal = CalcJournal(base + '.jsonl')
+    writer = RAWWriter(base + '-raw.yml', config.PDFCALCULATOR)
+    tmpdir = tempfile.mkdtemp(prefix='calcpdfs-')
+    r = pdfc.rgrid
+    npypath = lambda cf: os.path.join(
+        tmpdir, 'cod{}.npy'.format(normcodid(cf)))
+    try:
+        for lease in iter(ldir.claim, None):
+            tasks = ((cf, npypath(cf)) for cf in lease.items)
+            results = genresults(pdfc, tasks, jobs=args.jobs,
+                                 timeout=args.timeout)
+            written = []
+            for rec in results:
+                recordmetrics(rec)
+                cf = rec.pop('cif')
+                codid = normcodid(cf)
+                if rec['status'] == 'ok':
+                    out = npypath(cf)
+                    writer.writePDF(codid, r, numpy.load(out))
+                    os.remove(out)
+                    written.append(codid)
+                journal.write(codid, rec.pop('status'), cif=cf,
+                              config=chash, **rec)
+                if not lease.renew():
+                    break
+            results.close()
+            # save the shard before marking lease as completed
+            writer.flush()
+            if not lease.finish():
+                # the lease expired and its new owner computes the items
+                for codid in written:
+                    writer.deletePDF(codid)
+                writer.flush()
+    finally:
+        writer.close()
+        journal.close()
+        shutil.rmtree(tmpdir)
+    return
+
+
+def mergeownerjournals(journal, output):
+    "Merge journals of lease owners from the shards subdirectory."
+    import glob
+    from cifpdfsearch.journal import CalcJournal
+    ljournals = glob.glob(os.path.join(output, 'shards', '*.jsonl'))
+    for f in sorted(ljournals):
+        journal.merge(CalcJournal(f))
+    return
+
+
+def printreport(stats):
+    "Print out journal statistics from CalcJournal.statistics()."
+    print("finished:", stats['finished'])
+    for n, v in sorted(stats['status'].items()):
+        print("  {}: {}".format(n, v))
+    if stats['error']:
+        print("errors:")
+    for n, v in sorted(stats['error'].items(), key=lambda x: -x[1]):
+        print("  {}: {}".format(n, v))
+    if 'duration' in stats:
+        print("duration [s]:")
+        for n in ('total', 'mean', 'median', 'p95', 'max'):
+            print("  {}: {:.4g}".format(n, stats['duration'][n]))
+    print("elapsed [s]: {:.4g}".format(stats['elapsed']))
+    if stats['throughput'] is not None:
+        print("throughput [1/s]: {:.4g}".format(stats['throughput']))
     return
 
 
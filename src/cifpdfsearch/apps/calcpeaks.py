@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+'''Calculate weighted pair distances for the specified CIF files.
+
+Save pair distance histograms to peak storage, from which cifpdfsearch
+renders PDFs for any r-grid and peak width.  Several radiation types
+can be evaluated from a single pass over the structures, each of them
+is saved to a parallel storage with the radiation name appended to the
+output filename.
+'''
+
+import os.path
+import argparse
+
+parser = argparse.ArgumentParser(description=__doc__.strip())
+parser.add_argument('-c', '--config', metavar='FILE',
+                    help="Load the specified configuration file")
+parser.add_argument('-f', '--force', action='store_true',
+                    help="Overwrite existing output storage.")
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help="Number of parallel worker processes.")
+parser.add_argument('--resolution', type=float, default=0.001,
+                    help="Bin width of the pair distances in A.  "
+                    "The default is 0.001.")
+parser.add_argument('--margin', type=float, default=1.0,
+                    help="Extra range of pair distances beyond rmax of "
+                    "PDFCALCULATOR in A.  The default is 1.")
+parser.add_argument('--radiation', action='append', metavar='SFT',
+                    help="Scattering factor table for the pair weights, "
+                    "e.g., xray or neutron.  Can be repeated.  Use the "
+                    "PDFCALCULATOR table when not specified.")
+parser.add_argument('--render', action='store_true',
+                    help="Save PDFs rendered for the PDFCALCULATOR r-grid "
+                    "and peak width to raw storage instead of the pair "
+                    "distances.")
+parser.add_argument('output',
+                    help="Path to the output storage YAML file")
+parser.add_argument('cifs', nargs='*',
+                    help="CIF files for which to calculate pair distances. "
+                         "Replace '-' with files from standard input.")
+
+# scattering factor tables and rendering setup in the worker processes
+_worker = {}
+
+
+def calculatepeaks(ciffile):
+    """Return (ciffile, results, error) tuple for a CIF file.
+
+    The results are a list with one item per radiation type, either the
+    (r, w, numdensity) tuple from `cifpdf.pairpeaks` or a rendered PDF.
+    The results are `None` when the calculation failed with the error
+    message.
+    """
+    import numpy
+    from diffpy.structure import loadStructure
+    from cifpdfsearch.cifpdf import pairpeaks, renderpeaks
+    try:
+        stru = loadStructure(ciffile, fmt='cif', eps=0.001)
+        r, ws, rho = pairpeaks(stru, _worker['sfts'], _worker['rmax'])
+    except Exception as e:
+        emsg = '{}: {}'.format(type(e).__name__, e)
+        return ciffile, None, emsg
+    render = _worker['render']
+    if render is None:
+        results = [(r, w, rho) for w in ws]
+    else:
+        rgrid, fwhm, scale = render
+        rowofpeak = numpy.zeros(len(r), dtype=int)
+        results = [renderpeaks(rowofpeak, r, w, [rho], rgrid, fwhm,
+                               scale=scale)[0] for w in ws]
+    return ciffile, results, None
+
+
+def _initworker(cfg, rmax, radiations, render):
+    "Set up scattering factor tables for calculatepeaks."
+    # register the xrayneutral table in spawned worker processes
+    import cifpdfsearch.sftxrayneutral
+    assert cifpdfsearch.sftxrayneutral is not None
+    from diffpy.srreal.scatteringfactortable import ScatteringFactorTable
+    sfts = [ScatteringFactorTable.createByType(n) for n in radiations]
+    for sft in sfts:
+        if hasattr(sft, 'preload'):
+            sft.preload()
+    _worker.update(sfts=sfts, rmax=rmax, render=render)
+    return
+
+
+def main(args):
+    from contextlib import ExitStack
+    from cifpdfsearch import config, normcodid
+    from cifpdfsearch.cifpdf import (PeakWriter, RAWWriter,
+                                     radiationpath, rendersetup)
+    from cifpdfsearch._utils import getargswithstdin
+    if args.config:
+        config.initialize(args.config)
+    cfg = config.PDFCALCULATOR
+    radiations = args.radiation or [cfg['scatteringfactortable']]
+    output = os.path.splitext(os.path.abspath(args.output))[0] + '.yml'
+    outputs = [output] if not args.radiation else [
+        radiationpath(output, n) for n in radiations]
+    for f in outputs:
+        if not args.force and os.path.exists(f):
+            emsg = "{} already exists, use --force to overwrite".format(f)
+            raise FileExistsError(emsg)
+    ciflist = list(getargswithstdin(args.cifs))
+    render = rendersetup(cfg) if args.render else None
+    initargs = (cfg, cfg['rmax'] + args.margin, radiations, render)
+    if args.jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(args.jobs, initializer=_initworker,
+                                    initargs=initargs)
+        results = pool.imap_unordered(calculatepeaks, ciflist, chunksize=4)
+    else:
+        pool = None
+        _initworker(*initargs)
+        results = map(calculatepeaks, ciflist)
+    nfailed = 0
+    count = 0
+    with ExitStack() as stack:
+        writers = []
+        for f, n in zip(outputs, radiations):
+            rcfg = dict(cfg, scatteringfactortable=n)
+            w = (RAWWriter(f, rcfg) if args.render else
+                 PeakWriter(f, rcfg, resolution=args.resolution))
+            writers.append(stack.enter_context(w))
+        for cf, res, emsg in results:
+            if res is None:
+                print(cf, emsg)
+                nfailed += 1
+                continue
+            codid = normcodid(cf)
+            for w, x in zip(writers, res):
+                if args.render:
+                    w.writePDF(codid, w.rgrid, x)
+                else:
+                    w.writePeaks(codid, *x)
+            count += 1
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print("saved {} structures to {}, {} failed".format(
+        count, ', '.join(outputs), nfailed))
+    return
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -5,24 +5,62 @@ Calculate correlation coefficients between given PDFs and COD simulations.
 '''
 
 import os.path
+import time
 import argparse
-import numpy
 
-from cifpdfsearch.config import PDFSTORAGE
-from cifpdfsearch.cifpdf import HDFStorage
-from cifpdfsearch.cifpdf import RAWStorage
 from cifpdfsearch import normcodid
-from diffpy.pdfgetx import loaddata
-
-RAWSTORE = os.path.splitext(PDFSTORAGE)[0] + '-raw.yml'
+from cifpdfsearch.metrics import metrics
+
+# Suffixes of storage files which replace the extension of PDFSTORAGE.
+# The paths are available as module attributes, e.g., RAWSTORE.
+STORESUFFIXES = {
+    'RAWSTORE' : '-raw.yml',
+    'ZRAWSTORE' : '-zraw.yml',
+    'SHARDSTORE' : '-shards.yml',
+    'PEAKSTORE' : '-peaks.yml',
+    'DOCSTORE' : '-docs.sqlite',
+    'CELLINDEX' : '-cells.npz',
+}
 ELASTICHOST = ['provexray.csi.bnl.gov']
 
-dspdfpath = 'pdfc/cod{:0>7}'
+
+def storepath(name):
+    """Return path to the storage file next to the configured PDFSTORAGE.
+
+    Parameters
+    ----------
+    name : str
+        Storage name in STORESUFFIXES, e.g., "RAWSTORE".
+
+    Returns
+    -------
+    str
+        The storage path.
+    """
+    from cifpdfsearch.config import PDFSTORAGE
+    rv = os.path.splitext(PDFSTORAGE)[0] + STORESUFFIXES[name]
+    return rv
+
+
+def __getattr__(name):
+    "Resolve storage paths from the configuration on access."
+    if name in STORESUFFIXES:
+        return storepath(name)
+    emsg = "module {!r} has no attribute {!r}".format(__name__, name)
+    raise AttributeError(emsg)
 
 
 parser = argparse.ArgumentParser(description=__doc__.strip())
-parser.add_argument('--store', choices=['raw', 'hdf'], default='hdf',
+parser.add_argument('--store',
+                    choices=['raw', 'hdf', 'zraw', 'sharded', 'peaks'],
+                    default='hdf',
                     help="storage backend for calculated PDFs")
+parser.add_argument('--radiation', metavar='SFT',
+                    help="use storage calculated for this radiation type, "
+                    "e.g., xray or neutron, by the calcpeaks --radiation")
+parser.add_argument('--uisowidth', type=float,
+                    help="peak width for PDFs rendered from the peaks "
+                    "storage, by default use the calculator setting")
 parser.add_argument('--rmin', type=float,
                     help="lower bound for evaluating correlation coefficient")
 parser.add_argument('--rmax', type=float,
@@ -31,6 +69,35 @@ parser.add_argument('--ccmin', type=float, default=-1.0,
                     help="minimum correlation value for a COD match")
 parser.add_argument('-t', '--tolerance', type=float, default=0.0,
                     help="tolerance on normalized stoichiometry, e.g., 0.1")
+parser.add_argument('--docstore', nargs='?', const=True, metavar='FILE',
+                    help="find compositions in a local document store "
+                    "instead of Elastic Search, by default the -docs.sqlite "
+                    "file next to the PDF storage")
+parser.add_argument('--cell', type=float, nargs=6,
+                    metavar=('A', 'B', 'C', 'ALPHA', 'BETA', 'GAMMA'),
+                    help="limit search to structures with equivalent "
+                    "reduced unit cell")
+parser.add_argument('--centering', default='P',
+                    choices=['P', 'A', 'B', 'C', 'I', 'F', 'R'],
+                    help="lattice centering of the --cell parameters")
+parser.add_argument('--cell-tolerance', type=float, nargs=2,
+                    default=[0.03, 1.0], metavar=('FRAC', 'DEG'),
+                    help="relative tolerance on reduced cell lengths and "
+                    "tolerance on angles in degrees, by default 0.03 1.0")
+parser.add_argument('--cellindex', metavar='FILE',
+                    help="reduced cell index from makecellindex, by default "
+                    "the -cells.npz file next to the PDF storage")
+parser.add_argument('--density-tolerance', type=float, metavar='FRAC',
+                    help="limit search to structures with number density "
+                    "within relative FRAC of the density estimated from "
+                    "the low-r slope of searchpdf.  Uses numdensity "
+                    "values from the local document store.")
+parser.add_argument('-j', '--jobs', type=int,
+                    help="number of threads for scanning storage shards")
+parser.add_argument('--metrics', metavar='FILE',
+                    help="save counters and timings of the search to FILE "
+                    "in JSON or, for the .prom extension, in Prometheus "
+                    "text format")
 parser.add_argument('-s', '--sort', action='store_true',
                     help="sort the output by correlation coefficient in "
                     "descending order")
@@ -40,29 +107,66 @@ parser.add_argument('searchpdf', help="PDF data to be matched with COD PDFs, "
 parser.add_argument('composition', nargs='*', help='limit search to specified '
                     'normalized composition, for example "Na 0.5 Cl 0.5"')
 
-def genidpdf_all_hdf(hfile):
-    grp = hfile['pdfc']
-    for n, v in grp.items():
-        yield normcodid(n), v[()]
-    pass
+def genidpdf_all(store):
+    return store.items()
+
 
+def gencorrelations(store, fastcorrcoef, jobs=None):
+    """Generate (codid, cc) pairs for all valid PDFs in the store.
 
-def genidpdf_composition_hdf(hfile, composition, tolerance):
-    genids = codsearch_composition(composition, tolerance)
-    for codid in genids:
-        ds = hfile.get(dspdfpath.format(codid))
-        if ds is not None:
-            yield codid, ds[()]
+    The PDFs are correlated in blocks of rows, which leave out invalid
+    and all-zero rows according to the store validity flags.  Stores
+    with z-scored rows for the r-window of `fastcorrcoef` are correlated
+    by a plain matrix-vector product.  Shards of ShardedStorage are scanned
+    concurrently in `jobs` threads and their results are generated in
+    the order of shards.
+    """
+    import numpy
+
+    def scan(st):
+        ids = []
+        ccs = []
+        zblocks = None
+        if fastcorrcoef.window and hasattr(st, 'zscoreblocks'):
+            zblocks = st.zscoreblocks(*fastcorrcoef.window)
+        if zblocks is not None:
+            for codids, zblock in zblocks:
+                cc = zblock.dot(fastcorrcoef.zobs)
+                metrics.inc('rows_correlated', len(zblock))
+                mask = ~numpy.isnan(cc)
+                ids.append(codids[mask])
+                ccs.append(cc[mask])
+        else:
+            for codids, gblock in st.blocks():
+                ids.append(codids)
+                ccs.append(fastcorrcoef.many(gblock))
+        if not ids:
+            return [], []
+        return numpy.concatenate(ids), numpy.concatenate(ccs)
+    shards = getattr(store, 'shards', [store])
+    if len(shards) == 1 or jobs == 1:
+        results = map(scan, shards)
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(jobs)
+        results = executor.map(scan, shards)
+        executor.shutdown(wait=False)
+    for ids, ccs in results:
+        for item in zip(ids, ccs):
+            yield item
     pass
 
 
-def genidpdf_all_raw(store):
-    return store.items()
+def genidpdf_composition(store, composition, tolerance, docstore=None,
+                         rowfilter=None):
+    genids = codsearch_composition(composition, tolerance, docstore)
+    if rowfilter is not None:
+        genids = (codid for codid in genids if codid in rowfilter)
+    return genidpdf_codids(store, genids)
 
 
-def genidpdf_composition_raw(store, composition, tolerance):
-    genids = codsearch_composition(composition, tolerance)
-    for codid in genids:
+def genidpdf_codids(store, codids):
+    for codid in codids:
         try:
             ds = store.readPDF(codid)[1]
             yield codid, ds
@@ -71,7 +175,93 @@ def genidpdf_composition_raw(store, composition, tolerance):
     pass
 
 
-def codsearch_composition(composition, tolerance):
+def cellrowfilter(cell, centering='P', tolerance=(0.03, 1.0), cellindex=None):
+    """Return COD ids of structures with matching reduced unit cell.
+
+    Parameters
+    ----------
+    cell : sequence
+        The (a, b, c, alpha, beta, gamma) lattice parameters.
+    centering : str, optional
+        Lattice centering symbol of the cell.
+    tolerance : tuple, optional
+        Relative tolerance on reduced cell lengths and absolute
+        tolerance on reduced cell angles in degrees.
+    cellindex : str, optional
+        Path to the saved CellIndex, by default CELLINDEX.
+
+    Returns
+    -------
+    set
+        The 7-digit COD identifiers.
+    """
+    from cifpdfsearch.cellindex import CellIndex
+    cindex = CellIndex.load(cellindex or storepath('CELLINDEX'))
+    lengthtol, angletol = tolerance
+    codids = cindex.query(cell, centering, lengthtol, angletol)
+    rv = set(map(normcodid, codids))
+    return rv
+
+
+def densityrowfilter(numdensity, tolerance, docstore=None):
+    """Return COD ids of structures with similar atom number density.
+
+    Parameters
+    ----------
+    numdensity : float
+        The number density in 1/A**3, e.g., from `estimatedensity`.
+    tolerance : float
+        Relative tolerance on the number density.
+    docstore : str, optional
+        Path to local document store, by default DOCSTORE.
+
+    Returns
+    -------
+    set
+        The 7-digit COD identifiers.
+    """
+    from cifpdfsearch.docstore import DocStore
+    lo = numdensity * (1 - tolerance)
+    hi = numdensity * (1 + tolerance)
+    q = 'numdensity:[{!r} TO {!r}]'.format(lo, hi)
+    dsfile = (storepath('DOCSTORE') if docstore in (None, True)
+              else docstore)
+    with DocStore(dsfile) as dstore:
+        codids = dstore.codids(q)
+    rv = set(map(normcodid, codids))
+    return rv
+
+
+def searchdensity(robs, gobs):
+    """Return number density estimated from the low-r slope of a PDF.
+
+    Raises
+    ------
+    ValueError
+        When the PDF has no points at 0 < r <= 1 A or its slope there
+        does not give a positive density.
+    """
+    from cifpdfsearch.cifpdf import estimatedensity
+    rv = estimatedensity(robs, gobs)
+    if rv is None:
+        emsg = "cannot estimate number density, PDF has no data at r <= 1 A"
+        raise ValueError(emsg)
+    if not rv > 0:
+        emsg = ("cannot estimate number density, PDF does not decrease "
+                "at r <= 1 A")
+        raise ValueError(emsg)
+    return rv
+
+
+def codsearch_composition(composition, tolerance, docstore=None):
+    if docstore is not None:
+        from cifpdfsearch.docstore import DocStore
+        dsfile = storepath('DOCSTORE') if docstore is True else docstore
+        with DocStore(dsfile) as dstore:
+            codids = dstore.codids(composition=composition, tol=tolerance)
+        for codid in codids:
+            yield normcodid(codid)
+        return
     from diffpy.pdfgetx.functs import composition_analysis
     from elasticsearch import Elasticsearch
     from elasticsearch.helpers import scan
@@ -101,6 +291,7 @@ def codsearch_composition(composition, tolerance):
 
 
 def correlation(robs, gobs, rcod, gcod, bounds):
+    import numpy
     clo = bounds['clo']
     chi = bounds['chi']
     r1 = rcod[clo:chi]
@@ -113,6 +304,7 @@ def correlation(robs, gobs, rcod, gcod, bounds):
 class FastCorrelation:
 
     def __init__(self, robs, gobs, rcod, rmin=None, rmax=None):
+        import numpy
         eps = 1e-5
         b = calcbounds(robs, rcod, rmin, rmax)
         iobs = numpy.round(robs / 0.01).astype(int)
@@ -125,11 +317,17 @@ class FastCorrelation:
         self.gobs1 = gobs[kk]
         csel = jj + b['clo']
         if len(csel) == len(rcod):
-            csel = slice()
+            csel = slice(None)
         elif len(set(numpy.diff(csel))) == 1:
             csel = slice(csel[0], csel[-1] + 1, csel[1] - csel[0])
         assert numpy.allclose(rcod[csel], self.robs1)
         self.csel = csel
+        # index bounds of a contiguous r-window for z-scored rows
+        self.window = None
+        if isinstance(csel, slice) and csel.step in (None, 1):
+            self.window = csel.indices(len(rcod))[:2]
+        d = self.gobs1 - self.gobs1.mean()
+        self.zobs = d / numpy.sqrt(d.dot(d))
         dtp = self.gobs1.dtype.type
         self.rn = rn = dtp(1.0 / len(self.gobs1))
         self.s1gobs = self.gobs1.sum()
@@ -139,6 +337,8 @@ class FastCorrelation:
 
 
     def __call__(self, gcod):
+        import numpy
+        metrics.inc('rows_correlated')
         gcod1 = gcod[self.csel]
         s1gcod = gcod1.sum()
         s2gcod = gcod1.dot(gcod1)
@@ -148,6 +348,23 @@ class FastCorrelation:
         return rv
 
 
+    def many(self, gblock):
+        """Return correlation coefficients for a 2D array of PDF rows.
+
+        Rows that are all zero produce NaN.
+        """
+        import numpy
+        metrics.inc('rows_correlated', len(gblock))
+        gcod1 = gblock[:, self.csel]
+        s1gcod = gcod1.sum(axis=1)
+        s2gcod = numpy.einsum('ij,ij->i', gcod1, gcod1)
+        nom = gcod1.dot(self.gobs1) - s1gcod * self.s1gobs * self.rn
+        den_gcod = s2gcod - s1gcod * s1gcod * self.rn
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            rv = nom / numpy.sqrt(self.den_gobs * den_gcod)
+        return rv
+
+
 def calcbounds(robs, rcod, rmin=None, rmax=None):
     """
     Calculate bounds and overlap indices for given rmin, rmax
@@ -172,7 +389,7 @@ def calcbounds(robs, rcod, rmin=None, rmax=None):
 # temporary UI functions -----------------------------------------------------
 
 def cifsearch(q=None, composition=None, tol=None, fields=None,
-              **kwargs):
+              docstore=None, **kwargs):
     """
     Execute search for CIF structures using Lucene query string syntax.
 
@@ -188,6 +405,9 @@ def cifsearch(q=None, composition=None, tol=None, fields=None,
         Maximum allowed difference from stoichiometry.
     fields : list or str, optional
         Name of CIF fields to be returned.
+    docstore : str, optional
+        Path to local document store to be searched instead of
+        Elastic Search.  Use `DOCSTORE` when True.
     kwargs : misc, optional
         Extra arguments passed to the `Elasticsearch.search` function.
 
@@ -195,7 +415,19 @@ def cifsearch(q=None, composition=None, tol=None, fields=None,
     -------
     databroker.Results
         Iterable object encapsulating the matching databroker Headers.
+        List of documents when searching in the local document store.
     """
+    if docstore:
+        from cifpdfsearch.docstore import DocStore
+        if kwargs:
+            emsg = "Unsupported arguments for docstore: {}".format(
+                ', '.join(sorted(kwargs)))
+            raise TypeError(emsg)
+        dsfile = storepath('DOCSTORE') if docstore is True else docstore
+        with DocStore(dsfile) as dstore:
+            rv = dstore.search(q, composition=composition, tol=tol,
+                               fields=fields)
+        return rv
     from diffpy.pdfgetx.functs import composition_analysis
     from elasticsearch import Elasticsearch
     es = Elasticsearch(ELASTICHOST)
@@ -249,13 +481,14 @@ def cifsimpdf(codid, what='rg'):
     tuple
     """
     from collections.abc import Iterable
-    store = RAWStorage(RAWSTORE)
+    from cifpdfsearch.cifpdf import RAWStorage
+    store = RAWStorage(storepath('RAWSTORE'))
     cids = codid
     if isinstance(codid, str) or not isinstance(codid, Iterable):
         cids = [codid]
     if what == 'r':
         return store.rgrid
-    gall = [0 + store.readPDF(c)[1] for c in cids]
+    gall = list(store.readPDFs(cids))
     if what == 'g':
         rv = tuple(gall)
     else:
@@ -266,13 +499,16 @@ def cifsimpdf(codid, what='rg'):
 
 
 def cifpdfsearch(filename, composition=None, tol=0, rmin=None, rmax=None,
-                 ccmin=-1, sort=False):
-    from functools import partial
-    store = RAWStorage(RAWSTORE)
+                 ccmin=-1, sort=False, jobs=None, radiation=None,
+                 docstore=None, cell=None, centering='P',
+                 celltolerance=(0.03, 1.0), densitytolerance=None,
+                 cellindex=None):
+    from cifpdfsearch.cifpdf import RAWStorage, radiationpath
+    from diffpy.pdfgetx import loaddata
+    t0 = time.perf_counter()
+    store = RAWStorage(radiationpath(storepath('RAWSTORE'), radiation))
     rcod = store.rgrid
     readpdf = store.readPDF
-    genidpdf_all = partial(genidpdf_all_raw, store)
-    genidpdf_composition = partial(genidpdf_composition_raw, store)
     # load observed PDF data to be matched with COD PDFs
     if filename.startswith('cod:'):
         robs, gobs = readpdf(filename[4:])
@@ -281,39 +517,62 @@ def cifpdfsearch(filename, composition=None, tol=0, rmin=None, rmax=None,
                               dtype=rcod.dtype, unpack=True)
     fastcorrcoef = FastCorrelation(robs, gobs, rcod, rmin=rmin, rmax=rmax)
     # generate correlation coefficients
+    rowfilter = None
+    if cell is not None:
+        rowfilter = cellrowfilter(cell, centering, celltolerance, cellindex)
+    if densitytolerance is not None:
+        numdensity = searchdensity(robs, gobs)
+        drows = densityrowfilter(numdensity, densitytolerance, docstore)
+        rowfilter = drows if rowfilter is None else rowfilter & drows
     has_composition = composition and composition != '*'
-    gpdfs = (genidpdf_composition(composition, tol)
-             if has_composition else genidpdf_all())
-    gcorr = ((codid, fastcorrcoef(gcod))
-             for codid, gcod in gpdfs if gcod.any())
+    if has_composition or rowfilter is not None:
+        gpdfs = (genidpdf_composition(store, composition, tol, docstore,
+                                      rowfilter) if has_composition
+                 else genidpdf_codids(store, sorted(rowfilter)))
+        gcorr = ((codid, fastcorrcoef(gcod))
+                 for codid, gcod in gpdfs if gcod.any())
+    else:
+        gcorr = gencorrelations(store, fastcorrcoef, jobs=jobs)
     gcorr1 = (gcorr if ccmin <= -1 else
               (xx for xx in gcorr if xx[1] >= ccmin))
     gout = gcorr1
     if sort:
         gout = sorted(gout, key=lambda x: x[1], reverse=True)
     rv = list(gout)
+    metrics.observe('query_seconds', time.perf_counter() - t0)
     return rv
 
 # ----------------------------------------------------------------------------
 
 def main():
-    from functools import partial
     pargs = parser.parse_args()
+    from cifpdfsearch.config import PDFSTORAGE
+    from cifpdfsearch.cifpdf import HDFStorage
+    from cifpdfsearch.cifpdf import RAWStorage
+    from cifpdfsearch.cifpdf import CompressedStorage
+    from cifpdfsearch.cifpdf import ShardedStorage
+    from cifpdfsearch.cifpdf import PeakStorage
+    from cifpdfsearch.cifpdf import radiationpath
+    from diffpy.pdfgetx import loaddata
+    if pargs.metrics:
+        metrics.enable()
+    t0 = time.perf_counter()
     composition = ' '.join(pargs.composition)
     # resolve storage backend
+    rpath = lambda f: radiationpath(f, pargs.radiation)
     if pargs.store == 'hdf':
-        hdb = HDFStorage(PDFSTORAGE)
-        rcod = hdb.rgrid
-        readpdf = hdb.readPDF
-        hfile = hdb._openhdf('r')
-        genidpdf_all = partial(genidpdf_all_hdf, hfile)
-        genidpdf_composition = partial(genidpdf_composition_hdf, hfile)
+        store = HDFStorage(rpath(PDFSTORAGE))
     elif pargs.store == 'raw':
-        store = RAWStorage(RAWSTORE)
-        rcod = store.rgrid
-        readpdf = store.readPDF
-        genidpdf_all = partial(genidpdf_all_raw, store)
-        genidpdf_composition = partial(genidpdf_composition_raw, store)
+        store = RAWStorage(rpath(storepath('RAWSTORE')))
+    elif pargs.store == 'zraw':
+        store = CompressedStorage(rpath(storepath('ZRAWSTORE')))
+    elif pargs.store == 'sharded':
+        store = ShardedStorage(rpath(storepath('SHARDSTORE')))
+    elif pargs.store == 'peaks':
+        store = PeakStorage(rpath(storepath('PEAKSTORE')))
+        store.setRendering(uisowidth=pargs.uisowidth)
+    rcod = store.rgrid
+    readpdf = store.readPDF
     # load observed PDF data to be matched with COD PDFs
     if pargs.searchpdf.startswith('cod:'):
         robs, gobs = readpdf(pargs.searchpdf[4:])
@@ -324,22 +583,48 @@ def main():
     bounds = calcbounds(robs, rcod, rmin=pargs.rmin, rmax=pargs.rmax)
     fastcorrcoef = FastCorrelation(robs, gobs, rcod,
                                    rmin=pargs.rmin, rmax=pargs.rmax)
+    numdensity = None
+    if pargs.density_tolerance is not None:
+        try:
+            numdensity = searchdensity(robs, gobs)
+        except ValueError as e:
+            parser.error(str(e))
     # print out the header
     print("#T cifpdfsearch.apps.cifpdfsearch")
     print("#C searchpdf =", os.path.basename(pargs.searchpdf))
     print("#C composition =", composition or '*')
     print("#C tolerance =", pargs.tolerance)
+    if pargs.cell:
+        print("#C cell =", ' '.join(map('{:g}'.format, pargs.cell)),
+              pargs.centering)
+        print("#C celltolerance =", *pargs.cell_tolerance)
+    if numdensity is not None:
+        print("#C numdensity =", numdensity)
+        print("#C densitytolerance =", pargs.density_tolerance)
     print("#C ccmin =", pargs.ccmin)
     print("#C rmin =", bounds['rmin'])
     print("#C rmax =", bounds['rmax'])
     print("#S 1")
     print("#L codid  correlation")
     # generate correlation coefficients
+    rowfilter = None
+    if pargs.cell:
+        rowfilter = cellrowfilter(pargs.cell, pargs.centering,
+                                  pargs.cell_tolerance, pargs.cellindex)
+    if numdensity is not None:
+        drows = densityrowfilter(numdensity, pargs.density_tolerance,
+                                 pargs.docstore)
+        rowfilter = drows if rowfilter is None else rowfilter & drows
     has_composition = composition and composition != '*'
-    gpdfs = (genidpdf_composition(composition, pargs.tolerance)
-             if has_composition else genidpdf_all())
-    gcorr = ((codid, fastcorrcoef(gcod))
-             for codid, gcod in gpdfs if gcod.any())
+    if has_composition or rowfilter is not None:
+        gpdfs = (genidpdf_composition(store, composition, pargs.tolerance,
+                                      pargs.docstore, rowfilter)
+                 if has_composition
+                 else genidpdf_codids(store, sorted(rowfilter)))
+        gcorr = ((codid, fastcorrcoef(gcod))
+                 for codid, gcod in gpdfs if gcod.any())
+    else:
+        gcorr = gencorrelations(store, fastcorrcoef, jobs=pargs.jobs)
     gcorr1 = (gcorr if pargs.ccmin <= -1 else
               (xx for xx in gcorr if xx[1] >= pargs.ccmin))
     gout = gcorr1
@@ -348,6 +633,9 @@ def main():
     fmt = '{:g}'.format
     for codid, cc in gout:
         print(codid, fmt(cc))
+    metrics.observe('query_seconds', time.perf_counter() - t0)
+    if pargs.metrics:
+        metrics.save(pargs.metrics)
     return
 
 
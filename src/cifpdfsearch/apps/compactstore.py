@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+'''Rewrite raw PDF storage without the deleted and superseded rows.
+
+The rows are saved in the order of COD identifiers.  This is an offline
+operation, the storage must not be open for writing.
+'''
+
+import os
+import argparse
+
+parser = argparse.ArgumentParser(description=__doc__.strip())
+parser.add_argument('storage',
+                    help="Path to the raw storage YAML file")
+
+
+def main(args):
+    import numpy
+    from cifpdfsearch.cifpdf import RAWStorage, RAWWriter
+    store = RAWStorage(args.storage)
+    b = os.path.splitext(store.filename)[0]
+    tb = b + '-compact'
+    rows = numpy.flatnonzero(store.live)
+    rows = rows[numpy.argsort(store.codids[rows], kind='stable')]
+    rgrid = store.rgrid
+    with RAWWriter(tb + '.yml', store.pdfcalculator,
+                   dtype=store.dtype) as writer:
+        for i in rows:
+            writer.writePDF(store.codids[i], rgrid, store.gdata[i])
+    ndead = len(store.codids) - len(rows)
+    del store
+    # swap in the compacted files
+    os.replace(tb + '.idx', b + '.idx')
+    os.replace(tb + '.bin', b + '.bin')
+    os.replace(tb + '.chk', b + '.chk')
+    for f in (b + '.del', b + '.sidx'):
+        if os.path.isfile(f):
+            os.remove(f)
+    os.replace(tb + '.yml', b + '.yml')
+    print("compacted {} PDFs, removed {} dead rows".format(
+        len(rows), ndead))
+    return
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+'''Convert raw or HDF PDF storage to compressed PDF storage.
+'''
+
+import os.path
+import argparse
+
+parser = argparse.ArgumentParser(description=__doc__.strip())
+parser.add_argument('-c', '--config', metavar='FILE',
+                    help="Load the specified configuration file")
+parser.add_argument('-b', '--blocksize', type=int, default=256,
+                    help="Number of PDF rows per compressed block.")
+parser.add_argument('--codec', choices=['zlib', 'lzma', 'zstd'],
+                    help="Compression codec, by default zstd when "
+                    "supported by Python or zlib otherwise.")
+parser.add_argument('-f', '--force', action='store_true',
+                    help="Overwrite existing output storage.")
+parser.add_argument('input',
+                    help="Raw storage YAML file or HDF5 storage file")
+parser.add_argument('output',
+                    help="Path to the compressed storage YAML file")
+
+
+def main(args):
+    from cifpdfsearch import config
+    from cifpdfsearch.cifpdf import (RAWStorage, HDFStorage,
+                                     CompressedWriter)
+    if args.config:
+        config.initialize(args.config)
+    output = os.path.splitext(os.path.abspath(args.output))[0] + '.yml'
+    if not args.force and os.path.exists(output):
+        emsg = "{} already exists, use --force to overwrite".format(output)
+        raise FileExistsError(emsg)
+    ext = os.path.splitext(args.input)[1]
+    if ext in ('.h5', '.hdf', '.hdf5'):
+        store = HDFStorage(args.input)
+        pcfg = config.PDFCALCULATOR
+    else:
+        store = RAWStorage(args.input)
+        pcfg = store.pdfcalculator
+    r = store.rgrid
+    writer = CompressedWriter(output, pcfg, blocksize=args.blocksize,
+                              codec=args.codec)
+    with writer:
+        for codid, g in store.items():
+            writer.writePDF(codid, r, g)
+    b = os.path.splitext(output)[0]
+    zsize = os.path.getsize(b + '.zbin')
+    rawsize = writer.nrows * len(r) * r.itemsize
+    print("compressed {} PDFs with {}, ratio {:.2f}".format(
+        writer.nrows, writer.codec, rawsize / max(1, zsize)))
+    return
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -7,7 +7,6 @@ from __future__ import print_function
 
 import os.path
 import argparse
-import numpy
 
 
 parser = argparse.ArgumentParser(description=__doc__.strip())
@@ -15,12 +14,15 @@ parser.add_argument('-c', '--config', metavar='FILE',
                     help="Load the specified configuration file")
 parser.add_argument('-o', '--output',
                     help="Output path to use instead of configuration value")
+parser.add_argument('--flush', type=int, default=1000, metavar='N',
+                    help="Write buffered PDFs to the file after N entries.")
 parser.add_argument('args', nargs='+', metavar='file',
                     help="npy files to be copied to the HDF 5 output.  "
                          "Replace '-' with files from standard input.")
 
 
 def main(args):
+    import numpy
     from cifpdfsearch.cifpdf import HDFStorage
     from cifpdfsearch import config, normcodid
     from cifpdfsearch._utils import getargswithstdin
@@ -34,15 +36,16 @@ def main(args):
     r = hdb.rgrid
     progress_step = len(npyfiles) / (80.0 + 1)
     progress_next = 0
-    for i, f in enumerate(npyfiles):
-        if os.path.getsize(f) == 0:
-            continue
-        g = numpy.load(f)
-        codid = normcodid(os.path.basename(f))
-        hdb.writePDF(codid,r, g)
-        if i >= progress_next:
-            print('.', end='', flush=True)
-            progress_next += progress_step
+    with hdb.writer(flushsize=args.flush) as hw:
+        for i, f in enumerate(npyfiles):
+            if os.path.getsize(f) == 0:
+                continue
+            g = numpy.load(f)
+            codid = normcodid(os.path.basename(f))
+            hw.writePDF(codid, r, g)
+            if i >= progress_next:
+                print('.', end='', flush=True)
+                progress_next += progress_step
     print()
     return
 
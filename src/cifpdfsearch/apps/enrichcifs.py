@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+'''Add derived fields from CIF files to documents in the ES index.
+
+Parse every CIF file once in parallel worker processes, extract all
+requested fields and stream partial document updates to the index in
+parallel bulk requests.  Documents missing in the index are reported
+from the bulk responses and skipped.  Process all CIFs in the local COD
+mirror when no CIF files are specified.
+'''
+
+import sys
+import time
+import argparse
+
+parser = argparse.ArgumentParser(description=__doc__.strip())
+parser.add_argument('-c', '--config', metavar='FILE',
+                    help="Load the specified configuration file")
+parser.add_argument('--index', default='codall',
+                    help="Elastic Search index to be updated")
+parser.add_argument('-f', '--fields', default='doi,numdensity',
+                    help="Comma separated fields to be added.  "
+                    "The default is 'doi,numdensity'.")
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help="Number of parallel worker processes.")
+parser.add_argument('--chunk', type=int, default=500,
+                    help="Number of updates per bulk request.  "
+                    "The default is 500.")
+parser.add_argument('--threads', type=int, default=4,
+                    help="Number of threads sending bulk requests.")
+parser.add_argument('cifs', nargs='*',
+                    help="CIF files to be processed.  "
+                         "Replace '-' with files from standard input.")
+
+
+def cifdoi(block):
+    "Return DOI of the paper for a gemmi CIF block or None."
+    import gemmi.cif
+    raw = block.find_value('_journal_paper_doi')
+    if raw is None or raw in ('?', '.'):
+        return None
+    return gemmi.cif.as_string(raw)
+
+
+def blocknumdensity(block):
+    "Return number density of atoms in 1/A**3 for a gemmi CIF block."
+    from cifpdfsearch.cifdocument import cifblockrecord, cifnumdensity
+    rv = cifnumdensity(cifblockrecord(block))
+    return rv
+
+
+# Functions of gemmi CIF block that return the derived field values.
+ENRICHFIELDS = {
+    'doi' : cifdoi,
+    'numdensity' : blocknumdensity,
+}
+
+
+def enrichcif(ciffile, fields):
+    """Extract derived fields from a CIF file in a worker process.
+
+    Parameters
+    ----------
+    ciffile : str
+        Path to the CIF file.
+    fields : tuple
+        Names of the fields in `ENRICHFIELDS`.
+
+    Returns
+    -------
+    tuple
+        The (ciffile, codid, doc, emsg) tuple, where `doc` is a
+        dictionary of the available field values.  `codid` and `doc`
+        are `None` and `emsg` has the error message when the CIF file
+        failed.
+    """
+    import gemmi.cif
+    try:
+        block = gemmi.cif.read(ciffile).sole_block()
+        codid = gemmi.cif.as_string(block.find_value('_cod_database_code'))
+        doc = {}
+        for name in fields:
+            value = ENRICHFIELDS[name](block)
+            if value is not None:
+                doc[name] = value
+    except Exception as e:
+        emsg = '{}: {}'.format(type(e).__name__, e)
+        return ciffile, None, None, emsg
+    return ciffile, codid, doc, None
+
+
+def genupdates(ciffiles, fields, jobs=1, chunksize=32):
+    """Generate derived fields for CIF files using a process pool.
+
+    Parameters
+    ----------
+    ciffiles : iterable
+        Paths to the CIF files.
+    fields : tuple
+        Names of the fields in `ENRICHFIELDS`.
+    jobs : int, optional
+        Number of worker processes.
+    chunksize : int, optional
+        Number of CIF files sent to a worker at once.
+
+    Yields
+    ------
+    tuple
+        Results of `enrichcif` in the order of completion.
+    """
+    import functools
+    fenrich = functools.partial(enrichcif, fields=tuple(fields))
+    if jobs <= 1:
+        for cf in ciffiles:
+            yield fenrich(cf)
+        return
+    import multiprocessing
+    with multiprocessing.Pool(jobs) as pool:
+        for rv in pool.imap_unordered(fenrich, ciffiles, chunksize):
+            yield rv
+    return
+
+
+def updateaction(index, codid, doc):
+    "Return bulk action for a partial update of an existing document."
+    action = {
+        '_op_type' : 'update',
+        '_index' : index,
+        '_id' : str(codid),
+        '_type' : 'cif',
+        'doc' : doc,
+    }
+    return action
+
+
+def main(args):
+    from cifpdfsearch import config, gencifpaths
+    from cifpdfsearch._utils import getargswithstdin
+    from elasticsearch import Elasticsearch
+    from elasticsearch import helpers as eshelpers
+    if args.config:
+        config.initialize(args.config)
+    fields = args.fields.replace(',', ' ').split()
+    unknown = set(fields).difference(ENRICHFIELDS)
+    if unknown:
+        emsg = "unsupported fields {}".format(', '.join(sorted(unknown)))
+        parser.error(emsg)
+    ciffiles = (getargswithstdin(args.cifs) if args.cifs
+                else gencifpaths())
+    counts = dict(updated=0, missing=0, failed=0, empty=0)
+
+    def genactions():
+        for cf, codid, doc, emsg in genupdates(ciffiles, fields, args.jobs):
+            if emsg is not None:
+                counts['failed'] += 1
+                print("{}: {}".format(cf, emsg), file=sys.stderr)
+                continue
+            if not doc:
+                counts['empty'] += 1
+                continue
+            yield updateaction(args.index, codid, doc)
+        pass
+
+    es = Elasticsearch()
+    t0 = time.time()
+    results = eshelpers.parallel_bulk(
+        es, genactions(), thread_count=args.threads,
+        chunk_size=args.chunk, raise_on_error=False)
+    for ok, info in results:
+        if ok:
+            counts['updated'] += 1
+            continue
+        status = info.get('update', {}).get('status')
+        if status == 404:
+            counts['missing'] += 1
+            continue
+        counts['failed'] += 1
+        print("update failed:", info, file=sys.stderr)
+    dt = time.time() - t0
+    print("updated {updated} documents, {missing} missing in index, "
+          "{empty} without fields, {failed} failed".format(**counts),
+          "in {:.4g} s".format(dt), file=sys.stderr)
+    return
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
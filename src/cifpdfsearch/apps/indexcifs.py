@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+'''Create search documents for CIF files and save them in bulk.
+
+Parse CIF files directly with gemmi in parallel worker processes and
+convert them to the same documents as cifdocument creates from cif2json
+output.  The documents are streamed to a JSON lines file, a local
+document store or an Elastic Search index.  Process all CIFs in the
+local COD mirror when no CIF files are specified.
+'''
+
+import sys
+import time
+import json
+import argparse
+
+parser = argparse.ArgumentParser(description=__doc__.strip())
+parser.add_argument('-c', '--config', metavar='FILE',
+                    help="Load the specified configuration file")
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help="Number of parallel worker processes.")
+parser.add_argument('-o', '--output', metavar='FILE',
+                    help="Write documents to a JSON lines file.  "
+                    "Use '-' for standard output.")
+parser.add_argument('--docstore', metavar='FILE',
+                    help="Add documents to a local SQLite document store.")
+parser.add_argument('--index',
+                    help="Elastic Search index to be filled with documents.")
+parser.add_argument('--chunk', type=int, default=500,
+                    help="Number of documents per bulk request or "
+                    "document store transaction.  The default is 500.")
+parser.add_argument('--formulas', metavar='FILE',
+                    help="JSON table of formula compositions shared by "
+                    "the worker processes.  The table is loaded if it "
+                    "exists and updated with new formulas at the end.")
+parser.add_argument('cifs', nargs='*',
+                    help="CIF files to be indexed.  "
+                         "Replace '-' with files from standard input.")
+
+
+def indexcif(ciffile):
+    """Create document for a CIF file in a worker process.
+
+    Returns
+    -------
+    tuple
+        The (ciffile, codid, doc, emsg, cachecounts) tuple, where `codid`
+        and `doc` are `None` and `emsg` has the error message when the
+        CIF file failed.  `cachecounts` is a pair of formula cache hits
+        and misses in this call, which are summed by the parent process.
+    """
+    from cifpdfsearch.cifdocument import ciffiledocument, formulacache
+    hits0, misses0 = formulacache.hits, formulacache.misses
+    codid = doc = emsg = None
+    try:
+        codid, doc = ciffiledocument(ciffile)
+    except Exception as e:
+        emsg = '{}: {}'.format(type(e).__name__, e)
+    cachecounts = (formulacache.hits - hits0, formulacache.misses - misses0)
+    return ciffile, codid, doc, emsg, cachecounts
+
+
+def loadformulas(filename):
+    "Load formula table to the composition cache of cifdocument."
+    from cifpdfsearch.cifdocument import formulacache
+    formulacache.loadTable(filename)
+    return
+
+
+def gendocuments(ciffiles, jobs=1, chunksize=32, formulas=None):
+    """Generate documents for CIF files using a process pool.
+
+    Parameters
+    ----------
+    ciffiles : iterable
+        Paths to the CIF files.
+    jobs : int, optional
+        Number of worker processes.
+    chunksize : int, optional
+        Number of CIF files sent to a worker at once.
+    formulas : str, optional
+        Path to the formula table that is loaded in every worker.
+
+    Yields
+    ------
+    tuple
+        Results of `indexcif` in the order of completion.
+    """
+    initializer = None if formulas is None else loadformulas
+    if jobs <= 1:
+        if initializer is not None:
+            initializer(formulas)
+        for cf in ciffiles:
+            yield indexcif(cf)
+        return
+    import multiprocessing
+    with multiprocessing.Pool(jobs, initializer, (formulas,)) as pool:
+        for rv in pool.imap_unordered(indexcif, ciffiles, chunksize):
+            yield rv
+    return
+
+
+def jsonlinessink(filename):
+    """Return function that writes (codid, doc) pairs to a JSON lines file.
+    """
+    import contextlib
+
+    def writedocs(pairs):
+        with contextlib.ExitStack() as stack:
+            fp = (sys.stdout if filename == '-' else
+                  stack.enter_context(open(filename, 'w')))
+            for codid, doc in pairs:
+                fp.write(json.dumps(doc, sort_keys=True))
+                fp.write('\n')
+        return
+    return writedocs
+
+
+def docstoresink(filename, chunk):
+    """Return function that adds (codid, doc) pairs to a local DocStore.
+    """
+    from cifpdfsearch.docstore import DocStore
+
+    def writedocs(pairs):
+        with DocStore(filename) as store:
+            store.addDocuments(pairs, chunk=chunk)
+        return
+    return writedocs
+
+
+def elasticsink(index, chunk):
+    """Return function that adds (codid, doc) pairs to an ES index in bulk.
+    """
+    from elasticsearch import Elasticsearch
+    from elasticsearch import helpers as eshelpers
+    es = Elasticsearch()
+
+    def writedocs(pairs):
+        actions = (dict(_index=index, _id=codid, _type='cif', _source=doc)
+                   for codid, doc in pairs)
+        for ok, info in eshelpers.streaming_bulk(
+                es, actions, chunk_size=chunk, raise_on_error=False):
+            if not ok:
+                print("index failed:", info, file=sys.stderr)
+        return
+    return writedocs
+
+
+def main(args):
+    import os.path
+    from cifpdfsearch import config, gencifpaths
+    from cifpdfsearch.cifdocument import formulacache
+    from cifpdfsearch._utils import getargswithstdin
+    if args.config:
+        config.initialize(args.config)
+    sinks = [args.output, args.docstore, args.index]
+    if len(sinks) - sinks.count(None) != 1:
+        emsg = "specify exactly one of --output, --docstore or --index"
+        parser.error(emsg)
+    ciffiles = (getargswithstdin(args.cifs) if args.cifs
+                else gencifpaths())
+    if args.output:
+        writedocs = jsonlinessink(args.output)
+    elif args.docstore:
+        writedocs = docstoresink(args.docstore, args.chunk)
+    else:
+        writedocs = elasticsink(args.index, args.chunk)
+    formulas = args.formulas
+    if formulas and not os.path.isfile(formulas):
+        formulas = None
+    counts = dict(indexed=0, failed=0)
+    cachecounts = dict(hits=0, misses=0)
+
+    def genpairs():
+        for cf, codid, doc, emsg, (hits, misses) in gendocuments(
+                ciffiles, args.jobs, formulas=formulas):
+            cachecounts['hits'] += hits
+            cachecounts['misses'] += misses
+            if emsg is not None:
+                counts['failed'] += 1
+                print("{}: {}".format(cf, emsg), file=sys.stderr)
+                continue
+            counts['indexed'] += 1
+            if args.formulas and 'formula' in doc:
+                formulacache.table.setdefault(
+                    doc['formula'], doc.get('composition'))
+            yield codid, doc
+        pass
+
+    t0 = time.time()
+    writedocs(genpairs())
+    dt = time.time() - t0
+    print("indexed {indexed} documents, {failed} failed".format(**counts),
+          "in {:.4g} s".format(dt), file=sys.stderr)
+    print("formula cache: {hits} hits, {misses} misses".format(
+        **cachecounts), file=sys.stderr)
+    if args.formulas:
+        formulacache.saveTable(args.formulas)
+    return
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
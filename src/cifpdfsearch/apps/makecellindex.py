@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+'''Build index of reduced unit cells for the cifpdfsearch --cell filter.
+
+Read lattice parameters and space groups from a local document store
+or JSON lines documents from indexcifs, reduce the cells to Niggli
+cells and save the grid index to a npz file.
+'''
+
+import sys
+import argparse
+
+parser = argparse.ArgumentParser(description=__doc__.strip())
+parser.add_argument('--binwidth', type=float, default=0.02,
+                    help="Grid bin width in logarithm of cell lengths.  "
+                    "The default is 0.02.")
+parser.add_argument('input',
+                    help="SQLite document store or JSON lines file "
+                    "with CIF documents.")
+parser.add_argument('output', help="Output npz file for the index.")
+
+
+def main(args):
+    from cifpdfsearch import genjson
+    from cifpdfsearch.cellindex import CellIndex
+    with open(args.input, 'rb') as fp:
+        issqlite = fp.read(16) == b'SQLite format 3\0'
+    if issqlite:
+        cindex = CellIndex.fromDocStore(args.input, binwidth=args.binwidth)
+    else:
+        docs = genjson(filename=args.input)
+        pairs = ((doc.get('codid'), doc) for doc in docs)
+        cindex = CellIndex.fromDocuments(pairs, binwidth=args.binwidth)
+    cindex.save(args.output)
+    print("indexed {} unit cells".format(len(cindex)), file=sys.stderr)
+    return
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+'''Merge raw PDF storage shards into one raw storage sorted by COD id.
+'''
+
+import os.path
+import argparse
+
+parser = argparse.ArgumentParser(description=__doc__.strip())
+parser.add_argument('-o', '--output', required=True,
+                    help="Path to the merged raw storage YAML file")
+parser.add_argument('-f', '--force', action='store_true',
+                    help="Overwrite existing output storage.")
+parser.add_argument('shards', nargs='+',
+                    help="YAML files of the raw storage shards.  "
+                         "Replace '-' with files from standard input.")
+
+
+def main(args):
+    import numpy
+    from cifpdfsearch.cifpdf import RAWStorage, RAWWriter
+    from cifpdfsearch._utils import getargswithstdin
+    output = os.path.splitext(os.path.abspath(args.output))[0] + '.yml'
+    if not args.force and os.path.exists(output):
+        emsg = "{} already exists, use --force to overwrite".format(output)
+        raise FileExistsError(emsg)
+    stores = [RAWStorage(f) for f in getargswithstdin(args.shards)]
+    if output in (st.filename for st in stores):
+        raise ValueError("output cannot be one of the shards")
+    rgrid = stores[0].rgrid
+    for st in stores:
+        r = st.rgrid
+        if r.shape != rgrid.shape or not numpy.allclose(r, rgrid):
+            emsg = "{} has incompatible r-grid".format(st.filename)
+            raise ValueError(emsg)
+    # first occurrence wins for COD ids computed in several shards
+    liverows = [numpy.flatnonzero(st.live) for st in stores]
+    codids = numpy.concatenate(
+        [st.codids[lr] for st, lr in zip(stores, liverows)])
+    shardidx = numpy.concatenate(
+        [numpy.full(len(lr), i) for i, lr in enumerate(liverows)])
+    rows = numpy.concatenate(liverows)
+    ucodids, first = numpy.unique(codids, return_index=True)
+    with RAWWriter(output, stores[0].pdfcalculator) as writer:
+        for codid, k in zip(ucodids, first):
+            st = stores[shardidx[k]]
+            writer.writePDF(codid, rgrid, st.gdata[rows[k]])
+    print("merged {} PDFs from {} shards into {}".format(
+        len(ucodids), len(stores), output))
+    return
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
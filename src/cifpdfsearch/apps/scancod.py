@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+'''Report CIF files changed in the COD mirror since the last scan.
+
+Compare the COD cif directory with a snapshot from the previous run and
+print added, modified and deleted CIF files.  Only directories with a
+new modification time are listed, so that the scan of an updated mirror
+takes a fraction of the full directory walk.  The snapshot is updated
+after a successful scan.
+'''
+
+import os.path
+import sys
+import argparse
+
+parser = argparse.ArgumentParser(description=__doc__.strip())
+parser.add_argument('-c', '--config', metavar='FILE',
+                    help="Load the specified configuration file")
+parser.add_argument('--snapshot', metavar='FILE',
+                    help="Snapshot of the COD directories.  Use "
+                    "codscan.json next to the PDF storage by default.")
+parser.add_argument('--full', action='store_true',
+                    help="List all directories to detect also files "
+                    "rewritten in place.")
+parser.add_argument('-n', '--dry-run', action='store_true',
+                    help="Do not update the snapshot.")
+parser.add_argument('-p', '--paths', action='store_true',
+                    help="Print only paths of added and modified CIFs, "
+                    "e.g., for the standard input of calcpdfs or indexcifs.")
+
+STATUSCODES = {'added' : 'A', 'modified' : 'M', 'deleted' : 'D'}
+
+
+def main(args):
+    from cifpdfsearch import config
+    from cifpdfsearch.codscan import CODScanner
+    if args.config:
+        config.initialize(args.config)
+    snapshot = args.snapshot
+    if snapshot is None:
+        snapshot = os.path.join(os.path.dirname(config.PDFSTORAGE),
+                                'codscan.json')
+    scanner = CODScanner(os.path.join(config.CODDIR, 'cif'), snapshot)
+    counts = dict.fromkeys(STATUSCODES, 0)
+    for status, path in scanner.scan(full=args.full):
+        counts[status] += 1
+        if not args.paths:
+            print(STATUSCODES[status], path)
+        elif status != 'deleted':
+            print(path)
+    if not args.dry_run:
+        scanner.save()
+    print("{added} added, {modified} modified, {deleted} deleted".format(
+        **counts), "in {listed} of {n} directories".format(
+            n=len(scanner.snapshot), **scanner.counts), file=sys.stderr)
+    return
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
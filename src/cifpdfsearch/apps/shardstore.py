@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+'''Split PDF storage into raw shards by COD id and write their manifest.
+
+The manifest is a YAML file for ShardedStorage that lists the shard files
+with their COD id ranges.  With the --manifest-only option write manifest
+for existing shard files, for example, after rebuilding one of them.
+'''
+
+import os.path
+import argparse
+
+parser = argparse.ArgumentParser(description=__doc__.strip())
+parser.add_argument('-c', '--config', metavar='FILE',
+                    help="Load the specified configuration file.  "
+                    "Its PDFCALCULATOR is used for HDF input without "
+                    "saved calculator settings.")
+parser.add_argument('-o', '--output', required=True,
+                    help="Path to the manifest YAML file.  Shards are "
+                    "written next to it as OUTPUT-NNN-raw.yml.")
+parser.add_argument('-n', '--nshards', type=int, default=4,
+                    help="Number of shards to split the input into.")
+parser.add_argument('--blocksize', type=int, default=4096,
+                    help="Number of PDF rows read at once.  "
+                    "The default is 4096.")
+parser.add_argument('-f', '--force', action='store_true',
+                    help="Overwrite existing output files.")
+parser.add_argument('--manifest-only', action='store_true',
+                    help="Write manifest for the existing shard files "
+                    "given as input.")
+parser.add_argument('input', nargs='+',
+                    help="Raw, compressed or HDF storage to be split, "
+                    "or the shard files with --manifest-only.")
+
+
+def main(args):
+    import numpy
+    from cifpdfsearch import config
+    from cifpdfsearch.cifpdf import (HDFStorage, RAWStorage, RAWWriter,
+                                     openstorage, writemanifest)
+    if args.config:
+        config.initialize(args.config)
+    output = os.path.splitext(os.path.abspath(args.output))[0] + '.yml'
+    if not args.force and os.path.exists(output):
+        emsg = "{} already exists, use --force to overwrite".format(output)
+        raise FileExistsError(emsg)
+    if args.manifest_only:
+        writemanifest(output, args.input)
+        print("wrote manifest for {} shards to {}".format(
+            len(args.input), output))
+        return
+    if len(args.input) != 1:
+        raise ValueError("expected one input storage to be split")
+    store = openstorage(args.input[0])
+    pcfg = store.pdfcalculator
+    if isinstance(store, HDFStorage) and pcfg is None:
+        pcfg = config.PDFCALCULATOR
+    codids = store.codids
+    if isinstance(store, RAWStorage):
+        codids = codids[store.live]
+    codids = numpy.unique(codids)
+    rgrid = store.rgrid
+    # split sorted COD ids into contiguous ranges of similar size
+    parts = numpy.array_split(codids, max(1, args.nshards))
+    base = os.path.splitext(output)[0]
+    shardfiles = []
+    for i, part in enumerate(parts):
+        f = '{}-{:03d}-raw.yml'.format(base, i)
+        if not args.force and os.path.exists(f):
+            emsg = "{} already exists, use --force to overwrite".format(f)
+            raise FileExistsError(emsg)
+        with RAWWriter(f, pcfg, dtype=rgrid.dtype) as writer:
+            # copy the shard in blocks to limit memory use
+            for lo in range(0, len(part), args.blocksize):
+                cids = part[lo:lo + args.blocksize]
+                for codid, g in zip(cids, store.readPDFs(cids)):
+                    writer.writePDF(codid, rgrid, g)
+        shardfiles.append(f)
+    writemanifest(output, shardfiles)
+    print("split {} PDFs into {} shards listed in {}".format(
+        len(codids), len(shardfiles), output))
+    return
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+'''Verify stored PDFs against their checksums and validity flags.
+
+Report entries that are unreadable, do not match the saved checksum,
+or contain all-zero or non-finite values.  Raw and compressed storage
+is checked in parallel chunks of rows.
+'''
+
+import argparse
+
+parser = argparse.ArgumentParser(description=__doc__.strip())
+parser.add_argument('-j', '--jobs', type=int, default=4,
+                    help="Number of parallel threads.  The default is 4.")
+parser.add_argument('--chunk', type=int, default=4096,
+                    help="Number of rows checked per task.")
+parser.add_argument('-q', '--quiet', action='store_true',
+                    help="Print only the summary of problems.")
+parser.add_argument('storage', nargs='+',
+                    help="HDF5 file or YAML file of raw, compressed "
+                    "or sharded storage")
+
+
+def verifystore(store, jobs=4, chunk=4096):
+    """Return list of (codid, problem) pairs for a PDF storage.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from cifpdfsearch.cifpdf import HDFStorage
+    if isinstance(store, HDFStorage):
+        # h5py serializes access, check all entries in one task
+        return store.verifyRows()
+    ranges = [(lo, lo + chunk) for lo in range(0, store.nrows, chunk)]
+    with ThreadPoolExecutor(jobs) as executor:
+        results = executor.map(lambda x: store.verifyRows(*x), ranges)
+        rv = [item for res in results for item in res]
+    return rv
+
+
+def main(args):
+    from collections import Counter
+    from cifpdfsearch.cifpdf import openstorage
+    nproblems = 0
+    for f in args.storage:
+        try:
+            store = openstorage(f)
+        except (OSError, ValueError) as e:
+            print("{}: unreadable storage, {}".format(f, e))
+            nproblems += 1
+            continue
+        for st in getattr(store, 'shards', [store]):
+            if not hasattr(st, 'verifyRows'):
+                print("{}: verification not supported".format(st.filename))
+                continue
+            problems = verifystore(st, jobs=args.jobs, chunk=args.chunk)
+            if not args.quiet:
+                for codid, problem in problems:
+                    print(codid, problem)
+            counts = Counter(p for c, p in problems)
+            summary = ', '.join('{} {}'.format(n, p)
+                                for p, n in sorted(counts.items()))
+            print("{}: {} entries, {}".format(
+                st.filename, st.nrows, summary or 'all good'))
+            nproblems += len(problems)
+    return nproblems
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    nproblems = main(args)
+    raise SystemExit(1 if nproblems else 0)
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+'''
+Index of reduced unit cells for prefiltering by lattice parameters.
+
+Conventional cells of CIF documents are converted to primitive cells
+according to the lattice centering and reduced to Niggli cells, which
+are the same for all choices of the unit cell.  The reduced cells are
+described by sorted cell lengths and acute equivalents of cell angles
+in ascending order, which makes the comparison insensitive to the
+ambiguities of nearly equal lengths and nearly right angles.  Cells are
+looked up in a grid of logarithmic cell lengths.
+'''
+
+import numpy
+
+# Primitive basis vectors in conventional cell coordinates (as columns)
+# for the lattice centering symbols.  R is for hexagonal axes, obverse.
+CENTERINGS = {
+    'P' : [[1, 0, 0], [0, 1, 0], [0, 0, 1]],
+    'A' : [[1, 0, 0], [0, 0.5, 0.5], [0, 0.5, -0.5]],
+    'B' : [[0.5, 0, 0.5], [0, 1, 0], [0.5, 0, -0.5]],
+    'C' : [[0.5, 0.5, 0], [0.5, -0.5, 0], [0, 0, 1]],
+    'I' : [[-0.5, 0.5, 0.5], [0.5, -0.5, 0.5], [0.5, 0.5, -0.5]],
+    'F' : [[0, 0.5, 0.5], [0.5, 0, 0.5], [0.5, 0.5, 0]],
+    'R' : [[2 / 3, -1 / 3, -1 / 3], [1 / 3, 1 / 3, -2 / 3],
+           [1 / 3, 1 / 3, 1 / 3]],
+}
+
+
+def latticecentering(spacegroup=None, spacegrouphall=None):
+    """Return lattice centering symbol for a space group.
+
+    Parameters
+    ----------
+    spacegroup : str, optional
+        Hermann-Mauguin space group symbol, e.g., "F m -3 m".
+    spacegrouphall : str, optional
+        Hall space group symbol, e.g., "-F 4 2 3".  Used when
+        `spacegroup` is not available.
+
+    Returns
+    -------
+    str
+        One of the CENTERINGS symbols, "P" when not known.
+    """
+    smbl = (spacegroup or '').strip()[:1].upper()
+    if not smbl and spacegrouphall:
+        smbl = spacegrouphall.strip().lstrip('-')[:1].upper()
+    rv = smbl if smbl in CENTERINGS else 'P'
+    return rv
+
+
+def primitivecell(cell, centering='P'):
+    """Return lattice parameters of primitive cell.
+
+    Parameters
+    ----------
+    cell : array_like
+        The (a, b, c, alpha, beta, gamma) lattice parameters.
+    centering : str, optional
+        Lattice centering symbol.  Rhombohedral cells with "R"
+        centering are converted only when given in hexagonal axes.
+
+    Returns
+    -------
+    numpy.ndarray
+        The primitive lattice parameters.
+    """
+    a, b, c, alpha, beta, gamma = map(float, cell)
+    hexaxes = abs(gamma - 120) < 0.01 and abs(a - b) < 1e-4 * a
+    if centering == 'P' or (centering == 'R' and not hexaxes):
+        return numpy.array(cell, dtype=float)
+    P = numpy.array(CENTERINGS[centering], dtype=float)
+    G = P.T.dot(_metrictensor(a, b, c, alpha, beta, gamma)).dot(P)
+    rv = _cellfrommetric(G)
+    return rv
+
+
+def nigglicell(cell, eps=1e-5):
+    """Return Niggli-reduced lattice parameters of a primitive cell.
+
+    Use the algorithm of Krivy and Gruber, Acta Cryst. A32, 297 (1976),
+    with relative tolerance `eps` on the metric components.
+
+    Parameters
+    ----------
+    cell : array_like
+        The (a, b, c, alpha, beta, gamma) lattice parameters.
+    eps : float, optional
+        Relative tolerance for the comparisons.
+
+    Returns
+    -------
+    numpy.ndarray
+        The reduced lattice parameters.
+
+    Raises
+    ------
+    ValueError
+        When the cell is invalid or the reduction does not converge.
+    """
+    G = _metrictensor(*map(float, cell))
+    A, B, C = map(float, numpy.diag(G))
+    xi, eta, zeta = map(float, 2 * G[[1, 0, 0], [2, 2, 1]])
+    if not (min(A, B, C) > 0 and numpy.isfinite([A, B, C]).all()):
+        emsg = "Invalid unit cell {}.".format(tuple(cell))
+        raise ValueError(emsg)
+    e = eps * (A * B * C) ** (1.0 / 3)
+    sgn = lambda x: int(x > e) - int(x < -e)
+    for _ in range(1000):
+        # N1, N2: order lengths
+        if A > B + e or (abs(A - B) <= e and abs(xi) > abs(eta) + e):
+            A, B, xi, eta = B, A, eta, xi
+        if B > C + e or (abs(B - C) <= e and abs(eta) > abs(zeta) + e):
+            B, C, eta, zeta = C, B, zeta, eta
+            continue
+        # N3, N4: all angles acute or all obtuse
+        if sgn(xi) * sgn(eta) * sgn(zeta) > 0:
+            xi, eta, zeta = abs(xi), abs(eta), abs(zeta)
+        else:
+            xi, eta, zeta = -abs(xi), -abs(eta), -abs(zeta)
+        # N5 - N8: reduce off-diagonal components
+        if (abs(xi) > B + e or (abs(xi - B) <= e and 2 * eta < zeta - e) or
+                (abs(xi + B) <= e and zeta < -e)):
+            s = 1 if xi > 0 else -1
+            C, eta, xi = B + C - xi * s, eta - zeta * s, xi - 2 * B * s
+            continue
+        if (abs(eta) > A + e or (abs(eta - A) <= e and 2 * xi < zeta - e) or
+                (abs(eta + A) <= e and zeta < -e)):
+            s = 1 if eta > 0 else -1
+            C, xi, eta = A + C - eta * s, xi - zeta * s, eta - 2 * A * s
+            continue
+        if (abs(zeta) > A + e or (abs(zeta - A) <= e and 2 * xi < eta - e) or
+                (abs(zeta + A) <= e and eta < -e)):
+            s = 1 if zeta > 0 else -1
+            B, xi, zeta = A + B - zeta * s, xi - eta * s, zeta - 2 * A * s
+            continue
+        t = xi + eta + zeta + A + B
+        if t < -e or (abs(t) <= e and 2 * (A + eta) + zeta > e):
+            C, xi, eta = t + C, 2 * B + xi + zeta, 2 * A + eta + zeta
+            continue
+        break
+    else:
+        emsg = "Niggli reduction did not converge for {}.".format(tuple(cell))
+        raise ValueError(emsg)
+    G = numpy.array([[A, zeta / 2, eta / 2],
+                     [zeta / 2, B, xi / 2],
+                     [eta / 2, xi / 2, C]])
+    rv = _cellfrommetric(G)
+    return rv
+
+
+def cellfeatures(cell, centering='P'):
+    """Return index features of a conventional unit cell.
+
+    The features are the Niggli-reduced cell lengths and the acute
+    equivalents of the reduced cell angles sorted in ascending order.
+
+    Returns
+    -------
+    numpy.ndarray
+        The (a, b, c, angle1, angle2, angle3) features.
+    """
+    rc = nigglicell(primitivecell(cell, centering))
+    angles = numpy.sort(90 - numpy.abs(rc[3:] - 90))
+    rv = numpy.concatenate([rc[:3], angles])
+    return rv
+
+
+class CellIndex:
+    """Grid index of reduced unit cells for tolerance queries.
+
+    Attributes
+    ----------
+    codids : numpy.ndarray
+        COD ids of the indexed cells.
+    features : numpy.ndarray
+        Array of `cellfeatures` for each COD id.
+    binwidth : float
+        Bin width of the grid in logarithm of cell lengths.
+    """
+
+    def __init__(self, codids, features, binwidth=0.02):
+        self.codids = numpy.asarray(codids, dtype=numpy.int64)
+        self.features = numpy.asarray(features, dtype=float).reshape(-1, 6)
+        self.binwidth = binwidth
+        self._order = None
+        self._keys = None
+        self._buildgrid()
+        return
+
+
+    @classmethod
+    def fromDocuments(cls, pairs, binwidth=0.02):
+        """Create index from (codid, doc) pairs of CIF documents.
+
+        Documents without valid cell parameters are skipped.
+        """
+        names = ('a', 'b', 'c', 'alpha', 'beta', 'gamma')
+        codids = []
+        features = []
+        for codid, doc in pairs:
+            cell = [doc.get(n) for n in names]
+            centering = latticecentering(doc.get('spacegroup'),
+                                         doc.get('spacegrouphall'))
+            try:
+                f = cellfeatures(cell, centering)
+                cid = int(codid)
+            except (TypeError, ValueError):
+                continue
+            codids.append(cid)
+            features.append(f)
+        rv = cls(codids, features, binwidth=binwidth)
+        return rv
+
+
+    @classmethod
+    def fromDocStore(cls, filename, binwidth=0.02):
+        "Create index from all documents in a local DocStore."
+        from cifpdfsearch.docstore import DocStore
+        sql = ('SELECT codid, a, b, c, alpha, beta, gamma, '
+               'spacegroup, spacegrouphall FROM docs')
+        names = sql[7:sql.index(' FROM')].split(', ')
+        with DocStore(filename) as ds:
+            rows = ds.connection.execute(sql).fetchall()
+        pairs = ((r[0], dict(zip(names, r))) for r in rows)
+        rv = cls.fromDocuments(pairs, binwidth=binwidth)
+        return rv
+
+
+    @classmethod
+    def load(cls, filename):
+        "Load index saved in a npz file."
+        with numpy.load(filename) as data:
+            rv = cls(data['codids'], data['features'],
+                     binwidth=float(data['binwidth']))
+        return rv
+
+
+    def save(self, filename):
+        "Save index to a npz file."
+        numpy.savez(filename, codids=self.codids, features=self.features,
+                    binwidth=self.binwidth)
+        return
+
+
+    def __len__(self):
+        return len(self.codids)
+
+
+    def query(self, cell, centering='P', lengthtol=0.03, angletol=1.0):
+        """Find COD ids of unit cells that match within tolerances.
+
+        Parameters
+        ----------
+        cell : array_like
+            The (a, b, c, alpha, beta, gamma) lattice parameters.
+        centering : str, optional
+            Lattice centering symbol of the cell.
+        lengthtol : float, optional
+            Relative tolerance on the reduced cell lengths.
+        angletol : float, optional
+            Tolerance on the reduced cell angles in degrees.
+
+        Returns
+        -------
+        numpy.ndarray
+            Sorted COD ids of the matching cells.
+        """
+        import itertools
+        f = cellfeatures(cell, centering)
+        lo = numpy.floor(numpy.log(f[:3] * (1 - lengthtol)) / self.binwidth)
+        hi = numpy.floor(numpy.log(f[:3] * (1 + lengthtol)) / self.binwidth)
+        ranges = [range(int(l), int(h) + 1) for l, h in zip(lo, hi)]
+        keys = numpy.array([self._gridkey(*ijk)
+                            for ijk in itertools.product(*ranges)])
+        start = numpy.searchsorted(self._keys, keys, side='left')
+        stop = numpy.searchsorted(self._keys, keys, side='right')
+        idx = numpy.concatenate([self._order[i:j]
+                                 for i, j in zip(start, stop)] + [[]])
+        idx = idx.astype(int)
+        cand = self.features[idx]
+        ok = numpy.all(numpy.abs(cand[:, :3] / f[:3] - 1) <= lengthtol, axis=1)
+        ok &= numpy.all(numpy.abs(cand[:, 3:] - f[3:]) <= angletol, axis=1)
+        rv = numpy.sort(self.codids[idx[ok]])
+        return rv
+
+
+    def _buildgrid(self):
+        "Sort cells by their grid bin keys."
+        ijk = numpy.floor(numpy.log(self.features[:, :3]) / self.binwidth)
+        keys = self._gridkey(*ijk.astype(numpy.int64).T)
+        self._order = numpy.argsort(keys, kind='stable')
+        self._keys = keys[self._order]
+        return
+
+
+    @staticmethod
+    def _gridkey(i, j, k):
+        "Combine grid bin indices into a sortable integer key."
+        off = 1 << 20
+        rv = ((i + off) << 42) | ((j + off) << 21) | (k + off)
+        return rv
+
+# end of class CellIndex
+
+# Local Helpers --------------------------------------------------------------
+
+def _metrictensor(a, b, c, alpha, beta, gamma):
+    "Return metric tensor for lattice parameters with angles in degrees."
+    ca, cb, cg = numpy.cos(numpy.radians([alpha, beta, gamma]))
+    rv = numpy.array([[a * a, a * b * cg, a * c * cb],
+                      [a * b * cg, b * b, b * c * ca],
+                      [a * c * cb, b * c * ca, c * c]])
+    return rv
+
+
+def _cellfrommetric(G):
+    "Return lattice parameters for a metric tensor."
+    a, b, c = numpy.sqrt(numpy.diag(G))
+    alpha = numpy.degrees(numpy.arccos(numpy.clip(G[1, 2] / (b * c), -1, 1)))
+    beta = numpy.degrees(numpy.arccos(numpy.clip(G[0, 2] / (a * c), -1, 1)))
+    gamma = numpy.degrees(numpy.arccos(numpy.clip(G[0, 1] / (a * b), -1, 1)))
+    rv = numpy.array([a, b, c, alpha, beta, gamma])
+    return rv
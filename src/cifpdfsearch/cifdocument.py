@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
 
-from cifpdfsearch._utils import tofloat, grouper, safecall
+import re
+from cifpdfsearch._utils import tofloat, grouper, safecall, cifcellvolume
 
 
 CIFDOCMAP = '''
@@ -21,6 +22,18 @@ _cod_database_code codid
 
 CIFDOCMAP = dict(grouper(CIFDOCMAP, 2))
 
+# CIF loop items needed for the derived structure quantities.
+CIFSITELOOP = (
+    '_atom_site_fract_x',
+    '_atom_site_fract_y',
+    '_atom_site_fract_z',
+    '_atom_site_occupancy',
+)
+CIFSYMOPLOOPS = (
+    '_space_group_symop_operation_xyz',
+    '_symmetry_equiv_pos_as_xyz',
+)
+
 CIFCONVERTERS = {
     "_cell_angle_alpha" : tofloat,
     "_cell_angle_beta" : tofloat,
@@ -64,13 +77,97 @@ def normalized_formula(formula):
     return rv
 
 
+class FormulaCache:
+    """Bounded LRU cache of normalized compositions of chemical formulas.
+
+    Formulas that cannot be parsed are cached as `None`.  Compositions
+    from a precomputed formula table are never evicted.
+
+    Attributes
+    ----------
+    maxsize : int
+        Maximum number of cached formulas apart from the table.
+    table : dict
+        Precomputed compositions for formula strings.
+    hits : int
+        Number of lookups found in the table or cache.
+    misses : int
+        Number of lookups that called `normalized_formula`.
+    """
+
+    # normalized_formula which returns None for invalid formulas
+    _normalized_formula = staticmethod(safecall(normalized_formula))
+
+    def __init__(self, maxsize=65536, table=None):
+        from collections import OrderedDict
+        self.maxsize = maxsize
+        self.table = dict(table or {})
+        self.hits = 0
+        self.misses = 0
+        self._lru = OrderedDict()
+        return
+
+
+    def __call__(self, formula):
+        """Return normalized composition of formula or None if invalid.
+
+        The returned dictionary is a copy that can be modified.
+        """
+        rv = self.table.get(formula, self)
+        if rv is self:
+            rv = self._lru.get(formula, self)
+            if rv is not self:
+                self._lru.move_to_end(formula)
+        if rv is self:
+            self.misses += 1
+            rv = self._normalized_formula(formula)
+            self._lru[formula] = rv
+            if len(self._lru) > self.maxsize:
+                self._lru.popitem(last=False)
+        else:
+            self.hits += 1
+        return None if rv is None else dict(rv)
+
+
+    def statistics(self):
+        "Return dictionary of cache size and hit counts."
+        lookups = self.hits + self.misses
+        rv = dict(hits=self.hits, misses=self.misses,
+                  hitrate=(self.hits / lookups if lookups else None),
+                  size=len(self._lru), tablesize=len(self.table))
+        return rv
+
+
+    def loadTable(self, filename):
+        "Add formula compositions from a JSON file to the table."
+        import json
+        with open(filename) as fp:
+            self.table.update(json.load(fp))
+        return
+
+
+    def saveTable(self, filename):
+        "Save the table together with cached compositions to a JSON file."
+        import json
+        data = dict(self.table)
+        data.update(self._lru)
+        with open(filename, 'w') as fp:
+            json.dump(data, fp, sort_keys=True)
+        return
+
+# end of class FormulaCache
+
+
+# Shared cache of formula compositions for cifdocument
+formulacache = FormulaCache()
+
+
 def cifdocument(codjson):
     """
     Create document from JSON record from cif2json utility.
     """
     codvalues = codjson['data']['values']
     cifnames = set(CIFDOCMAP).intersection(codvalues)
-    getcomposition = safecall(normalized_formula)
     rv = {}
     for cn in cifnames:
         fcnv = getconverter(codjson, cn)
@@ -79,8 +176,225 @@ def cifdocument(codjson):
         en = CIFDOCMAP[cn]
         rv[en] = evalue
     # derived quantities
-    formula = rv.get('formula', 'xxx-fail-xxx')
-    if getcomposition(formula):
-        rv['composition'] = getcomposition(formula)
-        rv['nel'] = len(rv['composition'])
+    composition = formulacache(rv.get('formula', 'xxx-fail-xxx'))
+    if composition:
+        rv['composition'] = composition
+        rv['nel'] = len(composition)
+    try:
+        numdensity = cifnumdensity(codjson)
+    except ValueError:
+        numdensity = None
+    if numdensity is not None:
+        rv['numdensity'] = numdensity
+    return rv
+
+
+def cifnumdensity(codjson):
+    """
+    Return number density of atoms from JSON record of a CIF file.
+
+    The atom count in the unit cell is the occupancy-weighted sum of
+    site multiplicities for the listed symmetry operations.
+
+    Parameters
+    ----------
+    codjson : dict
+        Record in cif2json layout with the cell, atom site and symmetry
+        operation items.
+
+    Returns
+    -------
+    float or None
+        The number density in 1/A**3 or `None` when the record has
+        no atom sites or the cell volume is not available.
+
+    Raises
+    ------
+    ValueError
+        When the record has invalid numeric values or symmetry
+        operations.
+    """
+    import numpy
+    codvalues = codjson['data']['values']
+    volume = tofloat(codvalues.get('_cell_volume', ['?'])[0])
+    if not volume or not volume > 0:
+        volume = cifcellvolume({n : codvalues[n][0] for n in
+                                set(CIFDOCMAP).intersection(codvalues)})
+    if not volume:
+        return None
+    columns = [codvalues.get(n, ()) for n in CIFSITELOOP]
+    nsites = len(columns[0])
+    columns[3] = columns[3] or nsites * ['1']
+    if not nsites or any(len(c) != nsites for c in columns):
+        return None
+    a = numpy.array([[tofloat(w) for w in c] for c in columns],
+                    dtype=float).T
+    # skip sites with unknown positions, unknown occupancy means full
+    a = a[~numpy.isnan(a[:, :3]).any(axis=1)]
+    xyz, occ = a[:, :3], a[:, 3]
+    occ[numpy.isnan(occ)] = 1.0
+    triplets = next((codvalues[n] for n in CIFSYMOPLOOPS if n in codvalues),
+                    ['x,y,z'])
+    symops = numpy.array([symopmatrix(t) for t in triplets])
+    natoms = numpy.dot(occ, sitemultiplicities(xyz, symops))
+    rv = float(natoms / volume)
+    return rv
+
+
+def sitemultiplicities(xyz, symops, eps=1e-3):
+    """
+    Return number of symmetry-equivalent positions for atom sites.
+
+    Parameters
+    ----------
+    xyz : numpy.ndarray
+        Fractional coordinates of the sites in rows.
+    symops : numpy.ndarray
+        Symmetry operations as (M, 3, 4) array of affine matrices.
+        The operations must form a group including lattice centering.
+    eps : float, optional
+        Tolerance on equal fractional coordinates.
+
+    Returns
+    -------
+    numpy.ndarray
+        The site multiplicities as floats.
+    """
+    import numpy
+    xyz = numpy.asarray(xyz, dtype=float)
+    rot, tran = symops[:, :, :3], symops[:, :, 3]
+    # images of all sites for all operations, shape (nsites, nops, 3)
+    images = numpy.einsum('mij,nj->nmi', rot, xyz) + tran
+    d = images - xyz[:, numpy.newaxis, :]
+    d -= numpy.round(d)
+    # the site stabilizer has operations that map the site on itself
+    nstabilizer = numpy.all(numpy.fabs(d) < eps, axis=2).sum(axis=1)
+    rv = len(symops) / numpy.maximum(nstabilizer, 1)
+    return rv
+
+
+def symopmatrix(triplet):
+    """
+    Convert symmetry operation in the xyz notation to affine matrix.
+
+    Parameters
+    ----------
+    triplet : str
+        Symmetry operation such as "-y,x-y,z+1/3".
+
+    Returns
+    -------
+    numpy.ndarray
+        The (3, 4) matrix of rotation and translation.
+
+    Raises
+    ------
+    ValueError
+        When the triplet cannot be parsed.
+    """
+    import numpy
+    rows = triplet.replace(' ', '').lower().split(',')
+    if len(rows) != 3:
+        emsg = "Invalid symmetry operation {!r}.".format(triplet)
+        raise ValueError(emsg)
+    rv = numpy.zeros((3, 4))
+    for i, row in enumerate(rows):
+        pos = 0
+        while pos < len(row):
+            mx = _rxsymopterm.match(row, pos)
+            if not mx or mx.end() == pos:
+                emsg = "Invalid symmetry operation {!r}.".format(triplet)
+                raise ValueError(emsg)
+            pos = mx.end()
+            sign = -1.0 if mx.group('sign') == '-' else 1.0
+            num, den = mx.group('num', 'den')
+            value = sign * float(num or 1) / float(den or 1)
+            xyz = mx.group('xyz')
+            j = 3 if xyz is None else 'xyz'.index(xyz)
+            if xyz is None and num is None:
+                emsg = "Invalid symmetry operation {!r}.".format(triplet)
+                raise ValueError(emsg)
+            rv[i, j] += value
+    return rv
+
+_rxsymopterm = re.compile(r"""
+    (?P<sign>[-+]?)
+    (?:(?P<num>\d+\.?\d*|\.\d+)(?:/(?P<den>\d+))?\*?)?
+    (?P<xyz>[xyz])?
+    """, re.VERBOSE)
+
+
+def cifblockrecord(block):
+    """
+    Create cif2json-like record for CIFDOCMAP items in a gemmi CIF block.
+
+    The record has the "values" and "types" items of cif2json output
+    that are used by `cifdocument`, including the atom site and
+    symmetry operation loops.  Unknown and inapplicable values of
+    single items are omitted.
+
+    Parameters
+    ----------
+    block : gemmi.cif.Block
+        The parsed CIF data block.
+
+    Returns
+    -------
+    dict
+        The record with cif2json layout.
+    """
+    import gemmi.cif
+    values = {}
+    types = {}
+    for cn in CIFDOCMAP:
+        raw = block.find_value(cn)
+        if raw is None or raw in ('?', '.'):
+            continue
+        values[cn] = [gemmi.cif.as_string(raw)]
+        types[cn] = [_ciftype(raw)]
+    for cn in CIFSITELOOP + CIFSYMOPLOOPS:
+        column = block.find_values(cn)
+        if not len(column):
+            continue
+        values[cn] = [gemmi.cif.as_string(raw) for raw in column]
+        types[cn] = [_ciftype(raw) for raw in column]
+    rv = {'data' : {'values' : values, 'types' : types}}
+    return rv
+
+
+def ciffiledocument(filename):
+    """
+    Create document for a CIF file without the cif2json utility.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the CIF file with a single data block.
+
+    Returns
+    -------
+    codid : int
+        The COD database code of the CIF file.
+    doc : dict
+        The document from `cifdocument`.
+    """
+    import gemmi.cif
+    block = gemmi.cif.read(filename).sole_block()
+    codjson = cifblockrecord(block)
+    codid = cifid(codjson)
+    doc = cifdocument(codjson)
+    return codid, doc
+
+
+def _ciftype(raw):
+    "Return cif2json type name of a raw CIF value."
+    rv = _CIFQUOTETYPES.get(raw[:1])
+    if rv is None:
+        rv = ('INT' if _rxcifint.match(raw) else
+              'FLOAT' if _rxciffloat.match(raw) else 'UQSTRING')
     return rv
+
+_CIFQUOTETYPES = {"'" : 'SQSTRING', '"' : 'DQSTRING', ';' : 'TEXTFIELD'}
+_rxcifint = re.compile(r'[-+]?\d+(\(\d+\))?$')
+_rxciffloat = re.compile(
+    r'[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?(\(\d+\))?$')
@@ -6,17 +6,27 @@ Tools for bulk calculation of pair distribution functions from COD entries.
 
 
 import os.path
+import re
 import logging
 import math
 import numpy
 import yaml
 
 from cifpdfsearch import normcodid
+from cifpdfsearch.metrics import metrics
 
 # register SFTXrayNeutral lookup table
 import cifpdfsearch.sftxrayneutral
 assert cifpdfsearch.sftxrayneutral is not None
 
+# Validity flags of the stored PDF rows.
+ROW_VALID = 1
+ROW_ZERO = 2
+ROW_NONFINITE = 4
+
+# Record of the row checksum and validity flags in the "chk" files.
+_CHKDTYPE = numpy.dtype([('crc', '<u4'), ('flags', 'u1')])
+
 # ----------------------------------------------------------------------------
 
 class calculator:
@@ -97,12 +107,14 @@ class HDFStorage:
     def __init__(self, filename):
         self.filename = os.path.abspath(filename)
         self._rgrid = None
+        self._hfile = None
         return
 
 
     def writeConfig(self, cfg):
         from cifpdfsearch._utils import h5writejson
         calc = calculator.fromConfig(cfg)
+        self.close()
         with self._openhdf('a') as hfile:
             hfile.pop(self._gconfigcalc, None)
             group = hfile.create_group(self._gconfigcalc)
@@ -119,46 +131,312 @@ class HDFStorage:
 
 
     def writePDF(self, codid, r, g):
-        from numpy import allclose
-        if r.shape != self.rgrid.shape or not allclose(r, self.rgrid):
-            emsg = "r must equal the {} dataset".format(self._dsrgridpath)
-            raise ValueError(emsg)
-        scid = normcodid(codid)
-        nm = self._dspdfpath.format(scid)
-        with self._openhdf('a') as hfile:
-            ds = hfile.require_dataset(nm, shape=g.shape, dtype=self.dtype)
-            ds[:] = g
+        with self.writer() as hw:
+            hw.writePDF(codid, r, g)
         return
 
 
+    def writer(self, flushsize=1000):
+        """Open writer session for saving many PDFs.
+
+        Parameters
+        ----------
+        flushsize : int, optional
+            Number of buffered PDFs that triggers write to the file.
+
+        Returns
+        -------
+        HDFWriter
+            The writer session to be used as a context manager.
+        """
+        # HDF5 cannot open the file for writing when it is open to read
+        self.close()
+        return HDFWriter(self, flushsize=flushsize)
+
+
     def readPDF(self, codid):
         scid = normcodid(codid)
         dsname = self._dspdfpath.format(scid)
-        with self._openhdf('r') as hfile:
-            g = hfile[dsname][()]
+        g = self._reader()[dsname][()]
+        metrics.inc('rows_read')
+        metrics.inc('bytes_read', g.nbytes)
         rv = (self.rgrid, g)
         return rv
 
 
+    def readPDFs(self, codids):
+        """Read PDFs for a sequence of COD identifiers.
+
+        The datasets are accessed in sorted order of COD identifiers.
+
+        Parameters
+        ----------
+        codids : iterable
+            The COD identifiers as integers or strings.
+
+        Returns
+        -------
+        numpy.ndarray
+            Two-dimensional array with PDF rows in the order of `codids`.
+
+        Raises
+        ------
+        KeyError
+            When some COD identifier is not in the storage.
+        """
+        scids = [normcodid(c) for c in codids]
+        hfile = self._reader()
+        rv = numpy.empty((len(scids), len(self.rgrid)), dtype=self.dtype)
+        for i in sorted(range(len(scids)), key=scids.__getitem__):
+            dsname = self._dspdfpath.format(scids[i])
+            rv[i] = hfile[dsname][()]
+        metrics.inc('rows_read', len(rv))
+        metrics.inc('bytes_read', rv.nbytes)
+        return rv
+
+
+    def items(self):
+        """Generate pairs of (codid, g) for all stored PDFs.
+
+        The COD identifiers are int32 in ascending order as in RAWStorage.
+        """
+        grp = self._reader().get(os.path.dirname(self._dspdfpath), {})
+        for n, ds in grp.items():
+            yield numpy.int32(normcodid(n)), ds[()]
+        pass
+
+
+    def blocks(self, blocksize=1024):
+        """Generate pairs of (codids, gblock) arrays for blocks of rows.
+
+        Rows without the ROW_VALID flag are left out.  Datasets saved
+        without validity flags are skipped when all-zero.
+        """
+        from itertools import islice
+        grp = self._reader().get(os.path.dirname(self._dspdfpath), {})
+        gitems = iter(grp.items())
+        while True:
+            chunk = list(islice(gitems, blocksize))
+            if not chunk:
+                break
+            codids = numpy.array([normcodid(n) for n, ds in chunk],
+                                 dtype='int32')
+            gblock = numpy.array([ds[()] for n, ds in chunk],
+                                 dtype=self.dtype)
+            # use -1 for datasets without the flags attribute
+            flags = numpy.array([ds.attrs.get('flags', -1)
+                                 for n, ds in chunk], dtype=int)
+            metrics.inc('rows_scanned', len(gblock))
+            metrics.inc('bytes_read', gblock.nbytes)
+            keep = numpy.where(flags < 0, gblock.any(axis=1),
+                               flags == ROW_VALID)
+            yield codids[keep], gblock[keep]
+        pass
+
+
+    def verifyRows(self, lo=0, hi=None):
+        """Check stored PDFs against their checksums and validity flags.
+
+        Parameters
+        ----------
+        lo, hi : int, optional
+            Range of PDF datasets in the order of COD identifiers.
+
+        Returns
+        -------
+        list
+            Pairs of (codid, problem) for the failed entries, where
+            problem is "unreadable", "checksum", "zero" or "nonfinite".
+            Datasets saved without checksum are only checked for
+            the zero or non-finite values.
+        """
+        grp = self._reader().get(os.path.dirname(self._dspdfpath), {})
+        rv = []
+        for n in sorted(grp)[lo:hi]:
+            codid = normcodid(n)
+            try:
+                ds = grp[n]
+                g = ds[()]
+                crc = ds.attrs.get('crc32')
+            except (OSError, KeyError, ValueError):
+                rv.append((codid, 'unreadable'))
+                continue
+            chk = _rowchecks(g[numpy.newaxis])[0]
+            problem = _rowproblem(chk, crc)
+            if problem:
+                rv.append((codid, problem))
+        return rv
+
+
+    @property
+    def nrows(self):
+        grp = self._reader().get(os.path.dirname(self._dspdfpath), {})
+        return len(grp)
+
+
+    @property
+    def codids(self):
+        "Sorted int32 array of COD identifiers from the dataset names."
+        grp = self._reader().get(os.path.dirname(self._dspdfpath), {})
+        rv = numpy.array([normcodid(n) for n in grp], dtype='int32')
+        rv.sort()
+        return rv
+
+
+    @property
+    def pdfcalculator(self):
+        "PDFCALCULATOR configuration saved in the file or None."
+        from cifpdfsearch._utils import h5readjson
+        group = self._reader().get(self._gconfigcalc)
+        rv = None if group is None else h5readjson(group)
+        return rv
+
+
     @property
     def rgrid(self):
         if self._rgrid is None:
-            with self._openhdf('r') as hfile:
-                self._rgrid = hfile[self._dsrgridpath][:]
+            self._rgrid = self._reader()[self._dsrgridpath][:]
         return self._rgrid
 
 
+    def close(self):
+        """Close the cached read handle of the HDF5 file.
+        """
+        if self._hfile is not None:
+            self._hfile.close()
+            self._hfile = None
+        return
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return
+
+
+    def _reader(self):
+        "Return cached HDF5 file opened for reading."
+        if self._hfile is None:
+            self._hfile = self._openhdf('r')
+        return self._hfile
+
+
     def _openhdf(self, mode):
         import h5py
         return h5py.File(self.filename, mode)
 
 # end of class HDFStorage
 
+
+class HDFWriter:
+    """Writer session that holds one open HDF5 file of HDFStorage.
+
+    The PDFs are buffered and written in blocks on `flush`, which is
+    called automatically after `flushsize` entries and when the session
+    is closed.  The r-grid is verified only once per distinct r array.
+    """
+
+    def __init__(self, storage, flushsize=1000):
+        self.storage = storage
+        self.flushsize = flushsize
+        self._buffer = {}
+        self._rchecked = None
+        self._hfile = storage._openhdf('a')
+        self.rgrid = self._hfile[storage._dsrgridpath][:]
+        return
+
+
+    def writePDF(self, codid, r, g):
+        if r is not self._rchecked:
+            rgrid = self.rgrid
+            if r.shape != rgrid.shape or not numpy.allclose(r, rgrid):
+                emsg = "r must equal the {} dataset".format(
+                    self.storage._dsrgridpath)
+                raise ValueError(emsg)
+            self._rchecked = r
+        scid = normcodid(codid)
+        self._buffer[scid] = numpy.asarray(g, dtype=self.storage.dtype)
+        if len(self._buffer) >= self.flushsize:
+            self.flush()
+        return
+
+
+    def flush(self):
+        """Write buffered PDFs to the HDF5 file.
+        """
+        hfile = self._hfile
+        for scid, g in sorted(self._buffer.items()):
+            nm = self.storage._dspdfpath.format(scid)
+            ds = hfile.get(nm)
+            if ds is not None and ds.shape != g.shape:
+                del hfile[nm]
+                ds = None
+            if ds is None:
+                ds = hfile.create_dataset(nm, data=g)
+            else:
+                ds[...] = g
+            # set checksum after the data so partial writes are detected
+            chk = _rowchecks(g[numpy.newaxis])[0]
+            ds.attrs['crc32'] = chk['crc']
+            ds.attrs['flags'] = chk['flags']
+        self._buffer.clear()
+        hfile.flush()
+        return
+
+
+    def close(self):
+        if not self._hfile:
+            return
+        self.flush()
+        self._hfile.close()
+        return
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return
+
+# end of class HDFWriter
+
 # ----------------------------------------------------------------------------
 
 class RAWStorage:
+    """Memory-mapped PDF storage in raw binary files.
 
-    def __init__(self, filename):
+    The storage is written with RAWWriter.  Rows can be appended, updated
+    and deleted in place.  Updated COD entries are appended as new rows
+    that supersede the old ones and deleted rows are marked in the "del"
+    bitmap file.  Dead rows are skipped by the readers until the storage
+    is rewritten with the compactstore application.
+
+    Attributes
+    ----------
+    codids : numpy.ndarray
+        COD identifiers of all rows including the dead ones.
+    live : numpy.ndarray
+        Boolean mask of rows with the current PDFs.
+    checks : numpy.ndarray or None
+        Row checksums and validity flags from the "chk" file or `None`
+        for storage written without them.
+    valid : numpy.ndarray
+        Boolean mask of live rows with the ROW_VALID flag.
+    index : RowIndex
+        Lookup of the live row for a COD identifier.
+    zscores : dict
+        Memory-mapped z-scored rows from `writezscores` for the
+        (clo, chi) index bounds of the r-windows.
+    gdata : numpy.ndarray
+        Memory-mapped array of PDF rows.
+    """
+
+    def __init__(self, filename, verify=False):
         b, e = os.path.splitext(filename)
         f = filename
         if e != '.yml':
@@ -167,23 +445,51 @@ class RAWStorage:
             cfg = yaml.safe_load(fp)
         f = os.path.abspath(f)
         b, _ = os.path.splitext(f)
-        codids = numpy.fromfile(b + '.idx', dtype='int32')
-        index = {c: i for i, c in enumerate(codids)}
         mcfg = cfg['memmap']
         pcfg = cfg['pdfcalculator']
-        gdata = numpy.memmap(b + '.bin', mode='r', dtype=mcfg['dtype'])
-        gdata = gdata.reshape(mcfg['shape'])
-        npts = round((pcfg['rmax'] - pcfg['rmin']) / pcfg['rstep']) + 1
-        rgrid = numpy.linspace(pcfg['rmin'], pcfg['rmax'], npts,
-                               dtype=mcfg['dtype'])
+        shape = tuple(mcfg['shape'])
+        # the data files may have extra rows from an unfinished writer
+        codids = numpy.fromfile(b + '.idx', dtype='int32', count=shape[0])
+        index = _loadrawindex(b, codids)
+        live = numpy.zeros(len(codids), dtype=bool)
+        live[index.rows] = True
+        checks = _loadchecks(b + '.chk', shape[0])
+        valid = live
+        if checks is not None:
+            valid = live & (checks['flags'] == ROW_VALID)
+        if shape[0]:
+            nbytes = numpy.prod(shape) * numpy.dtype(mcfg['dtype']).itemsize
+            if os.path.getsize(b + '.bin') < nbytes:
+                emsg = "{}.bin is truncated".format(b)
+                raise ValueError(emsg)
+            gdata = numpy.memmap(b + '.bin', mode='r', dtype=mcfg['dtype'],
+                                 shape=shape)
+        else:
+            gdata = numpy.zeros(shape, dtype=mcfg['dtype'])
+        rgrid = _rawrgrid(pcfg, mcfg['dtype'])
         assert len(rgrid) == gdata.shape[1]
+        assert len(codids) == gdata.shape[0]
         # all good here - let us assign all attributes
         self.filename = os.path.abspath(f)
+        self.pdfcalculator = pcfg
         self.codids = codids
+        self.nrows = len(codids)
+        self.live = live
+        self.checks = checks
+        self.valid = valid
+        self.verify = verify
         self.index = index
         self.gdata = gdata
         self.rgrid = rgrid
         self.dtype = rgrid.dtype
+        self.zscores = _loadzscores(b, codids)
+        return
+
+
+    def reload(self):
+        """Read the storage again to see changes from writers.
+        """
+        self.__init__(self.filename, verify=self.verify)
         return
 
 
@@ -191,8 +497,32 @@ class RAWStorage:
         raise NotImplementedError
 
 
+    def writer(self):
+        """Open writer session for appending, updating or deleting PDFs.
+
+        The changes become visible after `reload`.
+
+        Returns
+        -------
+        RAWWriter
+        """
+        rv = RAWWriter(self.filename, self.pdfcalculator,
+                       dtype=self.dtype, append=True)
+        return rv
+
+
     def writePDF(self, codid, r, g):
-        raise NotImplementedError
+        with self.writer() as rw:
+            rw.writePDF(codid, r, g)
+        self.reload()
+        return
+
+
+    def deletePDF(self, codid):
+        with self.writer() as rw:
+            rw.deletePDF(codid)
+        self.reload()
+        return
 
 
     def readPDF(self, codid):
@@ -201,18 +531,1575 @@ class RAWStorage:
             cid = int(normcodid(cid))
         row = self.index[cid]
         g = self.gdata[row]
+        metrics.inc('rows_read')
+        metrics.inc('bytes_read', g.nbytes)
+        if self.verify:
+            self._checkrows([row], g[numpy.newaxis])
         rv = (self.rgrid, g)
         return rv
 
 
+    def readPDFs(self, codids):
+        """Read PDFs for a sequence of COD identifiers.
+
+        Returns
+        -------
+        numpy.ndarray
+            Two-dimensional array with PDF rows in the order of `codids`.
+
+        Raises
+        ------
+        KeyError
+            When some COD identifier is not in the storage.
+        """
+        cids = [int(normcodid(c)) if isinstance(c, str) else c
+                for c in codids]
+        rows = self.index.lookup(cids)
+        # read memory-mapped rows in file order
+        order = numpy.argsort(rows)
+        rv = numpy.empty((len(rows), self.gdata.shape[1]), dtype=self.dtype)
+        rv[order] = self.gdata[rows[order]]
+        metrics.inc('rows_read', len(rv))
+        metrics.inc('bytes_read', rv.nbytes)
+        if self.verify:
+            self._checkrows(rows, rv)
+        return rv
+
+
+    def verifyRows(self, lo=0, hi=None):
+        """Check live rows against their checksums and validity flags.
+
+        Parameters
+        ----------
+        lo, hi : int, optional
+            Range of storage rows to be checked.
+
+        Returns
+        -------
+        list
+            Pairs of (codid, problem) for the failed rows, where problem
+            is "checksum", "zero" or "nonfinite".  Without the "chk" file
+            only the zero or non-finite values are detected.
+        """
+        rows = numpy.flatnonzero(self.live[lo:hi]) + lo
+        chk = _rowchecks(self.gdata[rows])
+        crcs = [None] * len(rows)
+        if self.checks is not None:
+            crcs = self.checks['crc'][rows]
+        rv = []
+        for row, c, crc in zip(rows, chk, crcs):
+            problem = _rowproblem(c, crc)
+            if problem:
+                rv.append((normcodid(self.codids[row]), problem))
+        return rv
+
+
     def items(self):
-        rv = zip(self.codids, self.gdata)
+        if self.live.all():
+            return zip(self.codids, self.gdata)
+        rows = numpy.flatnonzero(self.live)
+        rv = zip(self.codids[rows], (self.gdata[i] for i in rows))
         return rv
 
+
+    def blocks(self, blocksize=4096):
+        """Generate pairs of (codids, gblock) arrays for blocks of rows.
+
+        Dead rows and rows without the ROW_VALID flag are left out.
+        Storage without validity flags skips the all-zero rows.
+        """
+        return self._genblocks(self.gdata, blocksize,
+                               checkzero=self.checks is None)
+
+
+    def zscoreblocks(self, clo, chi, blocksize=4096):
+        """Generate blocks of z-scored rows for the r-window if available.
+
+        Parameters
+        ----------
+        clo, chi : int
+            Index bounds of the r-window in `rgrid`, where `chi` is
+            excluded.
+
+        Returns
+        -------
+        generator or None
+            Pairs of (codids, zblock) arrays without the dead rows or
+            `None` when the storage has no z-scores for the window.
+        """
+        zdata = self.zscores.get((clo, chi))
+        if zdata is None:
+            return None
+        return self._genblocks(zdata, blocksize)
+
+
+    def _genblocks(self, data, blocksize, checkzero=False):
+        for lo in range(0, len(self.codids), blocksize):
+            hi = lo + blocksize
+            block = data[lo:hi]
+            metrics.inc('rows_scanned', len(block))
+            metrics.inc('bytes_read', block.nbytes)
+            keep = self.valid[lo:hi]
+            if checkzero:
+                keep = keep & block.any(axis=1)
+            if keep.all():
+                yield self.codids[lo:hi], block
+            else:
+                yield self.codids[lo:hi][keep], block[keep]
+        pass
+
+
+    def _checkrows(self, rows, gblock):
+        "Raise ValueError for rows that do not match their checksums."
+        if self.checks is None:
+            return
+        crc = _rowchecks(gblock)['crc']
+        bad = crc != self.checks['crc'][rows]
+        if bad.any():
+            cid = self.codids[numpy.asarray(rows)[bad][0]]
+            emsg = "checksum mismatch for COD {}".format(normcodid(cid))
+            raise ValueError(emsg)
+        return
+
 # end of class RAWStorage
 
+
+def _rawrgrid(pcfg, dtype):
+    "Return r-grid array for the raw storage configuration."
+    npts = round((pcfg['rmax'] - pcfg['rmin']) / pcfg['rstep']) + 1
+    rgrid = numpy.linspace(pcfg['rmin'], pcfg['rmax'], npts, dtype=dtype)
+    return rgrid
+
+
+class RowIndex:
+    """Sorted array index from COD identifiers to storage rows.
+
+    Attributes
+    ----------
+    codids : numpy.ndarray
+        Sorted int32 COD identifiers.
+    rows : numpy.ndarray
+        Row numbers for the COD identifiers in `codids`.
+    """
+
+    def __init__(self, codids, rows):
+        self.codids = codids
+        self.rows = rows
+        return
+
+
+    def __len__(self):
+        return len(self.codids)
+
+
+    def __contains__(self, codid):
+        k = numpy.searchsorted(self.codids, codid)
+        rv = k < len(self.codids) and self.codids[k] == codid
+        return bool(rv)
+
+
+    def __getitem__(self, codid):
+        k = numpy.searchsorted(self.codids, codid)
+        if k < len(self.codids) and self.codids[k] == codid:
+            return int(self.rows[k])
+        raise KeyError(codid)
+
+
+    def lookup(self, codids):
+        """Return array of rows for a sequence of COD identifiers.
+
+        Raises
+        ------
+        KeyError
+            When some COD identifier is not in the index.
+        """
+        cids = numpy.asarray(codids, dtype='int64').reshape(-1)
+        if not len(self.codids):
+            if len(cids):
+                raise KeyError(int(cids[0]))
+            return numpy.zeros(0, dtype='int32')
+        k = numpy.searchsorted(self.codids, cids)
+        k[k == len(self.codids)] = 0
+        found = self.codids[k] == cids
+        if not found.all():
+            raise KeyError(int(cids[~found][0]))
+        rv = self.rows[k]
+        return rv
+
+# end of class RowIndex
+
+
+def _loadrawindex(b, codids):
+    """Return RowIndex of live rows for raw storage with base path b.
+
+    The index is memory-mapped from the "sidx" file, which starts with
+    two stamp columns of the row count, the number of dead rows and
+    the crc32 checksum of the COD ids.  A missing, malformed or stale
+    index file is rebuilt and saved if possible.
+    """
+    import zlib
+    nrows = len(codids)
+    deleted = _readtombstones(b + '.del', nrows)
+    ndeleted = int(deleted.sum())
+    crc = numpy.uint32(zlib.crc32(codids.tobytes())).view('int32')
+    stamp = numpy.array([[nrows, crc], [ndeleted, 0]], dtype='int32')
+    f = b + '.sidx'
+    try:
+        a = numpy.load(f, mmap_mode='r')
+        if (a.dtype != stamp.dtype or a.ndim != 2 or a.shape[0] != 2 or
+                a.shape[1] < 2 or not numpy.array_equal(a[:, :2], stamp)):
+            a = None
+    except (OSError, ValueError):
+        a = None
+    if a is None:
+        live = _rawliverows(codids, deleted)
+        liverows = numpy.flatnonzero(live)
+        order = numpy.argsort(codids[liverows], kind='stable')
+        a = numpy.empty((2, len(liverows) + 2), dtype='int32')
+        a[:, :2] = stamp
+        a[0, 2:] = codids[liverows[order]]
+        a[1, 2:] = liverows[order]
+        try:
+            with open(f + '.tmp', 'wb') as fp:
+                numpy.save(fp, a)
+            os.replace(f + '.tmp', f)
+        except OSError:
+            pass
+    rv = RowIndex(a[0, 2:], a[1, 2:])
+    return rv
+
+
+def writezscores(store, windows):
+    """Save z-scored PDF rows of raw storage for the specified r-windows.
+
+    The z-scored rows are centred and scaled to unit norm over the window,
+    so their Pearson correlation with similarly scaled observed PDF is
+    a plain dot product.  Rows that are constant over the window are
+    saved as NaN.  The windows are listed in the "-zscores.yml" file
+    next to the storage, which also records the row count and checksum
+    of the COD identifiers to detect a changed storage.
+
+    Parameters
+    ----------
+    store : RAWStorage
+        The raw storage.
+    windows : list
+        Pairs of (rmin, rmax) bounds of the r-windows.  Use `None`
+        for the lower or upper limit of the storage.  The upper bound
+        is excluded the same way as in the search application.
+    """
+    import zlib
+    b = os.path.splitext(store.filename)[0]
+    f = b + '-zscores.yml'
+    crc = zlib.crc32(store.codids.tobytes())
+    nrows = len(store.codids)
+    entries = {}
+    if store.zscores:
+        with open(f) as fp:
+            zcfg = yaml.safe_load(fp)
+        entries = {(w['clo'], w['chi']): w for w in zcfg['windows']}
+    rgrid = store.rgrid
+    for rmin, rmax in windows:
+        clo, chi = _rwindow(rgrid, rmin, rmax)
+        zf = '{}-zscore-{}-{}.bin'.format(b, clo, chi)
+        with open(zf + '.tmp', 'wb') as fp:
+            for lo in range(0, nrows, 1024):
+                gblock = store.gdata[lo:lo + 1024, clo:chi]
+                fp.write(_zscorerows(gblock).tobytes())
+        os.replace(zf + '.tmp', zf)
+        entries[clo, chi] = {
+            'clo' : clo, 'chi' : chi,
+            'rmin' : float(rgrid[clo]), 'rmax' : float(rgrid[chi - 1]),
+            'file' : os.path.basename(zf),
+        }
+    zcfg = {
+        'nrows' : nrows,
+        'idxcrc' : crc,
+        'dtype' : store.dtype.name,
+        'windows' : sorted(entries.values(), key=lambda w: w['clo']),
+    }
+    with open(f + '.tmp', 'w') as fp:
+        yaml.safe_dump(zcfg, fp)
+    os.replace(f + '.tmp', f)
+    store.zscores = _loadzscores(b, store.codids)
+    return
+
+
+def _rwindow(rgrid, rmin=None, rmax=None):
+    "Return index bounds of r-window same as calcbounds in the search."
+    eps = 1e-5
+    rstep = rgrid[1] - rgrid[0]
+    lb = rgrid[0] if rmin is None else max(rmin, rgrid[0])
+    ub = rgrid[-1] if rmax is None else min(rmax, rgrid[-1])
+    clo = int((lb + eps) // rstep)
+    chi = int(round(ub / rstep))
+    return clo, chi
+
+
+def _zscorerows(gblock):
+    "Return rows centred and scaled to unit norm, NaN for constant rows."
+    d = gblock - gblock.mean(axis=1, dtype=float, keepdims=True)
+    nrm = numpy.sqrt(numpy.einsum('ij,ij->i', d, d))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        rv = (d / nrm[:, numpy.newaxis]).astype(gblock.dtype)
+    rv[nrm == 0] = numpy.nan
+    return rv
+
+
+def _loadzscores(b, codids):
+    "Return dictionary of z-scored rows that match raw storage rows."
+    import zlib
+    f = b + '-zscores.yml'
+    if not os.path.isfile(f):
+        return {}
+    with open(f) as fp:
+        zcfg = yaml.safe_load(fp)
+    if (zcfg['nrows'] != len(codids) or
+            zcfg['idxcrc'] != zlib.crc32(codids.tobytes())):
+        return {}
+    rv = {}
+    topdir = os.path.dirname(f)
+    for w in zcfg['windows']:
+        shape = (zcfg['nrows'], w['chi'] - w['clo'])
+        zf = os.path.join(topdir, w['file'])
+        rv[w['clo'], w['chi']] = (
+            numpy.memmap(zf, mode='r', dtype=zcfg['dtype'], shape=shape)
+            if shape[0] else numpy.zeros(shape, dtype=zcfg['dtype']))
+    return rv
+
+
+def _readtombstones(filename, nrows):
+    "Return boolean array of rows marked in the deletion bitmap file."
+    rv = numpy.zeros(nrows, dtype=bool)
+    if os.path.isfile(filename):
+        bits = numpy.unpackbits(numpy.fromfile(filename, dtype='uint8'))
+        n = min(nrows, len(bits))
+        rv[:n] = bits[:n]
+    return rv
+
+
+def _rowchecks(gblock):
+    "Return array of crc32 checksums and validity flags for PDF rows."
+    import zlib
+    gblock = numpy.ascontiguousarray(gblock)
+    rv = numpy.zeros(len(gblock), dtype=_CHKDTYPE)
+    rv['crc'] = [zlib.crc32(g) for g in gblock]
+    finite = numpy.isfinite(gblock).all(axis=1)
+    nonzero = gblock.any(axis=1)
+    rv['flags'] = numpy.where(~finite, ROW_NONFINITE,
+                              numpy.where(nonzero, ROW_VALID, ROW_ZERO))
+    return rv
+
+
+def _rowproblem(chk, crc):
+    "Return problem name for the row checks or None if all good."
+    if crc is not None and chk['crc'] != crc:
+        return 'checksum'
+    if chk['flags'] == ROW_NONFINITE:
+        return 'nonfinite'
+    if chk['flags'] == ROW_ZERO:
+        return 'zero'
+    return None
+
+
+def _loadchecks(filename, nrows):
+    "Return row checks from the file or None if missing or incomplete."
+    if not os.path.isfile(filename):
+        return None
+    rv = numpy.fromfile(filename, dtype=_CHKDTYPE, count=nrows)
+    if len(rv) < nrows:
+        return None
+    return rv
+
+
+def _rawliverows(codids, deleted):
+    "Return boolean mask of the last non-deleted row for each COD id."
+    rows = numpy.flatnonzero(~deleted)[::-1]
+    _, first = numpy.unique(codids[rows], return_index=True)
+    rv = numpy.zeros(len(codids), dtype=bool)
+    rv[rows[first]] = True
+    return rv
+
+# ----------------------------------------------------------------------------
+
+class RAWWriter:
+    """Writer of new raw PDF storage that can be opened by RAWStorage.
+
+    The storage consists of a YAML file with "memmap" and "pdfcalculator"
+    settings and of the "idx" and "bin" files with int32 COD identifiers
+    and PDF rows.  The YAML file is updated on each `flush` so that the
+    storage is readable while it is written.  PDFs written again for the
+    same COD identifier supersede the earlier rows.  Superseded and
+    deleted rows are marked in the "del" bitmap file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the YAML file of the storage.
+    cfg : dict
+        The PDFCALCULATOR configuration.
+    dtype : str, optional
+        Data type of the PDF rows.
+    append : bool, optional
+        Append to an existing storage instead of creating a new one.
+        Any rows after the last flush of an earlier writer are discarded.
+    """
+
+    def __init__(self, filename, cfg, dtype='float32', append=False):
+        b, _ = os.path.splitext(os.path.abspath(filename))
+        self.filename = b + '.yml'
+        self.pdfcalculator = dict(cfg)
+        self.rgrid = _rawrgrid(cfg, dtype)
+        self.dtype = self.rgrid.dtype
+        self.nrows = 0
+        self.ndeleted = 0
+        self._rchecked = None
+        self._rows = {}
+        self._deleted = bytearray()
+        self._delfile = b + '.del'
+        mode = 'wb'
+        if append and os.path.isfile(self.filename):
+            self._loadrows(b)
+            mode = 'ab'
+        else:
+            for f in (self._delfile, b + '.sidx'):
+                if os.path.isfile(f):
+                    os.remove(f)
+        self._fpidx = open(b + '.idx', mode)
+        self._fpbin = open(b + '.bin', mode)
+        self._fpchk = open(b + '.chk', mode)
+        rowsize = len(self.rgrid) * self.dtype.itemsize
+        self._fpidx.truncate(self.nrows * 4)
+        self._fpbin.truncate(self.nrows * rowsize)
+        self._fpchk.truncate(self.nrows * _CHKDTYPE.itemsize)
+        self.flush()
+        return
+
+
+    def _loadrows(self, b):
+        "Load row index and deletion marks of the existing storage."
+        with open(self.filename) as fp:
+            mcfg = yaml.safe_load(fp)['memmap']
+        nrows, npts = mcfg['shape']
+        if mcfg['dtype'] != self.dtype.name or npts != len(self.rgrid):
+            emsg = "{} has incompatible PDF rows".format(self.filename)
+            raise ValueError(emsg)
+        codids = numpy.fromfile(b + '.idx', dtype='int32', count=nrows)
+        live = _rawliverows(codids, _readtombstones(self._delfile, nrows))
+        liverows = numpy.flatnonzero(live)
+        self._rows = dict(zip(codids[liverows].tolist(), liverows.tolist()))
+        self._deleted = bytearray((~live).tobytes())
+        self.nrows = nrows
+        self.ndeleted = nrows - len(liverows)
+        # add checks for storage written without them
+        if nrows and _loadchecks(b + '.chk', nrows) is None:
+            gdata = numpy.memmap(b + '.bin', mode='r', dtype=self.dtype,
+                                 shape=(nrows, npts))
+            with open(b + '.chk', 'wb') as fp:
+                for lo in range(0, nrows, 4096):
+                    fp.write(_rowchecks(gdata[lo:lo + 4096]).tobytes())
+        return
+
+
+    def writePDF(self, codid, r, g):
+        if r is not self._rchecked:
+            rgrid = self.rgrid
+            if r.shape != rgrid.shape or not numpy.allclose(r, rgrid):
+                emsg = "r must equal the rgrid of the storage"
+                raise ValueError(emsg)
+            self._rchecked = r
+        cid = numpy.int32(normcodid(codid))
+        g = numpy.asarray(g, dtype=self.dtype)
+        self._fpbin.write(g.tobytes())
+        self._fpidx.write(cid.tobytes())
+        self._fpchk.write(_rowchecks(g[numpy.newaxis]).tobytes())
+        oldrow = self._rows.get(int(cid))
+        if oldrow is not None:
+            self._deleted[oldrow] = 1
+            self.ndeleted += 1
+        self._rows[int(cid)] = self.nrows
+        self._deleted.append(0)
+        self.nrows += 1
+        return
+
+
+    def deletePDF(self, codid):
+        """Mark PDF of the specified COD entry as deleted.
+
+        Raises
+        ------
+        KeyError
+            When the COD identifier is not in the storage.
+        """
+        row = self._rows.pop(int(normcodid(codid)))
+        self._deleted[row] = 1
+        self.ndeleted += 1
+        return
+
+
+    def flush(self):
+        """Write out buffered rows and update the YAML file.
+        """
+        self._fpbin.flush()
+        self._fpidx.flush()
+        self._fpchk.flush()
+        cfg = {
+            'memmap' : {
+                'dtype' : self.dtype.name,
+                'shape' : [self.nrows, len(self.rgrid)],
+            },
+            'pdfcalculator' : self.pdfcalculator,
+        }
+        tmpfile = self.filename + '.tmp'
+        with open(tmpfile, 'w') as fp:
+            yaml.safe_dump(cfg, fp)
+        os.replace(tmpfile, self.filename)
+        # readers resolve superseded rows even with an older bitmap
+        if self.ndeleted:
+            bits = numpy.frombuffer(self._deleted, dtype='uint8')
+            tmpfile = self._delfile + '.tmp'
+            numpy.packbits(bits).tofile(tmpfile)
+            os.replace(tmpfile, self._delfile)
+        return
+
+
+    def close(self):
+        if self._fpbin.closed:
+            return
+        self.flush()
+        self._fpbin.close()
+        self._fpidx.close()
+        self._fpchk.close()
+        return
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return
+
+# end of class RAWWriter
+
+# ----------------------------------------------------------------------------
+
+class CompressedStorage:
+    """Read-only storage of PDFs compressed in blocks of rows.
+
+    The storage consists of a YAML file with "compressed" and
+    "pdfcalculator" settings, the "idx" file of int32 COD identifiers,
+    the "zbin" file with concatenated compressed blocks, the "zoff"
+    file with int64 offsets of the blocks and the "chk" file with row
+    checksums and validity flags.  Recently decoded blocks are kept
+    in a LRU cache.
+    """
+
+    def __init__(self, filename, cachesize=16):
+        from functools import lru_cache
+        b, _ = os.path.splitext(os.path.abspath(filename))
+        f = b + '.yml'
+        with open(f) as fp:
+            cfg = yaml.safe_load(fp)
+        zcfg = cfg['compressed']
+        pcfg = cfg['pdfcalculator']
+        shape = tuple(zcfg['shape'])
+        codids = numpy.fromfile(b + '.idx', dtype='int32', count=shape[0])
+        nblocks = -(-shape[0] // zcfg['blocksize'])
+        offsets = numpy.fromfile(b + '.zoff', dtype='int64',
+                                 count=nblocks + 1)
+        zdata = (numpy.memmap(b + '.zbin', mode='r', dtype='uint8')
+                 if offsets[-1] else numpy.zeros(0, dtype='uint8'))
+        rgrid = _rawrgrid(pcfg, zcfg['dtype'])
+        assert len(rgrid) == shape[1]
+        assert len(codids) == shape[0]
+        # all good here - let us assign all attributes
+        self.filename = f
+        self.pdfcalculator = pcfg
+        self.codids = codids
+        self.nrows = len(codids)
+        self.checks = _loadchecks(b + '.chk', shape[0])
+        order = numpy.argsort(codids, kind='stable').astype('int32')
+        self.index = RowIndex(codids[order], order)
+        self.shape = shape
+        self.blocksize = zcfg['blocksize']
+        self.codec = zcfg['codec']
+        self.rgrid = rgrid
+        self.dtype = rgrid.dtype
+        self._offsets = offsets
+        self._zdata = zdata
+        self._decompress = _getcodec(self.codec)[1]
+        self.getblock = lru_cache(maxsize=cachesize)(self._decodeblock)
+        return
+
+
+    def readPDF(self, codid):
+        cid = codid
+        if isinstance(cid, str):
+            cid = int(normcodid(cid))
+        row = self.index[cid]
+        bidx, k = divmod(row, self.blocksize)
+        g = self._cachedblock(bidx)[k]
+        metrics.inc('rows_read')
+        rv = (self.rgrid, g)
+        return rv
+
+
+    def readPDFs(self, codids):
+        """Read PDFs for a sequence of COD identifiers.
+
+        Returns
+        -------
+        numpy.ndarray
+            Two-dimensional array with PDF rows in the order of `codids`.
+
+        Raises
+        ------
+        KeyError
+            When some COD identifier is not in the storage.
+        """
+        cids = [int(normcodid(c)) if isinstance(c, str) else c
+                for c in codids]
+        rows = self.index.lookup(cids)
+        rv = numpy.empty((len(rows), self.shape[1]), dtype=self.dtype)
+        # decode each block only once
+        for i in numpy.argsort(rows):
+            bidx, k = divmod(rows[i], self.blocksize)
+            rv[i] = self._cachedblock(bidx)[k]
+        metrics.inc('rows_read', len(rv))
+        return rv
+
+
+    def items(self):
+        for codids, gblock in self.blocks():
+            for item in zip(codids, gblock):
+                yield item
+        pass
+
+
+    def blocks(self):
+        """Generate pairs of (codids, gblock) arrays for compressed blocks.
+
+        Rows without the ROW_VALID flag are left out.  Storage without
+        validity flags skips the all-zero rows.
+        """
+        for bidx in range(len(self._offsets) - 1):
+            lo = bidx * self.blocksize
+            gblock = self._decodeblock(bidx)
+            hi = lo + len(gblock)
+            metrics.inc('rows_scanned', len(gblock))
+            if self.checks is None:
+                keep = gblock.any(axis=1)
+            else:
+                keep = self.checks['flags'][lo:hi] == ROW_VALID
+            if keep.all():
+                yield self.codids[lo:hi], gblock
+            else:
+                yield self.codids[lo:hi][keep], gblock[keep]
+        pass
+
+
+    def verifyRows(self, lo=0, hi=None):
+        """Check decoded rows against their checksums and validity flags.
+
+        Parameters
+        ----------
+        lo, hi : int, optional
+            Range of storage rows to be checked.
+
+        Returns
+        -------
+        list
+            Pairs of (codid, problem) for the failed rows, where problem
+            is "unreadable", "checksum", "zero" or "nonfinite".
+        """
+        lo, hi, _ = slice(lo, hi).indices(self.nrows)
+        rv = []
+        for bidx in range(lo // self.blocksize,
+                          -(-hi // self.blocksize)):
+            blo = bidx * self.blocksize
+            rows = numpy.arange(max(lo, blo),
+                                min(hi, blo + self.blocksize))
+            try:
+                gblock = self._decodeblock(bidx)[rows - blo]
+            except Exception:
+                rv.extend((normcodid(c), 'unreadable')
+                          for c in self.codids[rows])
+                continue
+            crcs = [None] * len(rows)
+            if self.checks is not None:
+                crcs = self.checks['crc'][rows]
+            for row, c, crc in zip(rows, _rowchecks(gblock), crcs):
+                problem = _rowproblem(c, crc)
+                if problem:
+                    rv.append((normcodid(self.codids[row]), problem))
+        return rv
+
+
+    def _cachedblock(self, bidx):
+        "Return decoded block from the LRU cache and count cache hits."
+        if not metrics.enabled:
+            return self.getblock(bidx)
+        misses = self.getblock.cache_info().misses
+        rv = self.getblock(bidx)
+        hit = self.getblock.cache_info().misses == misses
+        metrics.inc('cache_hits' if hit else 'cache_misses')
+        return rv
+
+
+    def _decodeblock(self, bidx):
+        "Return decoded 2D array of PDF rows in the block."
+        lo, hi = self._offsets[bidx:bidx + 2]
+        nrows = min(self.blocksize, self.shape[0] - bidx * self.blocksize)
+        metrics.inc('bytes_read', int(hi - lo))
+        buf = self._decompress(self._zdata[lo:hi])
+        rv = _unshuffledelta(buf, (nrows, self.shape[1]), self.dtype)
+        return rv
+
+# end of class CompressedStorage
+
+
+class CompressedWriter:
+    """Writer of new compressed PDF storage for CompressedStorage.
+
+    Rows are compressed with the codec after integer delta encoding
+    along r and byte shuffling, which makes them very compressible
+    for smooth PDF curves.
+    """
+
+    def __init__(self, filename, cfg, blocksize=256, codec=None,
+                 dtype='float32'):
+        b, _ = os.path.splitext(os.path.abspath(filename))
+        self.filename = b + '.yml'
+        self.pdfcalculator = dict(cfg)
+        self.rgrid = _rawrgrid(cfg, dtype)
+        self.dtype = self.rgrid.dtype
+        self.blocksize = blocksize
+        self.codec = codec or DEFAULT_CODEC
+        self.nrows = 0
+        self._compress = _getcodec(self.codec)[0]
+        self._pending = []
+        self._offset = 0
+        self._rchecked = None
+        self._fpidx = open(b + '.idx', 'wb')
+        self._fpzbin = open(b + '.zbin', 'wb')
+        self._fpzoff = open(b + '.zoff', 'wb')
+        self._fpzoff.write(numpy.int64(0).tobytes())
+        self._fpchk = open(b + '.chk', 'wb')
+        return
+
+
+    def writePDF(self, codid, r, g):
+        if r is not self._rchecked:
+            rgrid = self.rgrid
+            if r.shape != rgrid.shape or not numpy.allclose(r, rgrid):
+                emsg = "r must equal the rgrid of the storage"
+                raise ValueError(emsg)
+            self._rchecked = r
+        cid = numpy.int32(normcodid(codid))
+        self._fpidx.write(cid.tobytes())
+        self._pending.append(numpy.asarray(g, dtype=self.dtype))
+        self.nrows += 1
+        if len(self._pending) == self.blocksize:
+            self._writeblock()
+        return
+
+
+    def close(self):
+        """Write the last incomplete block and the YAML file.
+        """
+        if self._fpzbin.closed:
+            return
+        if self._pending:
+            self._writeblock()
+        cfg = {
+            'compressed' : {
+                'dtype' : self.dtype.name,
+                'shape' : [self.nrows, len(self.rgrid)],
+                'blocksize' : self.blocksize,
+                'codec' : self.codec,
+            },
+            'pdfcalculator' : self.pdfcalculator,
+        }
+        for fp in (self._fpidx, self._fpzbin, self._fpzoff, self._fpchk):
+            fp.close()
+        with open(self.filename, 'w') as fp:
+            yaml.safe_dump(cfg, fp)
+        return
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return
+
+
+    def _writeblock(self):
+        gblock = numpy.array(self._pending)
+        data = self._compress(_shuffledelta(gblock))
+        self._fpchk.write(_rowchecks(gblock).tobytes())
+        self._pending = []
+        self._fpzbin.write(data)
+        self._offset += len(data)
+        self._fpzoff.write(numpy.int64(self._offset).tobytes())
+        return
+
+# end of class CompressedWriter
+
+
+def _getcodec(name):
+    "Return (compress, decompress) functions for the codec name."
+    import zlib
+    import lzma
+    from functools import partial
+    codecs = {
+        'zlib' : (partial(zlib.compress, level=1), zlib.decompress),
+        'lzma' : (lzma.compress, lzma.decompress),
+    }
+    try:
+        from compression import zstd
+        codecs['zstd'] = (zstd.compress, zstd.decompress)
+    except ImportError:
+        pass
+    return codecs[name]
+
+
+def _shuffledelta(a):
+    """Return bytes of 2D array with delta encoded rows and shuffled.
+
+    The rows are delta encoded as unsigned integers of the same size
+    as the array items.
+    """
+    n = a.dtype.itemsize
+    u = a.view('u{}'.format(n))
+    d = u.copy()
+    d[:, 1:] -= u[:, :-1]
+    rv = d.view('uint8').reshape(-1, n).T.tobytes()
+    return rv
+
+
+def _unshuffledelta(buf, shape, dtype):
+    "Inverse of _shuffledelta, return array of dtype and shape."
+    dtype = numpy.dtype(dtype)
+    n = dtype.itemsize
+    utype = 'u{}'.format(n)
+    b = numpy.frombuffer(buf, dtype='uint8').reshape(n, -1)
+    d = b.T.copy().view(utype).reshape(shape)
+    rv = numpy.cumsum(d, axis=1, dtype=utype).view(dtype)
+    return rv
+
+
+DEFAULT_CODEC = 'zlib'
+try:
+    from compression import zstd
+    DEFAULT_CODEC = 'zstd'
+    del zstd
+except ImportError:
+    pass
+
+# ----------------------------------------------------------------------------
+
+class PeakStorage:
+    """Storage of weighted pair distance histograms of COD structures.
+
+    The PDFs are rendered from the pair distances at query time so that
+    the r-grid and Gaussian peak width can be changed without a new
+    calculation.  The storage is written with PeakWriter and consists
+    of a YAML file with "peaks" and "pdfcalculator" settings and of the
+    "idx", "cnt", "pos", "wt" and "rho" files with int32 COD identifiers,
+    int32 peak counts, uint32 positions in units of resolution, float32
+    weights and float64 number densities.
+
+    Attributes
+    ----------
+    resolution : float
+        Bin width of the pair distances in A.
+    rgrid : numpy.ndarray
+        The r-grid of rendered PDFs.
+    fwhm : float
+        Full width at half maximum of the rendered Gaussian peaks.
+    """
+
+    def __init__(self, filename):
+        b, _ = os.path.splitext(os.path.abspath(filename))
+        f = b + '.yml'
+        with open(f) as fp:
+            cfg = yaml.safe_load(fp)
+        kcfg = cfg['peaks']
+        pcfg = cfg['pdfcalculator']
+        n = kcfg['count']
+        codids = numpy.fromfile(b + '.idx', dtype='int32', count=n)
+        counts = numpy.fromfile(b + '.cnt', dtype='int32', count=n)
+        offsets = numpy.zeros(n + 1, dtype='int64')
+        numpy.cumsum(counts, out=offsets[1:])
+        mm = lambda ext, dt: (
+            numpy.memmap(b + ext, mode='r', dtype=dt, shape=(offsets[-1],))
+            if offsets[-1] else numpy.zeros(0, dtype=dt))
+        self.filename = f
+        self.pdfcalculator = pcfg
+        self.resolution = kcfg['resolution']
+        self.codids = codids
+        order = numpy.argsort(codids, kind='stable').astype('int32')
+        self.index = RowIndex(codids[order], order)
+        self.numdensity = numpy.fromfile(b + '.rho', dtype=float, count=n)
+        self._offsets = offsets
+        self._positions = mm('.pos', 'uint32')
+        self._weights = mm('.wt', 'float32')
+        self.setRendering()
+        return
+
+
+    def setRendering(self, uisowidth=None, rmin=None, rmax=None, rstep=None):
+        """Change r-grid or peak width of the rendered PDFs.
+
+        The unspecified values are taken from the PDFCALCULATOR
+        configuration of the storage.
+        """
+        pcfg = dict(self.pdfcalculator)
+        kw = dict(uisowidth=uisowidth, rmin=rmin, rmax=rmax, rstep=rstep)
+        pcfg.update((n, v) for n, v in kw.items() if v is not None)
+        self.rgrid, self.fwhm, self.scale = rendersetup(pcfg)
+        self.dtype = self.rgrid.dtype
+        return
+
+
+    def readPeaks(self, codid):
+        """Return pair distances, weights and number density of COD entry.
+        """
+        cid = codid
+        if isinstance(cid, str):
+            cid = int(normcodid(cid))
+        row = self.index[cid]
+        lo, hi = self._offsets[row:row + 2]
+        r = self._positions[lo:hi] * self.resolution
+        rv = (r, numpy.asarray(self._weights[lo:hi]), self.numdensity[row])
+        return rv
+
+
+    def readPDF(self, codid):
+        cid = codid
+        if isinstance(cid, str):
+            cid = int(normcodid(cid))
+        g = self._render([self.index[cid]])[0]
+        rv = (self.rgrid, g)
+        return rv
+
+
+    def readPDFs(self, codids):
+        """Render PDFs for a sequence of COD identifiers.
+
+        Returns
+        -------
+        numpy.ndarray
+            Two-dimensional array with PDF rows in the order of `codids`.
+
+        Raises
+        ------
+        KeyError
+            When some COD identifier is not in the storage.
+        """
+        cids = [int(normcodid(c)) if isinstance(c, str) else c
+                for c in codids]
+        rows = self.index.lookup(cids)
+        rv = self._render(rows)
+        return rv
+
+
+    def items(self):
+        for codids, gblock in self.blocks():
+            for item in zip(codids, gblock):
+                yield item
+        pass
+
+
+    def blocks(self, blocksize=256):
+        """Generate pairs of (codids, gblock) arrays of rendered PDFs.
+
+        Entries without any pair distances are left out.
+        """
+        nonempty = numpy.flatnonzero(numpy.diff(self._offsets))
+        for lo in range(0, len(nonempty), blocksize):
+            rows = nonempty[lo:lo + blocksize]
+            yield self.codids[rows], self._render(rows)
+        pass
+
+
+    def _render(self, rows):
+        "Return rendered PDFs for the storage rows."
+        rows = numpy.asarray(rows, dtype=int)
+        lo = self._offsets[rows]
+        cnt = self._offsets[rows + 1] - lo
+        # flat indices of all peaks in the selected rows
+        rowofpeak = numpy.repeat(numpy.arange(len(rows)), cnt)
+        start = numpy.repeat(lo - numpy.cumsum(cnt) + cnt, cnt)
+        idx = start + numpy.arange(cnt.sum())
+        r = self._positions[idx] * self.resolution
+        rv = renderpeaks(rowofpeak, r, self._weights[idx],
+                         self.numdensity[rows], self.rgrid, self.fwhm,
+                         nrows=len(rows), scale=self.scale)
+        return rv
+
+# end of class PeakStorage
+
+
+class PeakWriter:
+    """Writer of pair distance histograms that can be opened by PeakStorage.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the YAML file of the storage.
+    cfg : dict
+        The PDFCALCULATOR configuration used for the default rendering.
+    resolution : float, optional
+        Bin width of the pair distances in A.
+    """
+
+    def __init__(self, filename, cfg, resolution=0.001):
+        b, _ = os.path.splitext(os.path.abspath(filename))
+        self.filename = b + '.yml'
+        self.pdfcalculator = dict(cfg)
+        self.resolution = resolution
+        self.count = 0
+        self._fps = {ext: open(b + ext, 'wb')
+                     for ext in ('.idx', '.cnt', '.pos', '.wt', '.rho')}
+        self.flush()
+        return
+
+
+    def writePeaks(self, codid, r, w, numdensity):
+        """Add pair distances and weights of a COD structure.
+
+        Parameters
+        ----------
+        codid : str or int
+            The COD identifier.
+        r : numpy.ndarray
+            Pair distances, which are binned to the storage resolution.
+        w : numpy.ndarray
+            Weights of the pairs normalized per atom in the unit cell.
+        numdensity : float
+            Number density of atoms in 1/A**3.
+        """
+        k = numpy.round(numpy.asarray(r) / self.resolution).astype('uint32')
+        bins, inv = numpy.unique(k, return_inverse=True)
+        weights = numpy.bincount(inv.ravel(), weights=w, minlength=len(bins))
+        cid = numpy.int32(normcodid(codid))
+        self._fps['.idx'].write(cid.tobytes())
+        self._fps['.cnt'].write(numpy.int32(len(bins)).tobytes())
+        self._fps['.pos'].write(bins.tobytes())
+        self._fps['.wt'].write(weights.astype('float32').tobytes())
+        self._fps['.rho'].write(numpy.float64(numdensity).tobytes())
+        self.count += 1
+        return
+
+
+    def flush(self):
+        """Write out buffered entries and update the YAML file.
+        """
+        for fp in self._fps.values():
+            fp.flush()
+        cfg = {
+            'peaks' : {
+                'count' : self.count,
+                'resolution' : self.resolution,
+            },
+            'pdfcalculator' : self.pdfcalculator,
+        }
+        tmpfile = self.filename + '.tmp'
+        with open(tmpfile, 'w') as fp:
+            yaml.safe_dump(cfg, fp)
+        os.replace(tmpfile, self.filename)
+        return
+
+
+    def close(self):
+        if self._fps['.idx'].closed:
+            return
+        self.flush()
+        for fp in self._fps.values():
+            fp.close()
+        return
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return
+
+# end of class PeakWriter
+
+
+def pairpeaks(stru, sft, rmax):
+    """Return weighted pair distances of a structure for PDF rendering.
+
+    The pairs are enumerated with diffpy BondCalculator.  The weights
+    are f_i f_j / <f>**2 times site occupancies normalized per atom
+    in the unit cell, the same as for the total scattering PDF.
+
+    Parameters
+    ----------
+    stru : diffpy.structure.Structure
+        Atoms in the unit cell.
+    sft : ScatteringFactorTable or list
+        Table of atom scattering factors at Q = 0.  When a list
+        of tables, evaluate weights for each of them from the same
+        pair enumeration.
+    rmax : float
+        Maximum pair distance.
+
+    Returns
+    -------
+    r : numpy.ndarray
+        The pair distances.
+    w : numpy.ndarray or list
+        The pair weights or a list of weights per each table.
+    numdensity : float
+        The number density of atoms in 1/A**3.
+    """
+    from diffpy.srreal.bondcalculator import BondCalculator
+    bc = BondCalculator(rmax=rmax)
+    bc.eval(stru)
+    occ = numpy.array([a.occupancy for a in stru], dtype=float)
+    natoms = occ.sum()
+    i, j = bc.sites0, bc.sites1
+    oo = occ[i] * occ[j] / natoms
+
+    def weights(tb):
+        sf = numpy.array([tb.lookup(a.element) for a in stru], dtype=float)
+        favg = numpy.dot(occ, sf) / natoms
+        return oo * sf[i] * sf[j] / favg ** 2
+
+    w = ([weights(tb) for tb in sft] if isinstance(sft, (list, tuple))
+         else weights(sft))
+    numdensity = natoms / stru.lattice.volume
+    return bc.distances, w, numdensity
+
+
+def rendersetup(cfg):
+    """Return r-grid, peak FWHM and scale for rendering PDFs.
+
+    Parameters
+    ----------
+    cfg : dict
+        The PDFCALCULATOR configuration with constant peak width.
+
+    Returns
+    -------
+    rgrid : numpy.ndarray
+        The float32 r-grid from "rmin", "rmax" and "rstep".
+    fwhm : float
+        Full width at half maximum from the "uisowidth".
+    scale : float
+        The PDF scale factor.
+    """
+    rgrid = _rawrgrid(cfg, 'float32')
+    fwhm = uisotofwhm(cfg['uisowidth'])
+    scale = cfg.get('scale', 1.0)
+    return rgrid, fwhm, scale
+
+
+def radiationpath(filename, radiation):
+    """Return storage path for the specified radiation type.
+
+    Insert the radiation name, e.g., "xray" or "neutron", before the
+    filename extension.  Return filename unchanged if radiation is None.
+    """
+    if not radiation:
+        return filename
+    b, e = os.path.splitext(filename)
+    rv = '{}-{}{}'.format(b, radiation, e)
+    return rv
+
+
+def renderpeaks(rowofpeak, r, w, numdensity, rgrid, fwhm,
+                nrows=None, scale=1.0):
+    """Render PDFs from weighted pair distances of several structures.
+
+    The weights are split to the two nearest points of an extended
+    r-grid, convolved with a Gaussian by FFT and converted to
+    G = scale * (R / r - 4 pi rho r).
+
+    Parameters
+    ----------
+    rowofpeak : numpy.ndarray
+        Output row index for each pair distance.
+    r, w : numpy.ndarray
+        The pair distances and their weights.
+    numdensity : numpy.ndarray
+        Number density of each output row.
+    rgrid : numpy.ndarray
+        Equidistant r-grid of the rendered PDFs.
+    fwhm : float
+        Full width at half maximum of the Gaussian peaks.
+    nrows : int, optional
+        Number of output rows, by default the length of `numdensity`.
+    scale : float, optional
+        Scale factor of the PDFs.
+
+    Returns
+    -------
+    numpy.ndarray
+        Two-dimensional array of PDFs with the dtype of `rgrid`.
+    """
+    if nrows is None:
+        nrows = len(numdensity)
+    npts = len(rgrid)
+    dr = float(rgrid[1] - rgrid[0])
+    sigma = fwhm / _GAUSS_SIGMA_TO_FWHM
+    npad = int(math.ceil(5 * sigma / dr)) + 1
+    nx = npts + 2 * npad
+    x = (r - rgrid[0]) / dr + npad
+    i0 = numpy.floor(x).astype(int)
+    frac = x - i0
+    keep = (i0 >= 0) & (i0 < nx - 1)
+    i0, frac, w1 = i0[keep], frac[keep], w[keep]
+    flat = rowofpeak[keep] * nx + i0
+    hist = numpy.bincount(flat, weights=w1 * (1 - frac),
+                          minlength=nrows * nx)
+    hist += numpy.bincount(flat + 1, weights=w1 * frac,
+                           minlength=nrows * nx)
+    hist = hist.reshape(nrows, nx)
+    # circular Gaussian kernel, the wrap-around ends up in the padding
+    m = numpy.minimum(numpy.arange(nx), nx - numpy.arange(nx))
+    kernel = numpy.exp(-0.5 * (m * dr / sigma) ** 2)
+    kernel /= math.sqrt(2 * math.pi) * sigma
+    rdf = numpy.fft.irfft(numpy.fft.rfft(hist, axis=1) *
+                          numpy.fft.rfft(kernel), n=nx, axis=1)
+    rdf = rdf[:, npad:npad + npts]
+    rr = rgrid.astype(float)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        gr = numpy.where(rr > 0, rdf / rr, 0.0)
+    gr -= 4 * math.pi * numpy.outer(numdensity, rr)
+    rv = (scale * gr).astype(rgrid.dtype)
+    return rv
+
+
+def estimatedensity(r, g, rmax=1.0):
+    """Estimate atom number density from the low-r slope of a PDF.
+
+    Below the nearest-neighbor distance the PDF follows the baseline
+    G = -4 pi rho r.  The density is obtained from a least-squares line
+    through the origin for points at ``0 < r <= rmax``.  The estimate
+    is proportional to the PDF scale and should be compared with
+    a generous tolerance for experimental data.
+
+    Parameters
+    ----------
+    r, g : numpy.ndarray
+        The PDF r-grid and G values.
+    rmax : float, optional
+        Upper bound of the baseline region in A.
+
+    Returns
+    -------
+    float or None
+        The number density in 1/A**3 or `None` when there are no
+        points in the baseline region.
+    """
+    r = numpy.asarray(r, dtype=float)
+    g = numpy.asarray(g, dtype=float)
+    sel = (r > 0) & (r <= rmax)
+    if not sel.any():
+        return None
+    r1 = r[sel]
+    slope = r1.dot(g[sel]) / r1.dot(r1)
+    rv = -slope / (4 * math.pi)
+    return rv
+
+# ----------------------------------------------------------------------------
+
+class ShardedStorage:
+    """Read-only PDF storage split into several raw or compressed shards.
+
+    The storage is defined by a YAML manifest with a "sharded" item that
+    lists the shard files relative to the manifest together with their
+    "codidmin" and "codidmax" bounds.  The shards must have the same
+    r-grid.  Any shard can be rebuilt and swapped in independently by
+    updating its entry in the manifest.
+    """
+
+    def __init__(self, filename):
+        f = os.path.abspath(filename)
+        with open(f) as fp:
+            cfg = yaml.safe_load(fp)
+        topdir = os.path.dirname(f)
+        entries = cfg['sharded']['shards']
+        shards = [openstorage(os.path.join(topdir, e['file']))
+                  for e in entries]
+        rgrid = shards[0].rgrid
+        for st in shards:
+            r = st.rgrid
+            if r.shape != rgrid.shape or not numpy.allclose(r, rgrid):
+                emsg = "{} has incompatible r-grid".format(st.filename)
+                raise ValueError(emsg)
+        self.filename = f
+        self.pdfcalculator = shards[0].pdfcalculator
+        self.shards = shards
+        self.bounds = [(e['codidmin'], e['codidmax']) for e in entries]
+        self.rgrid = rgrid
+        self.dtype = rgrid.dtype
+        return
+
+
+    def readPDF(self, codid):
+        cid = codid
+        if isinstance(cid, str):
+            cid = int(normcodid(cid))
+        for st in self._candidates(cid):
+            if cid in st.index:
+                return st.readPDF(cid)
+        raise KeyError(codid)
+
+
+    def readPDFs(self, codids):
+        """Read PDFs for a sequence of COD identifiers.
+
+        Returns
+        -------
+        numpy.ndarray
+            Two-dimensional array with PDF rows in the order of `codids`.
+
+        Raises
+        ------
+        KeyError
+            When some COD identifier is not in the storage.
+        """
+        cids = [int(normcodid(c)) if isinstance(c, str) else c
+                for c in codids]
+        rv = numpy.empty((len(cids), len(self.rgrid)), dtype=self.dtype)
+        for i in numpy.argsort(cids, kind='stable'):
+            rv[i] = self.readPDF(cids[i])[1]
+        return rv
+
+
+    def items(self):
+        for st in self.shards:
+            for item in st.items():
+                yield item
+        pass
+
+
+    def blocks(self):
+        for st in self.shards:
+            for item in st.blocks():
+                yield item
+        pass
+
+
+    def _candidates(self, cid):
+        "Generate shards with bounds that contain the COD id."
+        for (lo, hi), st in zip(self.bounds, self.shards):
+            if lo <= cid <= hi:
+                yield st
+        pass
+
+# end of class ShardedStorage
+
+
+def writemanifest(filename, shardfiles):
+    """Write YAML manifest of ShardedStorage for existing shard files.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the manifest file to be written.
+    shardfiles : list
+        Paths to the YAML files of raw or compressed shards.
+        Shard paths are saved relative to the manifest.
+    """
+    topdir = os.path.dirname(os.path.abspath(filename))
+    entries = []
+    for f in shardfiles:
+        st = openstorage(f)
+        codids = st.codids
+        entries.append({
+            'file' : os.path.relpath(st.filename, topdir),
+            'codidmin' : int(codids.min()) if len(codids) else 0,
+            'codidmax' : int(codids.max()) if len(codids) else 0,
+        })
+    entries.sort(key=lambda e: e['codidmin'])
+    cfg = {'sharded' : {'shards' : entries}}
+    with open(filename, 'w') as fp:
+        yaml.safe_dump(cfg, fp)
+    return
+
+
+def openstorage(filename):
+    """Open PDF storage of a type determined from the file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to HDF5 file or to YAML file of raw, compressed,
+        peak or sharded storage.
+
+    Returns
+    -------
+    HDFStorage, RAWStorage, CompressedStorage, PeakStorage
+        or ShardedStorage
+    """
+    b, e = os.path.splitext(filename)
+    if e in ('.h5', '.hdf', '.hdf5'):
+        return HDFStorage(filename)
+    f = b + '.yml'
+    with open(f) as fp:
+        cfg = yaml.safe_load(fp)
+    if 'sharded' in cfg:
+        return ShardedStorage(f)
+    if 'compressed' in cfg:
+        return CompressedStorage(f)
+    if 'peaks' in cfg:
+        return PeakStorage(f)
+    return RAWStorage(f)
+
 # Helper functions -----------------------------------------------------------
 
+def estimatecost(natoms, volume, rmax):
+    """Estimate relative cost of PDF calculation for a periodic structure.
+
+    The real-space PDF calculator sums over all atom pairs within `rmax`
+    and the number of such pairs scales as ``natoms**2 * rmax**3 / volume``.
+
+    Parameters
+    ----------
+    natoms : int
+        Number of atoms in the unit cell.
+    volume : float
+        Unit cell volume in A**3.
+    rmax : float
+        Upper bound of the calculated PDF in A.
+
+    Returns
+    -------
+    float
+        Approximate number of atom pairs in the PDF summation.
+        Return `inf` when the cost cannot be estimated.
+    """
+    if not natoms or not volume or not volume > 0:
+        return math.inf
+    sphere = 4.0 / 3.0 * math.pi * rmax ** 3
+    rv = natoms * (1 + natoms * sphere / volume)
+    return rv
+
+
+def cifsizeinfo(filename):
+    """Return atom count and cell volume from a CIF file.
+
+    This is a cheap line-based scan of the CIF file, which does not
+    expand the asymmetric unit.  The atom count is obtained from the
+    formula sum and the number of formula units in the cell.  When these
+    are not available, use the number of atom sites times the number of
+    symmetry operations, which overestimates structures with atoms at
+    special positions.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the CIF file.
+
+    Returns
+    -------
+    natoms : int
+        Upper bound of atoms in the unit cell or 0 if not available.
+        The smaller of the two counts is used when both are available.
+    volume : float or None
+        Unit cell volume in A**3 or `None` if not available.
+    """
+    from cifpdfsearch._utils import tofloat, cifcellvolume
+    with open(filename, errors='replace') as fp:
+        lines = fp.read().splitlines()
+    values = {}
+    loopsizes = {}
+    tags = []
+    ntokens = 0
+    inloop = intext = False
+    for line in lines + ['loop_']:
+        if intext:
+            intext = not line.startswith(';')
+            continue
+        if line.startswith(';'):
+            intext = True
+            ntokens += 1
+            continue
+        words = _rxcifword.findall(line)
+        if not words or words[0].startswith('#'):
+            continue
+        w0 = words[0].lower()
+        isdata = not (w0.startswith('_') or w0 == 'loop_' or
+                      w0.startswith('data_'))
+        if inloop and isdata:
+            ntokens += len(words)
+            continue
+        if inloop and not isdata and ntokens:
+            nrows = ntokens // len(tags)
+            loopsizes.update(dict.fromkeys(tags, nrows))
+            inloop = False
+        if w0 == 'loop_':
+            inloop = True
+            tags = []
+            ntokens = 0
+        elif inloop and w0.startswith('_'):
+            tags.append(w0)
+        elif w0.startswith('_') and len(words) > 1:
+            values[w0] = words[1]
+    nsites = loopsizes.get('_atom_site_fract_x', 0)
+    nsymops = max(loopsizes.get('_symmetry_equiv_pos_as_xyz', 0),
+                  loopsizes.get('_space_group_symop_operation_xyz', 0), 1)
+    natoms = nsites * nsymops
+    try:
+        z = tofloat(values['_cell_formula_units_z'])
+        formula = values['_chemical_formula_sum'].strip('\'"')
+        nformula = sum(float(n or 1) for n in _rxelcount.findall(formula))
+        nformulaatoms = int(math.ceil(z * nformula))
+        if nformulaatoms > 0:
+            natoms = (min(natoms, nformulaatoms) if natoms > 0
+                      else nformulaatoms)
+    except (KeyError, TypeError, ValueError):
+        pass
+    volume = None
+    try:
+        volume = tofloat(values['_cell_volume'])
+    except (KeyError, ValueError):
+        pass
+    if not volume or math.isnan(volume):
+        volume = cifcellvolume(values)
+    return natoms, volume
+
+_rxelcount = re.compile(r'[A-Z][a-z]?(\d*\.?\d*)')
+_rxcifword = re.compile(r"'[^']*'(?!\S)|\"[^\"]*\"(?!\S)|\S+")
+
+
+def cifcost(filename, rmax):
+    """Estimate relative cost of PDF calculation for a CIF file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the CIF file.
+    rmax : float
+        Upper bound of the calculated PDF in A.
+
+    Returns
+    -------
+    float
+        Approximate number of atom pairs in the PDF summation
+        or `inf` when the CIF file cannot be analyzed.
+    """
+    try:
+        natoms, volume = cifsizeinfo(filename)
+    except OSError:
+        return math.inf
+    return estimatecost(natoms, volume, rmax)
+
+
 _GAUSS_SIGMA_TO_FWHM = 2 * math.sqrt(2 * math.log(2))
 
 def uisotofwhm(uiso):
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+'''
+Incremental scanner of CIF files in the local COD mirror.
+
+The COD tree has CIF files in directories such as ``cif/1/00/00/``.
+A snapshot keeps the modification time of every directory and the
+size and modification time of its CIF files.  A directory listing
+changes its modification time, therefore later scans stat only the
+directories and list just those that were modified.  This detects CIF
+files added, deleted or replaced by rsync, which renames its temporary
+files.  Files rewritten in place, e.g., with ``rsync --inplace``, are
+found only with a full scan.
+'''
+
+import os
+import json
+
+
+def gencodfiles(top):
+    """Generate sorted paths to CIF files in the COD cif directory.
+
+    Parameters
+    ----------
+    top : str
+        Path to the "cif" directory of the COD mirror.
+
+    Yields
+    ------
+    str
+        Absolute paths to CIF files.
+    """
+    for reldir, names, dirnames in _genlistings(top):
+        d = os.path.join(top, reldir)
+        for f in names:
+            yield os.path.join(d, f)
+    pass
+
+
+class CODScanner:
+    """Incremental scanner of the COD cif directory with a snapshot file.
+
+    Attributes
+    ----------
+    top : str
+        Path to the "cif" directory of the COD mirror.
+    snapshotfile : str
+        Path to the JSON snapshot file, may be `None`.
+    snapshot : dict
+        Snapshot data as {reldir : [mtime_ns, {name : [size, mtime_ns]},
+        subdirs]} for all directories relative to `top`.
+    counts : dict
+        Number of listed and unchanged directories in the last scan.
+    """
+
+    def __init__(self, top, snapshotfile=None):
+        self.top = os.path.abspath(top)
+        self.snapshotfile = snapshotfile
+        self.snapshot = {}
+        self.counts = dict(listed=0, unchanged=0)
+        if snapshotfile and os.path.isfile(snapshotfile):
+            with open(snapshotfile) as fp:
+                data = json.load(fp)
+            if data.get('top') == self.top:
+                self.snapshot = data['directories']
+        return
+
+
+    def scan(self, full=False):
+        """Generate changes of CIF files since the last snapshot.
+
+        The in-memory snapshot is updated after the generator completes.
+
+        Parameters
+        ----------
+        full : bool, optional
+            List and stat all directories regardless of their
+            modification times.
+
+        Yields
+        ------
+        tuple
+            The (status, path) pairs, where status is "added",
+            "modified" or "deleted" and path is absolute.  All files
+            are reported as added when there is no snapshot.
+        """
+        old = self.snapshot
+        new = {}
+        self.counts = dict(listed=0, unchanged=0)
+        pending = ['']
+        while pending:
+            reldir = pending.pop()
+            d = os.path.join(self.top, reldir)
+            try:
+                mtime = os.stat(d).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            prev = old.get(reldir)
+            if prev is not None and prev[0] == mtime and not full:
+                self.counts['unchanged'] += 1
+                new[reldir] = prev
+                pending.extend(reversed(prev[2]))
+                continue
+            self.counts['listed'] += 1
+            files, subdirs = _listdirectory(self.top, reldir)
+            new[reldir] = [mtime, files, subdirs]
+            prevfiles = prev[1] if prev else {}
+            for f in sorted(files):
+                pf = prevfiles.get(f)
+                if pf is None:
+                    yield 'added', os.path.join(d, f)
+                elif pf != files[f]:
+                    yield 'modified', os.path.join(d, f)
+            for f in sorted(set(prevfiles).difference(files)):
+                yield 'deleted', os.path.join(d, f)
+            gone = set(prev[2] if prev else ()).difference(subdirs)
+            for rd in sorted(gone):
+                for path in self._gensnapshotfiles(old, rd):
+                    yield 'deleted', path
+            pending.extend(reversed(subdirs))
+        self.snapshot = new
+        return
+
+
+    def save(self, filename=None):
+        "Save the snapshot to filename or to the snapshotfile."
+        filename = filename or self.snapshotfile
+        data = {'top' : self.top, 'directories' : self.snapshot}
+        tmp = filename + '.part'
+        with open(tmp, 'w') as fp:
+            json.dump(data, fp, separators=(',', ':'))
+        os.replace(tmp, filename)
+        return
+
+
+    def _gensnapshotfiles(self, snapshot, reldir):
+        "Generate paths of all files under reldir in the snapshot."
+        entry = snapshot.get(reldir)
+        if entry is None:
+            return
+        d = os.path.join(self.top, reldir)
+        for f in sorted(entry[1]):
+            yield os.path.join(d, f)
+        for sd in entry[2]:
+            for path in self._gensnapshotfiles(snapshot, sd):
+                yield path
+        return
+
+# end of class CODScanner
+
+# Local Helpers --------------------------------------------------------------
+
+def _genlistings(top):
+    "Generate sorted (reldir, cifnames, subdirs) for the COD cif tree."
+    pending = ['']
+    while pending:
+        reldir = pending.pop()
+        files, subdirs = _listdirectory(top, reldir, withstat=False)
+        yield reldir, sorted(files), subdirs
+        pending.extend(reversed(subdirs))
+    pass
+
+
+def _listdirectory(top, reldir, withstat=True):
+    """Return CIF files and sorted subdirectories of top/reldir.
+
+    CIF files are returned as dictionary of {name : [size, mtime_ns]}.
+    Subdirectories are relative to the top directory.  Only the
+    single-digit subdirectories are used in the top directory.
+    """
+    files = {}
+    subdirs = []
+    istop = (reldir == '')
+    with os.scandir(os.path.join(top, reldir)) as entries:
+        for e in entries:
+            if e.is_dir():
+                if istop and not (len(e.name) == 1 and e.name.isdigit()):
+                    continue
+                subdirs.append(os.path.join(reldir, e.name))
+            elif not istop and e.name.endswith('.cif'):
+                st = e.stat() if withstat else None
+                files[e.name] = st and [st.st_size, st.st_mtime_ns]
+    subdirs.sort()
+    return files, subdirs
+
@@ -7,6 +7,9 @@ The recommended way to change these constants is to copy
 "config/cifpdfsearch.yml.template" to "config/cifpdfsearch.aml"
 and edit the site settings as needed.
 
+The configuration is loaded on the first access to its constants
+unless `initialize` was called before with an explicit file.
+
 Attributes
 ----------
 CODDIR : str
@@ -18,15 +21,21 @@ __all__ = ["CODDIR", "PDFSTORAGE", "PDFCALCULATOR", "loadConfig"]
 
 from warnings import warn
 from os.path import expanduser, abspath, join as pathjoin
-from xdg.BaseDirectory import load_first_config, xdg_config_dirs
-import yaml
 import cifpdfsearch
 
 # Configuration constants ----------------------------------------------------
 
-CODDIR = ''
-PDFSTORAGE = ''
-PDFCALCULATOR = {}
+# CODDIR, PDFSTORAGE and PDFCALCULATOR are defined by initialize.
+_CONFIGNAMES = ('CODDIR', 'PDFSTORAGE', 'PDFCALCULATOR')
+
+
+def __getattr__(name):
+    "Load the default configuration on the first access to its constants."
+    if name in _CONFIGNAMES:
+        initialize()
+        return globals()[name]
+    emsg = "module {!r} has no attribute {!r}".format(__name__, name)
+    raise AttributeError(emsg)
 
 
 def loadConfig(cfgfile):
@@ -43,14 +52,23 @@ def loadConfig(cfgfile):
     cfg : dict
         Dictionary of configuration values.
     """
+    import yaml
     with open(cfgfile) as fp:
         cfg = yaml.safe_load(fp)
     return cfg
 
 
 def initialize(cfgfile=None):
+    global CODDIR
+    global PDFSTORAGE
+    global PDFCALCULATOR
+    # define the constants on the first call
+    CODDIR = globals().get('CODDIR', '')
+    PDFSTORAGE = globals().get('PDFSTORAGE', '')
+    PDFCALCULATOR = globals().get('PDFCALCULATOR', {})
     cfname = 'cifpdfsearch/cifpdfsearch.yml'
     if cfgfile is None:
+        from xdg.BaseDirectory import load_first_config, xdg_config_dirs
         cfgfile = load_first_config(cfname)
         if cfgfile is None:
             cf = pathjoin(xdg_config_dirs[0], cfname)
@@ -60,13 +78,8 @@ def initialize(cfgfile=None):
             warn(wmsg)
             return
     cfg = loadConfig(cfgfile)
-    global CODDIR
-    global PDFSTORAGE
     CODDIR = abspath(expanduser(cfg['coddir']))
     PDFSTORAGE = abspath(expanduser(cfg.get('pdfstorage', '')))
     PDFCALCULATOR.clear()
     PDFCALCULATOR.update(cfg.get('pdfcalculator', {}))
     return
-
-
-initialize()
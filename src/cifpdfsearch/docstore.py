@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+'''
+Local SQLite store of CIF documents for offline searches.
+
+The store holds documents from `cifdocument` in a table with an indexed
+column for every CIFDOCMAP field and the number of elements.  The
+normalized compositions are kept in a separate table indexed by element
+and fraction, so that term, range and composition queries are resolved
+from indexes without a search server.
+
+Queries are given as a small subset of the Lucene syntax that is used
+with Elastic Search, for example::
+
+    spacegroup:"F m -3 m" AND a:[5 TO 6] AND nel:2
+'''
+
+import re
+import json
+import sqlite3
+
+from cifpdfsearch.metrics import metrics
+
+# Document fields stored in columns with their SQL types.
+NUMERICFIELDS = ('a', 'b', 'c', 'alpha', 'beta', 'gamma', 'volume', 'nel',
+                 'numdensity')
+TEXTFIELDS = ('formula', 'mineralname', 'spacegroup', 'spacegrouphall')
+
+
+class DocStore:
+    """SQLite store of CIF documents with indexed query fields.
+
+    Attributes
+    ----------
+    filename : str
+        Path to the SQLite database file.
+    connection : sqlite3.Connection
+        The open database connection.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self._createtables()
+        return
+
+
+    def __len__(self):
+        cur = self.connection.execute('SELECT COUNT(*) FROM docs')
+        return cur.fetchone()[0]
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return
+
+
+    def close(self):
+        "Commit pending changes and close the database."
+        self.connection.commit()
+        self.connection.close()
+        return
+
+
+    def addDocuments(self, pairs, chunk=1000):
+        """Add or replace documents in the store.
+
+        Parameters
+        ----------
+        pairs : iterable
+            The (codid, doc) pairs, where `doc` is from `cifdocument`.
+        chunk : int, optional
+            Number of documents inserted per transaction.
+
+        Returns
+        -------
+        int
+            The number of added documents.
+        """
+        from cifpdfsearch._utils import grouper
+        columns = ('codid',) + NUMERICFIELDS + TEXTFIELDS + ('doc',)
+        sqldoc = 'INSERT OR REPLACE INTO docs ({}) VALUES ({})'.format(
+            ', '.join(columns), ', '.join(len(columns) * '?'))
+        sqldel = 'DELETE FROM composition WHERE codid = ?'
+        sqlcmp = 'INSERT INTO composition VALUES (?, ?, ?)'
+        rv = 0
+        con = self.connection
+        for grp in grouper(pairs, chunk):
+            rows = [(int(codid),) +
+                    tuple(doc.get(n) for n in NUMERICFIELDS + TEXTFIELDS) +
+                    (json.dumps(doc, sort_keys=True),)
+                    for codid, doc in grp]
+            crows = [(int(codid), smbl, x)
+                     for codid, doc in grp
+                     for smbl, x in doc.get('composition', {}).items()]
+            with con:
+                con.executemany(sqldel, [r[:1] for r in rows])
+                con.executemany(sqldoc, rows)
+                con.executemany(sqlcmp, crows)
+            rv += len(rows)
+        return rv
+
+
+    def search(self, q=None, composition=None, tol=None, fields=None):
+        """Find CIF documents by a query string or composition.
+
+        The interface follows the `cifsearch` function.
+
+        Parameters
+        ----------
+        q : str, optional
+            Query in the Lucene syntax subset of `parsequery`.
+        composition : str, optional
+            Normalized chemical stoichiometry to be matched.
+        tol : float, optional
+            Maximum allowed difference from stoichiometry.
+        fields : list or str, optional
+            Name of CIF fields to be returned.
+
+        Returns
+        -------
+        list
+            The matching documents sorted by COD id.  When `fields`
+            are specified, list of field-value tuples or just values
+            for a single field.
+        """
+        where, params = self._whereclause(q, composition, tol)
+        sql = 'SELECT codid, doc FROM docs'
+        if where:
+            sql += ' WHERE ' + where
+        sql += ' ORDER BY codid'
+        with metrics.timer('docstore_query_seconds'):
+            rows = self.connection.execute(sql, params).fetchall()
+        docs = (json.loads(d) for codid, d in rows)
+        if isinstance(fields, str):
+            fields = fields.replace(',', ' ').split()
+        if not fields:
+            return list(docs)
+        rv = [tuple(doc.get(n) for n in fields) for doc in docs]
+        if len(fields) == 1:
+            rv = [x[0] for x in rv]
+        return rv
+
+
+    def codids(self, q=None, composition=None, tol=None):
+        """Return sorted COD ids of matching documents.
+
+        The arguments are the same as for `search`.
+        """
+        where, params = self._whereclause(q, composition, tol)
+        sql = 'SELECT codid FROM docs'
+        if where:
+            sql += ' WHERE ' + where
+        sql += ' ORDER BY codid'
+        with metrics.timer('docstore_query_seconds'):
+            rv = [codid for codid, in self.connection.execute(sql, params)]
+        return rv
+
+
+    def _whereclause(self, q, composition, tol):
+        "Return SQL condition and its parameters for the query."
+        conditions = []
+        params = []
+        for field, op, value in (parsequery(q) if q else []):
+            if field not in ('codid',) + NUMERICFIELDS + TEXTFIELDS:
+                emsg = "Unsupported query field {!r}.".format(field)
+                raise ValueError(emsg)
+            if op == 'glob':
+                conditions.append('{} GLOB ?'.format(field))
+            else:
+                conditions.append('{} {} ?'.format(field, op))
+            params.append(value)
+        if composition:
+            from diffpy.pdfgetx.functs import composition_analysis
+            smbls, counts = composition_analysis(composition)
+            tol = tol or 0.0
+            sqlcmp = ('codid IN (SELECT codid FROM composition '
+                      'WHERE element = ? AND fraction BETWEEN ? AND ?)')
+            for s, c in zip(smbls, counts):
+                conditions.append(sqlcmp)
+                params += [s, c - tol, c + tol]
+        rv = ' AND '.join(conditions), params
+        return rv
+
+
+    def _createtables(self):
+        """Create tables and indexes if they do not exist.
+
+        Columns of fields added after the store was created are appended
+        to the docs table and filled from the stored documents.
+        """
+        columns = (['codid INTEGER PRIMARY KEY'] +
+                   ['{} REAL'.format(n) for n in NUMERICFIELDS] +
+                   ['{} TEXT'.format(n) for n in TEXTFIELDS] +
+                   ['doc TEXT'])
+        con = self.connection
+        with con:
+            con.execute('CREATE TABLE IF NOT EXISTS docs ({})'.format(
+                ', '.join(columns)))
+            cur = con.execute('PRAGMA table_info(docs)')
+            existing = set(row[1] for row in cur)
+            for c in columns[1:]:
+                n = c.split()[0]
+                if n in existing:
+                    continue
+                con.execute('ALTER TABLE docs ADD COLUMN ' + c)
+                con.execute("UPDATE docs SET {0} = "
+                            "json_extract(doc, '$.{0}')".format(n))
+            con.execute('CREATE TABLE IF NOT EXISTS composition '
+                        '(codid INTEGER, element TEXT, fraction REAL)')
+            for n in NUMERICFIELDS + TEXTFIELDS:
+                con.execute('CREATE INDEX IF NOT EXISTS docs_{0} '
+                            'ON docs ({0})'.format(n))
+            con.execute('CREATE INDEX IF NOT EXISTS composition_element '
+                        'ON composition (element, fraction)')
+            con.execute('CREATE INDEX IF NOT EXISTS composition_codid '
+                        'ON composition (codid)')
+        return
+
+# end of class DocStore
+
+
+def parsequery(q):
+    """Parse query string in a subset of Lucene syntax.
+
+    The query is a sequence of terms that are optionally joined by
+    "AND".  Supported terms are ``field:value``, ``field:"quoted value"``
+    and ranges ``field:[lo TO hi]`` with inclusive or ``field:{lo TO hi}``
+    with exclusive bounds, where "*" stands for an open bound.  Values
+    with "*" or "?" are matched as wildcard patterns.
+
+    Parameters
+    ----------
+    q : str
+        The query string.
+
+    Returns
+    -------
+    list
+        List of (field, operator, value) tuples, where operator is
+        a SQL comparison operator or "glob".
+
+    Raises
+    ------
+    ValueError
+        When the query has unsupported syntax.
+    """
+    rv = []
+    pos = 0
+    q = q.strip()
+    while pos < len(q):
+        mx = _rxqueryterm.match(q, pos)
+        if not mx:
+            emsg = "Unsupported query syntax at {!r}.".format(q[pos:])
+            raise ValueError(emsg)
+        pos = mx.end()
+        field = mx.group('field')
+        lo, hi = mx.group('lo', 'hi')
+        value = mx.group('value')
+        if lo is not None:
+            if lo != '*':
+                op = '>' if mx.group('open') == '{' else '>='
+                rv.append((field, op, _qvalue(lo)))
+            if hi != '*':
+                op = '<' if mx.group('close') == '}' else '<='
+                rv.append((field, op, _qvalue(hi)))
+        elif value is None:
+            rv.append((field, '=', mx.group('quoted')))
+        elif re.search(r'[*?]', value):
+            rv.append((field, 'glob', value))
+        else:
+            rv.append((field, '=', _qvalue(value)))
+    return rv
+
+
+def _qvalue(s):
+    "Convert numeric query value to float."
+    try:
+        rv = float(s)
+    except ValueError:
+        rv = s
+    return rv
+
+
+_rxqueryterm = re.compile(r'''
+    (?P<field>\w+):
+    (?:
+        (?P<open>[\[{])\s*(?P<lo>\S+)\s+TO\s+
+        (?P<hi>[^\]}\s]+)\s*(?P<close>[\]}]) |
+        "(?P<quoted>[^"]*)" |
+        (?P<value>[^\s"\[{][^\s"]*)
+    )
+    (?:\s+AND\s+|\s+|$)
+    ''', re.VERBOSE)
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+'''
+Persistent status journal for bulk PDF calculations.
+
+The journal is an append-only file in JSON lines format with one status
+record per line.  The last record for each COD identifier determines its
+current status, which makes it possible to resume interrupted runs.
+'''
+
+import os
+import json
+import time
+import socket
+
+
+# Status values in the journal records.
+STARTED = 'started'
+OK = 'ok'
+ERROR = 'error'
+TIMEOUT = 'timeout'
+
+# Names of exceptions which may succeed when calculated again.
+TRANSIENT_ERRORS = frozenset('''
+    Timeout WorkerError MemoryError OSError IOError
+    BlockingIOError InterruptedError KeyboardInterrupt
+    '''.split())
+
+
+def confighash(cfg):
+    """Return short hash string for a JSON-like configuration.
+
+    Parameters
+    ----------
+    cfg : dict
+        The configuration dictionary, for example, PDFCALCULATOR.
+
+    Returns
+    -------
+    str
+        The first 12 hexadecimal digits of SHA1 checksum of the
+        JSON representation with sorted keys.
+    """
+    from hashlib import sha1
+    s = json.dumps(cfg, sort_keys=True)
+    rv = sha1(s.encode()).hexdigest()[:12]
+    return rv
+
+
+class CalcJournal:
+    """Append-only journal of PDF calculation status records.
+
+    Attributes
+    ----------
+    filename : str
+        Absolute path to the journal file.
+    records : dict
+        The last status record for each 7-digit COD identifier.
+    """
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.records = {}
+        self._fp = None
+        self._offset = 0
+        self._host = socket.gethostname()
+        self.load()
+        return
+
+
+    def load(self):
+        """Read all status records from the journal file.
+        """
+        self.records.clear()
+        self._offset = 0
+        self.refresh()
+        return
+
+
+    def refresh(self):
+        """Read status records appended to the journal since last read.
+
+        This picks up records from other processes that share the
+        journal.  Skip any incomplete line at the end of file, which
+        may be still written or left behind by an interrupted writer.
+        """
+        if not os.path.isfile(self.filename):
+            return
+        with open(self.filename, 'rb') as fp:
+            fp.seek(self._offset)
+            for line in fp:
+                if not line.endswith(b'\n'):
+                    break
+                self._offset += len(line)
+                try:
+                    rec = json.loads(line.decode())
+                except ValueError:
+                    continue
+                self.records[rec['codid']] = rec
+        return
+
+
+    def write(self, codid, status, **kwargs):
+        """Append status record for the specified COD entry.
+
+        Parameters
+        ----------
+        codid : str
+            The 7-digit COD identifier.
+        status : str
+            The calculation status, one of "started", "ok",
+            "error" or "timeout".
+        kwargs : misc, optional
+            Extra items such as "error", "message", "duration",
+            "cif" or "config" to be saved in the record.
+
+        Returns
+        -------
+        dict
+            The status record written to the journal.
+        """
+        rec = dict(kwargs, codid=codid, status=status)
+        rec.setdefault('time', time.time())
+        rec.setdefault('host', self._host)
+        if self._fp is None:
+            self._fp = open(self.filename, 'a')
+        self._fp.write(json.dumps(rec, sort_keys=True) + '\n')
+        self._fp.flush()
+        self.records[codid] = rec
+        return rec
+
+
+    def merge(self, journal):
+        """Merge the last status records from another journal.
+
+        Keep the newer record for COD identifiers in both journals.
+        This combines the journals of lease owners for reports.
+
+        Parameters
+        ----------
+        journal : CalcJournal
+            The other journal.
+        """
+        for codid, rec in journal.records.items():
+            old = self.records.get(codid)
+            if old is None or rec['time'] >= old['time']:
+                self.records[codid] = rec
+        return
+
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+        return
+
+
+    def istransient(self, rec):
+        "Return True if status record is for a failure worth retrying."
+        rv = (rec['status'] == TIMEOUT or
+              (rec['status'] == ERROR and
+               rec.get('error') in TRANSIENT_ERRORS))
+        return rv
+
+
+    def needsrun(self, codid, config=None, retryfailed=False,
+                 staleafter=None):
+        """Check if PDF calculation of a COD entry should be run.
+
+        Parameters
+        ----------
+        codid : str
+            The 7-digit COD identifier.
+        config : str, optional
+            Hash of the current calculator configuration.  Entries
+            recorded with a different configuration are always run.
+        retryfailed : bool, optional
+            Also run entries that failed with a permanent error.
+        staleafter : float, optional
+            Age in seconds after which a "started" record without
+            a result is considered abandoned.  Started entries are
+            assumed in progress when not specified.
+
+        Returns
+        -------
+        bool
+        """
+        rec = self.records.get(codid)
+        if rec is None:
+            return True
+        if config is not None and rec.get('config') != config:
+            return True
+        status = rec['status']
+        if status == OK:
+            return False
+        if status == STARTED:
+            age = time.time() - rec['time']
+            return staleafter is not None and age > staleafter
+        rv = retryfailed or self.istransient(rec)
+        return rv
+
+
+    def statistics(self):
+        """Summarize the journal records.
+
+        Returns
+        -------
+        dict
+            Dictionary with record counts per "status" and per "error"
+            class, the number of "finished" entries, their "duration"
+            statistics, wall-clock "elapsed" time from the first start
+            to the last result and the "throughput" in structures per
+            second.
+        """
+        import numpy
+        final = [r for r in self.records.values() if r['status'] != STARTED]
+        rv = {}
+        rv['status'] = {}
+        rv['error'] = {}
+        for rec in self.records.values():
+            st = rec['status']
+            rv['status'][st] = rv['status'].get(st, 0) + 1
+            if 'error' in rec:
+                en = rec['error']
+                rv['error'][en] = rv['error'].get(en, 0) + 1
+        rv['finished'] = len(final)
+        elapsed = 0.0
+        if final:
+            durations = numpy.array([r.get('duration', 0) for r in final])
+            tfinish = numpy.array([r['time'] for r in final])
+            rv['duration'] = dict(
+                total=durations.sum(),
+                mean=durations.mean(),
+                median=numpy.median(durations),
+                p95=numpy.percentile(durations, 95),
+                max=durations.max())
+            elapsed = tfinish.max() - (tfinish - durations).min()
+        rv['elapsed'] = elapsed
+        rv['throughput'] = len(final) / elapsed if elapsed > 0 else None
+        return rv
+
+# end of class CalcJournal
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+'''
+Coordinator-free work distribution through lease files.
+
+A list of work items is split into lease files in a shared directory.
+Worker processes, possibly on different nodes, claim leases by renaming
+them to a name that includes the owner.  Owners renew their leases by
+updating the file modification time.  Leases which were not renewed for
+longer than the expiration time can be reclaimed by other workers.
+Renames are atomic so only one worker can succeed in any claim.
+
+Lease files are named as follows::
+
+    lease-000000.txt                    available
+    lease-000000.txt.claim-OWNER        claimed by OWNER
+    lease-000000.txt.done               completed
+'''
+
+import os
+import re
+import time
+import socket
+
+
+class LeaseDirectory:
+    """Shared directory with lease files.
+
+    Attributes
+    ----------
+    path : str
+        Absolute path to the lease directory.
+    owner : str
+        Identifier of this worker, by default "hostname-pid".
+    expire : float
+        Time in seconds after which unrenewed leases can be reclaimed.
+    """
+
+    _fmt = 'lease-{:06d}.txt'
+    _rxlease = re.compile(r'^(lease-\d+\.txt)(?:\.claim-(.+)|\.done)?$')
+
+    def __init__(self, path, owner=None, expire=3600):
+        self.path = os.path.abspath(path)
+        if owner is None:
+            owner = '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.owner = owner
+        self.expire = expire
+        return
+
+
+    def create(self, items, size):
+        """Split work items into lease files.
+
+        Parameters
+        ----------
+        items : iterable
+            Strings without newline characters, e.g., CIF file paths.
+            Leases are numbered in the order of items.
+        size : int
+            Maximum number of items per lease.
+
+        Returns
+        -------
+        int
+            The number of created lease files.
+
+        Raises
+        ------
+        FileExistsError
+            When the directory already contains lease files.
+        """
+        from cifpdfsearch._utils import grouper
+        os.makedirs(self.path, exist_ok=True)
+        if any(map(self._rxlease.match, os.listdir(self.path))):
+            emsg = "{} already contains lease files".format(self.path)
+            raise FileExistsError(emsg)
+        n = 0
+        for n, grp in enumerate(grouper(items, size), 1):
+            f = os.path.join(self.path, self._fmt.format(n - 1))
+            with open(f + '.tmp', 'w') as fp:
+                fp.writelines(x + '\n' for x in grp)
+            os.rename(f + '.tmp', f)
+        return n
+
+
+    def status(self):
+        """Return counts of available, claimed, expired and done leases.
+        """
+        rv = dict(available=0, claimed=0, expired=0, done=0)
+        now = time.time()
+        for f in os.listdir(self.path):
+            mx = self._rxlease.match(f)
+            if not mx:
+                continue
+            if f.endswith('.done'):
+                rv['done'] += 1
+            elif mx.group(2) is None:
+                rv['available'] += 1
+            else:
+                mtime = self._getmtime(f)
+                st = 'expired' if now - mtime > self.expire else 'claimed'
+                rv[st] += 1
+        return rv
+
+
+    def claim(self):
+        """Claim the first available or expired lease.
+
+        Returns
+        -------
+        Lease or None
+            The claimed lease or `None` when there is nothing to claim.
+        """
+        while True:
+            names = sorted(os.listdir(self.path))
+            available = []
+            expired = []
+            now = time.time()
+            for f in names:
+                mx = self._rxlease.match(f)
+                if not mx or f.endswith('.done'):
+                    continue
+                if mx.group(2) is None:
+                    available.append((mx.group(1), f))
+                elif now - self._getmtime(f) > self.expire:
+                    expired.append((mx.group(1), f))
+            if not available and not expired:
+                return None
+            for base, f in available + expired:
+                lease = self._tryclaim(base, f)
+                if lease is not None:
+                    return lease
+            # all candidates were taken by others, rescan the directory
+        pass
+
+
+    def _tryclaim(self, base, f):
+        "Rename lease file f to our claim.  Return Lease or None."
+        src = os.path.join(self.path, f)
+        dst = os.path.join(self.path, base + '.claim-' + self.owner)
+        # refresh time stamp first so others do not see an expired claim
+        try:
+            os.utime(src)
+            os.rename(src, dst)
+        except FileNotFoundError:
+            return None
+        return Lease(dst, os.path.join(self.path, base + '.done'))
+
+
+    def _getmtime(self, f):
+        "Return modification time of a lease file or 0 if it was moved."
+        try:
+            rv = os.path.getmtime(os.path.join(self.path, f))
+        except FileNotFoundError:
+            rv = 0
+        return rv
+
+# end of class LeaseDirectory
+
+
+class Lease:
+    """Work items claimed from a LeaseDirectory.
+
+    Attributes
+    ----------
+    filename : str
+        Path to the claimed lease file.
+    items : list
+        Work items in this lease.
+    lost : bool
+        Flag for a lease that was reclaimed by another worker.
+    """
+
+    def __init__(self, filename, donefile):
+        self.filename = filename
+        self._donefile = donefile
+        with open(filename) as fp:
+            self.items = [line.rstrip('\n') for line in fp]
+        self.lost = False
+        return
+
+
+    def renew(self):
+        """Update the lease time stamp.
+
+        Returns
+        -------
+        bool
+            True if the lease is still owned, False if it was lost.
+        """
+        try:
+            os.utime(self.filename)
+        except FileNotFoundError:
+            self.lost = True
+        return not self.lost
+
+
+    def finish(self):
+        """Mark the lease as completed.
+
+        Returns
+        -------
+        bool
+            True if successful, False if the lease was lost.
+        """
+        try:
+            os.rename(self.filename, self._donefile)
+        except FileNotFoundError:
+            self.lost = True
+        return not self.lost
+
+# end of class Lease
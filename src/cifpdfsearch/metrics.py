@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+'''
+Counters and histograms for monitoring the search and build pipelines.
+
+The shared `metrics` registry is disabled by default and its recording
+methods return after a single attribute check.  When enabled, the
+storages count scanned and read rows and bytes, the correlation scans
+count correlated rows, and the applications record query latencies and
+outcomes and durations of PDF calculations.  The metrics can be saved
+to a JSON file, a file in the Prometheus text format or served from a
+Prometheus text endpoint.
+
+Set the CIFPDFSEARCH_METRICS environment variable to a filename to
+enable the metrics and save them at exit.
+'''
+
+import os
+import time
+import threading
+from contextlib import nullcontext
+
+# Default upper bounds of histogram buckets in seconds.
+DEFAULTBUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                  0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Metrics:
+    """Registry of named counters and histograms.
+
+    Attributes
+    ----------
+    enabled : bool
+        Flag for recording the metrics.  Recording methods do nothing
+        when False.
+    prefix : str
+        Prefix of metric names in the Prometheus export.
+    counters : dict
+        Counter values for metric names.
+    histograms : dict
+        Histograms for metric names as dictionaries with the "buckets"
+        upper bounds, "counts" per bucket including the overflow one,
+        and the "count" and "sum" of observed values.
+    """
+
+    def __init__(self, prefix='cifpdfsearch'):
+        self.enabled = False
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        return
+
+
+    def enable(self, flag=True):
+        "Turn the recording on or off."
+        self.enabled = bool(flag)
+        return
+
+
+    def reset(self):
+        "Clear all recorded metrics."
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+        return
+
+
+    def inc(self, name, value=1):
+        "Increase the named counter by value."
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        return
+
+
+    def observe(self, name, value, buckets=DEFAULTBUCKETS):
+        """Add value to the named histogram.
+
+        The `buckets` upper bounds are used when the histogram is created.
+        """
+        if not self.enabled:
+            return
+        from bisect import bisect_left
+        with self._lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = dict(buckets=list(buckets),
+                         counts=(len(buckets) + 1) * [0], count=0, sum=0.0)
+                self.histograms[name] = h
+            h['counts'][bisect_left(h['buckets'], value)] += 1
+            h['count'] += 1
+            h['sum'] += value
+        return
+
+
+    def timer(self, name):
+        """Return context manager that observes its duration in seconds.
+
+        Return a no-op context manager when disabled.
+        """
+        if not self.enabled:
+            return _NULLTIMER
+        return _Timer(self, name)
+
+
+    def snapshot(self):
+        "Return copy of the recorded metrics as a JSON-compatible dictionary."
+        import copy
+        with self._lock:
+            rv = dict(time=time.time(),
+                      counters=dict(self.counters),
+                      histograms=copy.deepcopy(self.histograms))
+        return rv
+
+
+    def prometheusText(self):
+        "Return the metrics in the Prometheus text exposition format."
+        data = self.snapshot()
+        lines = []
+        for name, value in sorted(data['counters'].items()):
+            pname = '{}_{}_total'.format(self.prefix, name)
+            lines.append('# TYPE {} counter'.format(pname))
+            lines.append('{} {!r}'.format(pname, value))
+        for name, h in sorted(data['histograms'].items()):
+            pname = '{}_{}'.format(self.prefix, name)
+            lines.append('# TYPE {} histogram'.format(pname))
+            cumulative = 0
+            bounds = [repr(float(b)) for b in h['buckets']] + ['+Inf']
+            for le, c in zip(bounds, h['counts']):
+                cumulative += c
+                lines.append('{}_bucket{{le="{}"}} {}'.format(
+                    pname, le, cumulative))
+            lines.append('{}_sum {!r}'.format(pname, h['sum']))
+            lines.append('{}_count {}'.format(pname, h['count']))
+        rv = ''.join(line + '\n' for line in lines)
+        return rv
+
+
+    def save(self, filename):
+        """Save the metrics to a file.
+
+        Use the Prometheus text format for the ".prom" extension and
+        JSON otherwise.  The file is replaced atomically.
+        """
+        import json
+        if filename.endswith('.prom'):
+            content = self.prometheusText()
+        else:
+            content = json.dumps(self.snapshot(), indent=1, sort_keys=True)
+        tmp = filename + '.part'
+        with open(tmp, 'w') as fp:
+            fp.write(content)
+        os.replace(tmp, filename)
+        return
+
+
+    def serve(self, port, host=''):
+        """Serve the metrics in Prometheus text format over HTTP.
+
+        Parameters
+        ----------
+        port : int
+            The TCP port.  Use 0 to select any free port.
+        host : str, optional
+            Address of the network interface, all interfaces by default.
+
+        Returns
+        -------
+        http.server.ThreadingHTTPServer
+            The server running in a daemon thread.  Use its `shutdown`
+            method to stop it.
+        """
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = registry.prometheusText().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            def log_message(self, format, *args):
+                return
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+# end of class Metrics
+
+
+class _Timer:
+    "Context manager that observes its duration in a histogram."
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+        return
+
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        dt = time.perf_counter() - self.t0
+        self.registry.observe(self.name, dt)
+        return
+
+# end of class _Timer
+
+
+# Context manager that does nothing for the disabled timer
+_NULLTIMER = nullcontext()
+
+# Shared registry used by the storages and applications
+metrics = Metrics()
+
+
+def saveatexit(filename):
+    """Enable the shared metrics and save them at interpreter exit.
+
+    Parameters
+    ----------
+    filename : str
+        Output file for `Metrics.save`.
+    """
+    import atexit
+    metrics.enable()
+    atexit.register(metrics.save, filename)
+    return
+
+
+if os.environ.get('CIFPDFSEARCH_METRICS'):
+    saveatexit(os.environ['CIFPDFSEARCH_METRICS'])
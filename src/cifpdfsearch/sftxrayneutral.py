@@ -15,9 +15,30 @@ from diffpy.srreal.scatteringfactortable import SFTXray
 class SFTXrayNeutral(ScatteringFactorTable):
     """
     Lookup x-ray scattering factors of bare elements.
+
+    The form factors are tabulated per atom symbol on a fine Q-grid
+    and linearly interpolated, which avoids repeated symbol processing
+    and lookups in the Python callback from the PDF calculator.
+    The tables are shared by all instances and are computed on the
+    first use or in advance with the `preload` method.
+
+    Attributes
+    ----------
+    tabulate : bool
+        Use tabulated form factors.  When False, evaluate each lookup
+        with the SFTXray table.
+    qstep : float
+        Q-step of the form factor tables in 1/A.
+    qmaxtable : float
+        Upper Q-limit of the tables.  Lookups at higher Q are
+        evaluated with the SFTXray table.
     """
 
     __sftxray = SFTXray()
+    tabulate = True
+    qstep = 0.01
+    qmaxtable = 40.0
+    _tables = {}
 
     def create(self):
         return SFTXrayNeutral()
@@ -31,24 +52,76 @@ class SFTXrayNeutral(ScatteringFactorTable):
     def radiationType(self):
         return "XNEUTRAL"
 
+    def preload(self, symbols=None):
+        """Compute form factor tables for the specified atom symbols.
+
+        Parameters
+        ----------
+        symbols : iterable, optional
+            Atom symbols to be tabulated.  Use all elements from
+            H to Cf when not specified.  Unknown symbols are ignored.
+        """
+        if symbols is None:
+            symbols = ELEMENTS
+        for smbl in symbols:
+            try:
+                self._gettable(smbl)
+            except ValueError:
+                pass
+        return
+
     def _sfwater(self, q):
         fh = self.__sftxray._standardLookup("H", q)
         fo = self.__sftxray._standardLookup("O", q)
         return 2 * fh + fo
 
     def _standardLookup(self, smbl, q):
+        if not (self.tabulate and 0 <= q < self.qmaxtable):
+            return self._bareLookup(smbl, q)
+        tb = self._tables.get(smbl)
+        if tb is None:
+            tb = self._gettable(smbl)
+        x = q / self.qstep
+        i = int(x)
+        f0 = tb[i]
+        rv = f0 + (x - i) * (tb[i + 1] - f0)
+        return rv
+
+    def _bareLookup(self, smbl, q):
         smblbare = smbl.rstrip('+-012345678')
         if smblbare == 'D':
-            rv = self._standardLookup('H', q)
+            rv = self._bareLookup('H', q)
         elif smblbare == 'Wa':
             rv = self._sfwater(q)
         else:
             rv = self.__sftxray._standardLookup(smblbare, q)
         return rv
 
+    def _gettable(self, smbl):
+        "Return form factor table for atom symbol, create if necessary."
+        tables = SFTXrayNeutral._tables
+        smblbare = smbl.rstrip('+-012345678')
+        tb = tables.get(smblbare)
+        if tb is None:
+            npts = int(self.qmaxtable / self.qstep) + 2
+            tb = [self._bareLookup(smblbare, i * self.qstep)
+                  for i in range(npts)]
+            tables[smblbare] = tb
+        tables[smbl] = tb
+        return tb
+
 # end of class SFTXrayNeutral
 
 
+ELEMENTS = """
+    H He Li Be B C N O F Ne Na Mg Al Si P S Cl Ar K Ca Sc Ti V Cr Mn Fe
+    Co Ni Cu Zn Ga Ge As Se Br Kr Rb Sr Y Zr Nb Mo Tc Ru Rh Pd Ag Cd In
+    Sn Sb Te I Xe Cs Ba La Ce Pr Nd Pm Sm Eu Gd Tb Dy Ho Er Tm Yb Lu Hf
+    Ta W Re Os Ir Pt Au Hg Tl Pb Bi Po At Rn Fr Ra Ac Th Pa U Np Pu Am
+    Cm Bk Cf
+    """.split()
+
+
 _sftb = SFTXrayNeutral()
 ScatteringFactorTable._deregisterType(_sftb.type())
 _sftb._registerThisType()
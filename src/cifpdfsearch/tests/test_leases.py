@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+'''
+Tests of the lease-based work distribution with several local processes.
+'''
+
+import os
+import sys
+import glob
+import time
+import subprocess
+import multiprocessing
+
+import pytest
+
+import cifpdfsearch
+from cifpdfsearch.leases import LeaseDirectory
+
+NWORKERS = 3
+
+
+def _claimitems(path, owner, outfile):
+    "Process target that writes out items from all leases it can claim."
+    ldir = LeaseDirectory(path, owner=owner, expire=1)
+    with open(outfile, 'w') as fp:
+        for lease in iter(ldir.claim, None):
+            for x in lease.items:
+                fp.write(x + '\n')
+                time.sleep(0.001)
+            lease.finish()
+    return
+
+
+def _crashlease(ldir):
+    "Claim the first lease for a crashed owner that has expired."
+    f = os.path.join(ldir.path, 'lease-000000.txt')
+    os.rename(f, f + '.claim-crashed')
+    os.utime(f + '.claim-crashed', (0, 0))
+    return
+
+
+def test_claims_by_processes(tmp_path):
+    "Leases are claimed by exactly one process including expired ones."
+    items = ['item{:04d}'.format(i) for i in range(200)]
+    ldir = LeaseDirectory(str(tmp_path / 'leases'))
+    assert ldir.create(items, 7) == 29
+    _crashlease(ldir)
+    outfiles = [str(tmp_path / 'out{}.txt'.format(i))
+                for i in range(NWORKERS)]
+    procs = [multiprocessing.Process(target=_claimitems,
+                                     args=(ldir.path, 'w{}'.format(i), f))
+             for i, f in enumerate(outfiles)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+        assert p.exitcode == 0
+    done = []
+    for f in outfiles:
+        with open(f) as fp:
+            done.extend(line.rstrip('\n') for line in fp)
+    assert sorted(done) == items
+    assert ldir.status() == dict(available=0, claimed=0, expired=0, done=29)
+    return
+
+
+def test_expired_lease_takeover(tmp_path):
+    "Owner of a reclaimed lease can neither renew nor finish it."
+    path = str(tmp_path / 'leases')
+    LeaseDirectory(path).create(['a', 'b'], 2)
+    slow = LeaseDirectory(path, owner='slow', expire=3600)
+    lslow = slow.claim()
+    assert lslow.items == ['a', 'b']
+    os.utime(lslow.filename, (0, 0))
+    other = LeaseDirectory(path, owner='other', expire=1)
+    assert other.status()['expired'] == 1
+    lother = other.claim()
+    assert lother.items == ['a', 'b']
+    assert not lslow.renew()
+    assert not lslow.finish()
+    assert lslow.lost
+    assert lother.finish()
+    assert other.claim() is None
+    assert other.status() == dict(available=0, claimed=0, expired=0, done=1)
+    return
+
+
+def test_calcpdfs_leases(tmp_path):
+    "Lease owners compute every COD entry in exactly one shard."
+    pytest.importorskip('diffpy.srreal')
+    pytest.importorskip('diffpy.structure')
+    from cifpdfsearch.cifpdf import RAWStorage
+    codids = []
+    cifs = []
+    for f in sorted(glob.glob(cifpdfsearch.datapath('standards/*.cif'))):
+        cid = cifpdfsearch.normcodid(f)
+        d = tmp_path.joinpath('cod', 'cif', cid[0], cid[1:3], cid[3:5])
+        d.mkdir(parents=True, exist_ok=True)
+        cf = d / (cid + '.cif')
+        cf.write_bytes(open(f, 'rb').read())
+        codids.append(int(cid))
+        cifs.append(str(cf))
+    cfgfile = tmp_path / 'cifpdfsearch.yml'
+    cfgfile.write_text('''\
+coddir: {}
+pdfcalculator:
+  class: PDFCalculator
+  scatteringfactortable: xrayneutral
+  rmin: 0.0
+  rmax: 10.00001
+  rstep: 0.01
+  uisowidth: 0.004
+'''.format(tmp_path / 'cod'))
+    out = tmp_path / 'pdfs'
+    out.mkdir()
+    env = dict(os.environ)
+    srcdir = os.path.dirname(os.path.dirname(cifpdfsearch.__file__))
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [srcdir, env.get('PYTHONPATH')]))
+    calcpdfs = [sys.executable, '-m', 'cifpdfsearch.apps.calcpdfs',
+                '-c', str(cfgfile)]
+    subprocess.run(calcpdfs + ['--make-leases', '2', str(out)] + cifs,
+                   env=env, check=True)
+    _crashlease(LeaseDirectory(str(out / 'leases')))
+    procs = [subprocess.Popen(calcpdfs + ['--leases', '--lease-expire', '5',
+                                          str(out)], env=env)
+             for i in range(NWORKERS)]
+    for p in procs:
+        assert p.wait() == 0
+    shards = [RAWStorage(f) for f in glob.glob(str(out / 'shards/*.yml'))]
+    computed = sorted(c for st in shards for c in st.codids[st.live])
+    assert computed == sorted(codids)
+    merged = str(tmp_path / 'merged.yml')
+    subprocess.run([sys.executable, '-m', 'cifpdfsearch.apps.mergeshards',
+                    '-o', merged] + [st.filename for st in shards],
+                   env=env, check=True)
+    assert sorted(RAWStorage(merged).codids) == sorted(codids)
+    report = subprocess.run(calcpdfs + ['--report', str(out)], env=env,
+                            check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    assert 'finished: {}\n'.format(len(codids)) in report
+    return
@@ -21,12 +21,10 @@ __all__ = ['__date__', '__git_commit__', '__timestamp__', '__version__']
 
 import os.path
 
-from pkg_resources import resource_filename
-
 
 # obtain version information from the version.cfg file
 cp = dict(version='', date='', commit='', timestamp='0')
-fcfg = resource_filename(__name__, 'version.cfg')
+fcfg = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'version.cfg')
 if not os.path.isfile(fcfg):    # pragma: no cover
     from warnings import warn
     warn('Package metadata not found, execute "./setup.py egg_info".')